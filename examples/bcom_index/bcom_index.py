@@ -19,7 +19,7 @@ from hg_systematic.operators import index_composition, index_rolling_contracts,
     index_rolling_weight, business_days, Periods, \
     HolidayCalendar, symbol_is, INDEX_ROLL_FLOAT, INDEX_ROLL_STR
 from hg_systematic.operators._rolling_rules import monthly_rolling_info, MonthlyRollingRequest, \
-    futures_rolling_contracts, bbg_commodity_contract_fn
+    bbg_commodity_contract_fn, multi_asset_rolling_contracts
 
 
 @graph(overloads=index_rolling_weight, requires=symbol_is("BCOM Index"))
@@ -80,17 +80,7 @@ def index_rolling_contracts_bcom(symbol: str, dt: TS[date], calendar: HolidayCal
     rolling_info = monthly_rolling_info(
         request=MonthlyRollingRequest(5, 10, "BCOM")
     )
-    contracts = map_(
-        lambda asset, ri, rs, c_fn: futures_rolling_contracts(ri, rs, asset, c_fn),
-        rolling_info,
-        roll_schedule,
-        bbg_commodity_contract_fn,
-        __keys__=roll_schedule.key_set,
-        __key_arg__="asset",
-    )
-    first = map_(lambda c: c[0], contracts)
-    second = map_(lambda c: c[1], contracts)
-    return INDEX_ROLL_STR.from_ts(first=first, second=second)
+    return multi_asset_rolling_contracts(rolling_info, roll_schedule, bbg_commodity_contract_fn)
 
 
 def create_bcom_holidays() -> frozenset[date]:
@@ -112,3 +102,14 @@ def load_sample_prices() -> Frame[StaticPriceSchema]:
         df = pl.read_csv(resource_path)
     return df.melt("Commodity", variable_name="date", value_name="price").cast({"date": date}).rename(
         {"Commodity": "symbol"}).select("date", "symbol", "price").sort("date")
+
+
+def load_sample_wide_prices() -> pl.DataFrame:
+    """
+    The sample prices as a date x symbol frame, for use with ``price_in_dollars_wide_impl``.
+    """
+    import examples.bcom_index
+    source = files(examples.bcom_index).joinpath("bcom_prices.csv")
+    with as_file(source) as resource_path:
+        df = pl.read_csv(resource_path)
+    return df.transpose(include_header=True, header_name="date", column_names="Commodity").cast({"date": date})
@@ -0,0 +1,59 @@
+"""
+A simple harness for benchmarks comparing alternative implementations of the same service.
+
+The node counts are taken from the start trace of a run, this is written by the (native) runtime so the trace output
+is captured from stdout. The nodes started includes the nodes of nested graphs each time they are (re-)built, for
+example by a ``switch_`` changing branch. The timing is taken from a separate un-traced run.
+"""
+import os
+import re
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+
+from hgraph import run_graph
+
+__all__ = ["BenchmarkResult", "benchmark_graph", "print_benchmarks"]
+
+_NODE_STARTED = re.compile(r"\) (?:-> \S+ )?Started node")
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    name: str
+    nodes: int  # The number of nodes started, including nodes started in nested graphs (map_, switch_, etc.)
+    ticks: int  # The number of ticks of the graph output
+    seconds: float  # The (un-traced) run time
+
+    @property
+    def us_per_tick(self) -> float:
+        return self.seconds * 1e6 / max(self.ticks, 1)
+
+
+def benchmark_graph(name: str, graph_fn: Callable, start_time: datetime, end_time: datetime, *args,
+                    **kwargs) -> BenchmarkResult:
+    """Runs the graph traced (to count the nodes started) and un-traced (to time the run)"""
+    with tempfile.TemporaryFile("w+") as trace:
+        stdout = os.dup(1)
+        os.dup2(trace.fileno(), 1)
+        try:
+            run_graph(graph_fn, *args, start_time=start_time, end_time=end_time,
+                      __trace__=dict(start=True, eval=False, stop=False, node=True, graph=False), **kwargs)
+        finally:
+            os.dup2(stdout, 1)
+            os.close(stdout)
+        trace.seek(0)
+        nodes = sum(1 for line in trace if _NODE_STARTED.search(line))
+
+    start = time.perf_counter()
+    ticks = run_graph(graph_fn, *args, start_time=start_time, end_time=end_time, **kwargs)
+    seconds = time.perf_counter() - start
+    return BenchmarkResult(name, nodes, len(ticks or ()), seconds)
+
+
+def print_benchmarks(*results: BenchmarkResult):
+    print(f"{'implementation':<40}{'nodes':>10}{'ticks':>10}{'seconds':>10}{'us/tick':>10}")
+    for r in results:
+        print(f"{r.name:<40}{r.nodes:>10}{r.ticks:>10}{r.seconds:>10.3f}{r.us_per_tick:>10.1f}")
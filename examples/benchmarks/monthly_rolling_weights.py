@@ -0,0 +1,50 @@
+"""
+Compares the graph (``monthly_rolling_weights_impl``, over the ``monthly_rolling_info`` service) and fused
+(``monthly_rolling_weights_fused_impl``) implementations of ``monthly_rolling_weights``.
+
+::
+
+    python -m examples.benchmarks.monthly_rolling_weights
+
+"""
+from datetime import datetime
+
+from frozendict import frozendict as fd
+from hgraph import graph, TS, register_service, default_path, const, combine, TSL, Size
+
+from examples.bcom_index.bcom_index import create_bcom_holidays
+from examples.benchmarks.harness import benchmark_graph, print_benchmarks
+from hg_systematic.impl import calendar_for_static, business_day_impl, trade_date_week_days, \
+    monthly_rolling_weights_impl, monthly_rolling_info_service_impl, monthly_rolling_weights_fused_impl
+from hg_systematic.operators import monthly_rolling_weights, MonthlyRollingWeightRequest
+
+
+def rolling_weights_graph(impl, *services):
+    """The weights of two requests, ``services`` are the additional service impls the implementation depends on"""
+    @graph
+    def g() -> TSL[TS[float], Size[2]]:
+        register_service(default_path, calendar_for_static, holidays=fd(BCOM=create_bcom_holidays()))
+        register_service(default_path, business_day_impl)
+        register_service(default_path, trade_date_week_days)
+        for service in services:
+            register_service(default_path, service)
+        register_service(default_path, impl)
+        return combine[TSL](
+            monthly_rolling_weights(const(MonthlyRollingWeightRequest(start=5, end=10, round_to=2,
+                                                                      calendar_name="BCOM"))),
+            monthly_rolling_weights(const(MonthlyRollingWeightRequest(start=-3, end=5, round_to=2,
+                                                                      calendar_name="BCOM"))),
+        )
+
+    return g
+
+
+if __name__ == '__main__':
+    start_time, end_time = datetime(2015, 1, 1), datetime(2024, 12, 31)
+    print_benchmarks(
+        benchmark_graph("monthly_rolling_weights_impl", rolling_weights_graph(monthly_rolling_weights_impl,
+                                                                              monthly_rolling_info_service_impl),
+                        start_time, end_time),
+        benchmark_graph("monthly_rolling_weights_fused_impl",
+                        rolling_weights_graph(monthly_rolling_weights_fused_impl), start_time, end_time),
+    )
@@ -1,3 +1,8 @@
+from hg_systematic.impl._compiled_calendar import *
 from hg_systematic.impl._calendar_impl import *
 from hg_systematic.impl._price_impl import *
 from hg_systematic.impl._rolling_rules_impl import *
+from hg_systematic.impl._contract_expiry_impl import *
+from hg_systematic.impl._price_store_impl import *
+from hg_systematic.impl._live_price_impl import *
+from hg_systematic.impl._fx_impl import *
@@ -1,55 +1,192 @@
-import calendar as cal
+import logging
+import os
+import re
+from dataclasses import dataclass
 from datetime import date, timedelta, datetime
-from typing import Iterable
+from functools import cache
+from importlib.metadata import version as package_version
+from pathlib import Path
+from typing import Iterable, Mapping
 
+import numpy as np
 from frozendict import frozendict as fd
 from hgraph import TS, compute_node, \
     graph, service_impl, default_path, contains_, if_true, sample, TSS, TSD, map_, not_, \
-    EvaluationEngineApi, generator, const, index_of, DebugContext
+    EvaluationEngineApi, generator, const, DebugContext, STATE, CompoundScalar, set_delta, K, SCALAR, \
+    REMOVE_IF_EXISTS
 
+from hg_systematic.impl._compiled_calendar import CompiledCalendar, compile_calendar, combine_calendars, \
+    CALENDAR_OPERATIONS, period_range, weekend_days, cached_business_days
 from hg_systematic.operators._calendar import Periods, business_days, business_day, calendar_for, \
-    trade_date, HolidayCalendar, day_index_for
+    trade_date, HolidayCalendar, day_index_for, business_day_index, union_calendars, intersect_calendars, \
+    difference_calendars, business_day_offset, nth_business_day, business_days_between, filter_by_calendar
 
 __all__ = ["business_day_impl", "business_days_impl", "trade_date_week_days", "calendar_for_static", "create_market_holidays",
-           "holiday_const", "day_index_for_impl",]
+           "holiday_const", "day_index_for_impl", "business_day_index_impl", "set_holiday_cache_dir",
+           "market_holiday_ordinals", "union_calendars_impl", "intersect_calendars_impl",
+           "difference_calendars_impl", "business_day_offset_impl", "nth_business_day_impl",
+           "business_days_between_impl", "filter_by_calendar_tsd", "trade_date_sparse", "TradeDateClockInfo",
+           "trade_date_sparse_clock_info"]
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class _CompiledCalendarState(CompoundScalar):
+    calendar: object = None  # The CompiledCalendar for the current calendar value
+
+
+def _compiled_calendar_for(calendar: HolidayCalendar, dt: date, state: _CompiledCalendarState) -> CompiledCalendar:
+    """Keeps the compiled calendar on the state, only re-compiling when the calendar changes or dt is out of range"""
+    if calendar.modified or (compiled := state.calendar) is None or not compiled.covers(dt):
+        compiled = compile_calendar(
+            calendar.holidays.value,
+            calendar.start_of_week.value,
+            calendar.end_of_week.value,
+            dt
+        )
+        state.calendar = compiled
+    return compiled
+
+
+class _BusinessDaysState(_CompiledCalendarState):
+    days: tuple = None  # The business days last produced
 
 
 @compute_node(overloads=business_days)
 def business_days_impl(period: TS[Periods], calendar: HolidayCalendar, dt: TS[date],
+                       _state: STATE[_BusinessDaysState] = None,
                        _output: TS[tuple[date, ...]] = None) -> TS[tuple[date, ...]]:
     dt = dt.value
-    if not period.modified and not calendar.modified and _output.valid and len(dts := _output.value) > 1:
-        # Check if the date is still within the bounds, if it is then no further work required
-        if dts[0] <= dt <= dts[-1]:
-            return  # Don't tick any change
-
-    sow = calendar.start_of_week.value
-    eow = calendar.end_of_week.value
-    holidays = calendar.holidays.value
-    if holidays is None:
-        holidays = frozenset()
-    period = period.value
-    weekends = {(eow + d) % 7 for d in range(1, (sow - eow - 1) % 7 + 1)}
-    if period == Periods.Week:
-        dow = dt.weekday()
-        start_dt = dt - timedelta(days=(dow - sow) if dow >= sow else (dow + 7 - sow))
-        count = 7 - len(weekends)
-    elif period == Periods.Month:
-        start_dt = dt.replace(day=1)
-        count = cal.monthrange(dt.year, dt.month)[1]
-    elif period == Periods.Quarter:
-        start_dt = dt.replace(month=(dt.month - 1) // 3 * 3 + 1, day=1)
-        count = sum(cal.monthrange(start_dt.year, start_dt.month + i)[1] for i in range(3))
-    elif period == Periods.Year:
-        start_dt = dt.replace(month=1, day=1)
-        count = 366 if (dt.year % 4 == 0 and dt.year % 100 != 0) or (dt.year % 400 == 0) else 365
-    else:
-        raise ValueError(f"Unknown period {period}")
-    days = tuple(dt_ for d in range(count) if
-                 (dt_ := start_dt + timedelta(days=d)) not in holidays and dt_.weekday() not in weekends)
+    if not period.modified and _output.valid and len(dts := _state.days) > 1:
+        if not calendar.modified:
+            # Check if the date is still within the bounds, if it is then no further work required
+            if dts[0] <= dt <= dts[-1]:
+                return  # Don't tick any change
+        elif not calendar.start_of_week.modified and not calendar.end_of_week.modified:
+            # Only the holidays have changed, patch the current period if it is affected by the change.
+            start, end = period_range(period.value, dt, calendar.start_of_week.value)
+            if start <= dts[0] <= end:
+                return _patch_business_days(start, end, calendar, _state)
+
+    _state.days = days = cached_business_days(_compiled_calendar_for(calendar, dt, _state), period.value, dt)
     return days
 
 
+def _patch_business_days(start: date, end: date, calendar: HolidayCalendar, state: _BusinessDaysState) \
+        -> tuple[date, ...] | None:
+    """
+    Applies the holiday delta to the business days of the current period, ticking only if the days have changed.
+    The compiled calendar is released to be re-compiled (once per calendar value) when the next period is requested.
+    """
+    state.calendar = None
+    holidays = calendar.holidays
+    weekends = weekend_days(calendar.start_of_week.value, calendar.end_of_week.value)
+    added = {d for d in holidays.added() if start <= d <= end}
+    removed = {d for d in holidays.removed() if start <= d <= end and d.weekday() not in weekends}
+    if not added and not removed:
+        return
+    patched = tuple(sorted(set(days := state.days).difference(added).union(removed)))
+    if patched != days:
+        state.days = patched
+        return patched
+
+
+@compute_node(overloads=business_day_index)
+def business_day_index_impl(period: TS[Periods], calendar: HolidayCalendar, dt: TS[date],
+                            _state: STATE[_CompiledCalendarState] = None, _output: TS[int] = None) -> TS[int]:
+    out = _compiled_calendar_for(calendar, dt.value, _state).day_index(period.value, dt.value)
+    # Changes to the calendar only tick when the index has changed
+    if dt.modified or period.modified or not _output.valid or _output.value != out:
+        return out
+
+
+@compute_node(overloads=business_day_offset)
+def business_day_offset_impl(calendar: HolidayCalendar, dt: TS[date], n: TS[int],
+                             _state: STATE[_CompiledCalendarState] = None) -> TS[date]:
+    dt = dt.value
+    return _compiled_calendar_for(calendar, dt, _state).business_day_offset(dt, n.value)
+
+
+@compute_node(overloads=nth_business_day)
+def nth_business_day_impl(calendar: HolidayCalendar, dt: TS[date], n: TS[int],
+                          _state: STATE[_CompiledCalendarState] = None) -> TS[date]:
+    dt = dt.value
+    return _compiled_calendar_for(calendar, dt, _state).nth_business_day(dt, n.value)
+
+
+@compute_node(overloads=business_days_between)
+def business_days_between_impl(calendar: HolidayCalendar, start: TS[date], end: TS[date],
+                               _state: STATE[_CompiledCalendarState] = None) -> TS[int]:
+    start = start.value
+    end = end.value
+    compiled = _compiled_calendar_for(calendar, min(start, end), _state)
+    if not compiled.covers(max(start, end)):
+        compiled = _compiled_calendar_for(calendar, max(start, end), _state)
+    return compiled.business_days_between(start, end)
+
+
+@compute_node(overloads=contains_)
+def _contains_dt_in_calendar(ts: HolidayCalendar, item: TS[date], _state: STATE[_CompiledCalendarState] = None) \
+        -> TS[bool]:
+    """
+    Determines if the date is within the holiday calendar, for us that means if we deem it a non-working day then
+    the date is within the calendar. This is a bit test against the compiled calendar.
+    """
+    dt = item.value
+    return _compiled_calendar_for(ts, dt, _state).contains(dt)
+
+
+def _combine_calendar_inputs(op: str, lhs: HolidayCalendar, rhs: HolidayCalendar, output: HolidayCalendar):
+    holidays, sow, eow = combine_calendars(
+        CALENDAR_OPERATIONS[op],
+        compile_calendar(lhs.holidays.value, lhs.start_of_week.value, lhs.end_of_week.value),
+        compile_calendar(rhs.holidays.value, rhs.start_of_week.value, rhs.end_of_week.value),
+    )
+    if not output.valid:
+        return {"holidays": holidays, "start_of_week": sow, "end_of_week": eow}
+    out = {}
+    if holidays != (previous := output.holidays.value):
+        out["holidays"] = set_delta(added=holidays - previous, removed=previous - holidays, tp=date)
+    if sow != output.start_of_week.value:
+        out["start_of_week"] = sow
+    if eow != output.end_of_week.value:
+        out["end_of_week"] = eow
+    return out if out else None
+
+
+@compute_node(overloads=union_calendars)
+def union_calendars_impl(lhs: HolidayCalendar, rhs: HolidayCalendar, _output: HolidayCalendar = None) \
+        -> HolidayCalendar:
+    return _combine_calendar_inputs("|", lhs, rhs, _output)
+
+
+@compute_node(overloads=intersect_calendars)
+def intersect_calendars_impl(lhs: HolidayCalendar, rhs: HolidayCalendar, _output: HolidayCalendar = None) \
+        -> HolidayCalendar:
+    return _combine_calendar_inputs("&", lhs, rhs, _output)
+
+
+@compute_node(overloads=difference_calendars)
+def difference_calendars_impl(lhs: HolidayCalendar, rhs: HolidayCalendar, _output: HolidayCalendar = None) \
+        -> HolidayCalendar:
+    return _combine_calendar_inputs("\\", lhs, rhs, _output)
+
+
+@compute_node(overloads=filter_by_calendar, active=("ts",))
+def filter_by_calendar_tsd(ts: TSD[K, TS[SCALAR]], holidays: HolidayCalendar,
+                           _state: STATE[_CompiledCalendarState] = None) -> TSD[K, TS[SCALAR]]:
+    """
+    Filters all the time-series in the dictionary in a single node. Only the modified keys are forwarded and only when
+    they are modified on a working day, key removals are always forwarded.
+    """
+    out = {k: REMOVE_IF_EXISTS for k in ts.removed_keys()}
+    dt = ts.last_modified_time.date()
+    if not _compiled_calendar_for(holidays, dt, _state).contains(dt):
+        out.update((k, v.value) for k, v in ts.modified_items())
+    if out:
+        return out
+
+
 @service_impl(interfaces=(business_day,))
 def business_day_impl(symbol: TSS[str], calendar_path: str = default_path, trade_date_path: str = default_path) -> TSD[
     str, TS[date]]:
@@ -80,28 +217,191 @@ def trade_date_week_days(sow: int = 0, eow: int = 4, _api: EvaluationEngineApi =
         dt += timedelta(days=1)
 
 
+@dataclass(frozen=True)
+class TradeDateClockInfo:
+    """The statistics of a ``trade_date_sparse`` clock over a range, see ``trade_date_sparse_clock_info``"""
+    ticks: int  # The number of trade dates produced
+    week_days: int  # The number of trade dates the week-day clock would have produced over the same range
+
+    @property
+    def cycles_avoided(self) -> int:
+        return self.week_days - self.ticks
+
+
+def _sparse_trade_dates(start: date, end: date, holidays: frozenset[date], dates: frozenset[date],
+                        start_date: date | None, sow: int, eow: int) -> tuple[list[int], TradeDateClockInfo]:
+    """The ordinals of the trade dates in [start, end] with the statistics of the clock"""
+    days = np.arange(start.toordinal(), end.toordinal() + 1, dtype=np.int32)
+    calendar = compile_calendar(holidays, sow, eow, start)
+    is_trade_date = ~calendar.non_working_mask(days)
+    if start_date is not None:
+        is_trade_date &= days >= start_date.toordinal()
+    if dates:
+        is_trade_date |= np.isin(days, np.fromiter((d.toordinal() for d in dates), dtype=np.int32, count=len(dates)))
+    trade_dates = days[is_trade_date].tolist()
+    week_days = len(days) - int(np.count_nonzero(np.isin((days - 1) % 7, tuple(calendar.weekends))))
+    return trade_dates, TradeDateClockInfo(ticks=len(trade_dates), week_days=week_days)
+
+
+def trade_date_sparse_clock_info(start: date, end: date, holidays: frozenset[date] = frozenset(),
+                                 dates: frozenset[date] = frozenset(), start_date: date = None, sow: int = 0,
+                                 eow: int = 4) -> TradeDateClockInfo:
+    """
+    The statistics of the ``trade_date_sparse`` clock with these parameters run from ``start`` to ``end``
+    (inclusive), i.e. the cycles avoided relative to ``trade_date_week_days``.
+    """
+    return _sparse_trade_dates(start, end, holidays, dates, start_date, sow, eow)[1]
+
+
+@service_impl(interfaces=(trade_date,))
+@generator
+def trade_date_sparse(
+        holidays: frozenset[date] = frozenset(),
+        dates: frozenset[date] = frozenset(),
+        start_date: date = None,
+        sow: int = 0,
+        eow: int = 4,
+        _api: EvaluationEngineApi = None
+) -> TS[date]:
+    """
+    Provides a trade-date generator that only ticks on the dates that can change the graph, skipping the dead days
+    the week-day clock would otherwise cycle the engine through.
+
+    The trade dates are the business days of the publish calendar (supply the holidays of the combined calendar,
+    for example the intersection of the publishing calendars' holidays, i.e. their union as business days) from the
+    ``start_date`` (when supplied, typically the earliest index start date), as well as any additional event
+    ``dates`` (for example, the dates prices are available).
+
+    The cycles avoided relative to ``trade_date_week_days`` are logged when the clock starts, these can also be
+    obtained with ``trade_date_sparse_clock_info``.
+    """
+    st = _api.start_time
+    trade_dates, info = _sparse_trade_dates(st.date(), _api.end_time.date(), holidays, dates, start_date, sow, eow)
+    _LOGGER.info(f"[trade_date_sparse] {info.ticks} trade dates, {info.cycles_avoided} of {info.week_days} "
+                 f"week-day cycles avoided")
+    for ordinal in trade_dates:
+        dt = date.fromordinal(ordinal)
+        yield max(datetime(dt.year, dt.month, dt.day), st), dt
+
+
 @service_impl(interfaces=(calendar_for,))
 def calendar_for_static(symbol: TSS[str], holidays: fd[str, frozenset[date]], sow: int = 0, eow: int = 4) -> TSD[
     str, HolidayCalendar]:
-    """Provide a simple stub solution to provide holiday calendars from a fixed source of holidays."""
-    holidays = const(holidays, tp=TSD[str, TSS[date]])
+    """
+    Provide a simple stub solution to provide holiday calendars from a fixed source of holidays.
+
+    The symbol can also be an expression combining the named calendars, for example ``"BCOM|CL NonTrading"``, using
+    ``|`` (union), ``&`` (intersection) and ``\\`` (difference), evaluated left to right. The combined calendar is
+    resolved once per symbol and shared by all subscribers.
+    """
     DebugContext.print("[calendar_for] requests", symbol)
-    return map_(
-        lambda hols: HolidayCalendar.from_ts(holidays=hols, start_of_week=const(sow), end_of_week=const(eow)),
-        holidays,
-        __keys__=symbol
-    )
+    return map_(_static_calendar, holidays=holidays, sow=sow, eow=eow, __keys__=symbol, __key_arg__="symbol")
+
+
+@compute_node
+def _static_calendar(symbol: TS[str], holidays: fd[str, frozenset[date]], sow: int, eow: int) -> HolidayCalendar:
+    if (calendar := _resolve_calendar_expression(symbol.value, holidays, sow, eow)) is not None:
+        holidays_, sow_, eow_ = calendar
+        return {"holidays": holidays_, "start_of_week": sow_, "end_of_week": eow_}
+
+
+_CALENDAR_EXPRESSION = re.compile(r"\s*([" + re.escape("".join(CALENDAR_OPERATIONS)) + r"])\s*")
+
+
+def _resolve_calendar_expression(expression: str, holidays: Mapping[str, frozenset[date]], sow: int, eow: int) \
+        -> tuple[frozenset[date], int, int] | None:
+    """Resolves a calendar name or expression, returns None if any of the calendars named are not present."""
+    if expression in holidays:
+        return holidays[expression], sow, eow
+    tokens = _CALENDAR_EXPRESSION.split(expression)
+    names = tokens[::2]
+    if len(names) == 1 or any(name not in holidays for name in names):
+        return None
+    result = compile_calendar(holidays[names[0]], sow, eow)
+    for op, name in zip(tokens[1::2], names[1:]):
+        result = compile_calendar(
+            *combine_calendars(CALENDAR_OPERATIONS[op], result, compile_calendar(holidays[name], sow, eow)))
+    return result.holidays, result.sow, result.eow
+
+
+# The directory used to cache materialised market holidays, None (the default) disables the on-disk cache.
+_HOLIDAY_CACHE_DIR: str | None = os.environ.get("HG_SYSTEMATIC_CACHE_DIR")
+
+
+def set_holiday_cache_dir(path: str | None):
+    """
+    Sets the directory used to cache the holidays produced by ``create_market_holidays``. The on-disk cache is opt-in,
+    it is disabled (None) unless this is set or ``$HG_SYSTEMATIC_CACHE_DIR`` is defined.
+    """
+    global _HOLIDAY_CACHE_DIR
+    _HOLIDAY_CACHE_DIR = path
 
 
 def create_market_holidays(countries: Iterable[str], start_date_time: datetime, end_date_time: datetime) -> frozenset[
     date]:
-    """Uses the holidays package to generate out holidays for the country codes supplied"""
+    """
+    Uses the holidays package to generate out holidays for the country codes supplied.
+
+    The holiday calendar schema holds dates, so the dates are materialised from the (possibly memory-mapped) ordinals
+    once per process and the same set is returned to every caller asking for the same countries and years.
+    """
+    return _market_holidays(
+        tuple(sorted(set(countries))), start_date_time.year, end_date_time.year, _HOLIDAY_CACHE_DIR
+    )
+
+
+def market_holiday_ordinals(countries: Iterable[str], start_date_time: datetime, end_date_time: datetime) \
+        -> np.ndarray:
+    """
+    The sorted date ordinals of the holidays for the country codes supplied.
+
+    When the on-disk cache is enabled (see ``set_holiday_cache_dir``) the result is cached keyed by the countries, the
+    year range and the version of the holidays package, and is loaded memory-mapped so worker processes share a single
+    copy of the array and skip the holidays package on start up.
+    """
+    return _market_holiday_ordinals(
+        tuple(sorted(set(countries))), start_date_time.year, end_date_time.year, _HOLIDAY_CACHE_DIR
+    )
+
+
+@cache
+def _market_holidays(countries: tuple[str, ...], start_year: int, end_year: int,
+                     cache_dir: str | None) -> frozenset[date]:
+    return frozenset(
+        map(date.fromordinal, _market_holiday_ordinals(countries, start_year, end_year, cache_dir).tolist()))
+
+
+@cache
+def _market_holiday_ordinals(countries: tuple[str, ...], start_year: int, end_year: int,
+                             cache_dir: str | None) -> np.ndarray:
+    file = None
+    if cache_dir is not None:
+        file = Path(cache_dir) / \
+               f"holidays-{'_'.join(countries)}-{start_year}-{end_year}-{package_version('holidays')}.npy"
+        try:
+            return np.load(file, mmap_mode="r")
+        except (OSError, ValueError):
+            pass  # Not cached yet (or unreadable), so materialise it
+
     import holidays
+    years = list(range(start_year, end_year + 1))
     out = set()
-    years = list(range(start_date_time.year, end_date_time.year + 1))
     for ctry in countries:
         out.update(holidays.country_holidays(ctry, years=years).keys())
-    return frozenset(out)
+    ordinals = np.array(sorted(d.toordinal() for d in out), dtype=np.int32)
+
+    if file is not None:
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a process specific file and rename so concurrent workers never see a partial file
+            tmp = file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, ordinals)
+            os.replace(tmp, file)
+            return np.load(file, mmap_mode="r")
+        except OSError:
+            pass  # The cache is an optimisation, fall back to the in-memory result
+    return ordinals
 
 
 def holiday_const(holidays: frozenset[date], sow: int = 0, eow: int = 4) -> HolidayCalendar:
@@ -123,6 +423,4 @@ def day_index_for_impl(symbol: TSS[str]) -> TSD[str, TS[int]]:
 def _day_of_month_for_impl(symbol: TS[str]) -> TS[int]:
     calendar = calendar_for(symbol)
     dt = business_day(symbol)
-    days_of_month = business_days(Periods.Month, calendar, dt)
-    day_index = index_of(days_of_month, dt) + 1
-    return day_index
+    return business_day_index(Periods.Month, calendar, dt)
@@ -0,0 +1,360 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Iterable, Callable
+
+import numpy as np
+
+from hg_systematic.operators._calendar import Periods
+
+__all__ = ["CompiledCalendar", "compile_calendar", "weekend_days", "combine_calendars", "CALENDAR_OPERATIONS",
+           "period_range", "cached_business_days", "PeriodCacheInfo", "period_cache_info", "set_period_cache_size",
+           "clear_period_cache", "set_compiled_calendar_cache_size", "clear_compiled_calendar_cache"]
+
+
+def weekend_days(sow: int, eow: int) -> frozenset[int]:
+    """The days of the week (0 == Monday) that fall between the end of week and the start of week."""
+    return frozenset((eow + d) % 7 for d in range(1, (sow - eow - 1) % 7 + 1))
+
+
+def period_range(period: Periods, dt: date, sow: int = 0) -> tuple[date, date]:
+    """The first and last (calendar) dates of the period containing dt, weeks start on ``sow``"""
+    if period == Periods.Week:
+        dow = dt.weekday()
+        start = date.fromordinal(dt.toordinal() - ((dow - sow) if dow >= sow else (dow + 7 - sow)))
+        return start, date.fromordinal(start.toordinal() + 6)
+    if period == Periods.Month:
+        start_month, months = dt.month, 1
+    elif period == Periods.Quarter:
+        start_month, months = (dt.month - 1) // 3 * 3 + 1, 3
+    elif period == Periods.Year:
+        start_month, months = 1, 12
+    else:
+        raise ValueError(f"Unknown period {period}")
+    end_month = start_month + months
+    end = date(dt.year + 1, 1, 1) if end_month > 12 else date(dt.year, end_month, 1)
+    return date(dt.year, start_month, 1), date.fromordinal(end.toordinal() - 1)
+
+
+class CompiledCalendar:
+    """
+    A precompiled view over a holiday calendar (holidays, start_of_week, end_of_week) for a range of years.
+
+    The business days are held as a sorted array of date ordinals, with an offset table marking the first business
+    day of each month in the range (quarters and years are slices of the month table), and a map from ordinal to
+    position in the business day array. This makes the period and day-index look-ups O(1) (weeks are a binary search)
+    instead of re-generating the period from the holiday set on each request.
+
+    The non-working days (weekends and holidays) are also held as a packed bitset over the compiled range, making
+    ``contains`` a single bit test.
+
+    Business day arithmetic (offsets, nth business day of a month, counts) is delegated to ``numpy.busday_offset`` and
+    ``numpy.busday_count`` using a ``numpy.busdaycalendar`` derived from the calendar. These accept either a single
+    date or an array of dates (anything convertible to ``datetime64[D]``), the latter being the bulk form for batch
+    research code.
+
+    The range compiled is padded by a year on each side so that weeks spanning a year boundary are correctly
+    described, ``covers`` only reports the years requested.
+    """
+
+    __slots__ = ("key", "holidays", "sow", "eow", "weekends", "start_year", "end_year", "ordinals", "dates", "non_working",
+                 "_first_year", "_base", "_n_days", "_month_offsets", "_position", "_busdaycalendar")
+
+    def __init__(self, holidays: Iterable[date], sow: int, eow: int, start_year: int, end_year: int):
+        self.holidays: frozenset[date] = frozenset(holidays)
+        self.sow = sow
+        self.eow = eow
+        self.key: tuple[frozenset[date], int, int] = (self.holidays, sow, eow)  # The identity of the calendar value
+        self.weekends = weekends = weekend_days(sow, eow)
+        self.start_year = start_year
+        self.end_year = end_year
+        self._first_year = first_year = start_year - 1
+        last_year = end_year + 1
+
+        self._base = date(first_year, 1, 1).toordinal()
+        all_days = np.arange(self._base, date(last_year + 1, 1, 1).toordinal(), dtype=np.int32)
+        self._n_days = len(all_days)
+        is_business_day = ~_non_working_mask(all_days, self.holidays, weekends)
+        self.ordinals: np.ndarray = all_days[is_business_day]
+        self.non_working: bytes = np.packbits(~is_business_day, bitorder="little").tobytes()
+        self.dates: tuple[date, ...] = tuple(date.fromordinal(o) for o in self.ordinals.tolist())
+
+        month_starts = np.fromiter(
+            (date(y, m, 1).toordinal() for y in range(first_year, last_year + 2) for m in range(1, 13)),
+            dtype=np.int32
+        )
+        # Only need the first month of the year after the last year to close the last month.
+        self._month_offsets: tuple[int, ...] = tuple(
+            np.searchsorted(self.ordinals, month_starts[:(last_year - first_year + 1) * 12 + 1]).tolist())
+        self._position: dict[int, int] = {o: ndx for ndx, o in enumerate(self.ordinals.tolist())}
+        self._busdaycalendar: np.busdaycalendar | None = None
+
+    def covers(self, dt: date) -> bool:
+        """True if the date is within the years this calendar was compiled for."""
+        return self.start_year <= dt.year <= self.end_year
+
+    def is_business_day(self, dt: date) -> bool:
+        return dt.toordinal() in self._position
+
+    def contains(self, dt: date) -> bool:
+        """True if dt is a non-working day (i.e. the date is in the holiday calendar)"""
+        if 0 <= (i := dt.toordinal() - self._base) < self._n_days:
+            return bool(self.non_working[i >> 3] >> (i & 7) & 1)
+        return dt.weekday() in self.weekends or dt in self.holidays
+
+    def non_working_mask(self, ordinals: np.ndarray) -> np.ndarray:
+        """A boolean mask over the date ordinals supplied, True where the date is a non-working day"""
+        return _non_working_mask(ordinals, self.holidays, self.weekends)
+
+    def position_of(self, dt: date) -> int:
+        """The position of the date in the business day array, -1 if this is not a business day"""
+        return self._position.get(dt.toordinal(), -1)
+
+    def period_bounds(self, period: Periods, dt: date) -> tuple[int, int]:
+        """
+        The [start, end) positions in the business day array for the period containing dt, a ValueError is raised if
+        dt is not within the years this calendar was compiled for (see ``covers``).
+        """
+        if not self.covers(dt):
+            raise ValueError(f"{dt} is outside the years compiled [{self.start_year}, {self.end_year}]")
+        if period == Periods.Week:
+            dow = dt.weekday()
+            start_ordinal = dt.toordinal() - ((dow - self.sow) if dow >= self.sow else (dow + 7 - self.sow))
+            return (int(np.searchsorted(self.ordinals, start_ordinal)),
+                    int(np.searchsorted(self.ordinals, start_ordinal + 7)))
+        month = (dt.year - self._first_year) * 12 + dt.month - 1
+        if period == Periods.Month:
+            return self._month_offsets[month], self._month_offsets[month + 1]
+        elif period == Periods.Quarter:
+            month -= (dt.month - 1) % 3
+            return self._month_offsets[month], self._month_offsets[month + 3]
+        elif period == Periods.Year:
+            month -= dt.month - 1
+            return self._month_offsets[month], self._month_offsets[month + 12]
+        else:
+            raise ValueError(f"Unknown period {period}")
+
+    def business_days(self, period: Periods, dt: date) -> tuple[date, ...]:
+        """The business days of the period containing dt"""
+        start, end = self.period_bounds(period, dt)
+        return self.dates[start:end]
+
+    def day_index(self, period: Periods, dt: date) -> int:
+        """
+        The 1 based index of dt within the business days of the period containing dt, or 0 if dt is not a
+        business day.
+        """
+        if (ndx := self.position_of(dt)) < 0:
+            return 0
+        return ndx - self.period_bounds(period, dt)[0] + 1
+
+    def period_length(self, period: Periods, dt: date) -> int:
+        """The number of business days in the period containing dt"""
+        start, end = self.period_bounds(period, dt)
+        return end - start
+
+
+    @property
+    def busdaycalendar(self) -> np.busdaycalendar:
+        """The numpy business day calendar (weekmask and holidays) describing this calendar"""
+        if self._busdaycalendar is None:
+            self._busdaycalendar = np.busdaycalendar(
+                weekmask=[0 if d in self.weekends else 1 for d in range(7)],
+                holidays=np.array(sorted(self.holidays), dtype="datetime64[D]"),
+            )
+        return self._busdaycalendar
+
+    def business_day_offset(self, dt, n):
+        """
+        The business day ``n`` business days after dt (before when n is negative). When dt is not a business day it is
+        first rolled to the next business day for non-negative n and the previous business day for negative n, so
+        an offset of 0 is the first business day on or after dt.
+        """
+        days = _as_days(dt)
+        n = np.asarray(n)
+        out = np.where(
+            n < 0,
+            np.busday_offset(days, n, roll="backward", busdaycal=self.busdaycalendar),
+            np.busday_offset(days, n, roll="forward", busdaycal=self.busdaycalendar),
+        )
+        return _as_result(out, dt)
+
+    def nth_business_day(self, dt, n):
+        """
+        The n-th (1 based) business day of the month containing dt, negative values count back from the end of the
+        month (-1 is the last business day). If n is larger than the number of business days in the month the date
+        will be in a following month. There is no 0-th business day, a ValueError is raised if n is 0.
+        """
+        month = _as_days(dt).astype("datetime64[M]")
+        n = np.asarray(n)
+        if np.any(n == 0):
+            raise ValueError("nth_business_day is 1 based (or negative from the end of the month), n cannot be 0")
+        start = np.where(n > 0, month, month + np.timedelta64(1, "M")).astype("datetime64[D]")
+        return _as_result(
+            np.busday_offset(start, np.where(n > 0, n - 1, n), roll="forward", busdaycal=self.busdaycalendar), dt)
+
+    def business_days_between(self, start, end):
+        """The number of business days in [start, end), this is negative when end is before start"""
+        out = np.busday_count(_as_days(start), _as_days(end), busdaycal=self.busdaycalendar)
+        return int(out) if np.ndim(out) == 0 else out
+
+
+def _as_days(dt) -> np.ndarray:
+    return np.asarray(dt, dtype="datetime64[D]")
+
+
+def _as_result(out: np.ndarray, dt):
+    """Scalar inputs produce a date, otherwise the array of datetime64[D] is returned"""
+    return out.item() if np.ndim(out) == 0 and isinstance(dt, date) else out
+
+
+def _non_working_mask(ordinals: np.ndarray, holidays: frozenset[date], weekends: frozenset[int]) -> np.ndarray:
+    # date(1, 1, 1) has ordinal 1 and is a Monday
+    mask = np.isin((ordinals - 1) % 7, np.fromiter(weekends, dtype=np.int32))
+    if holidays:
+        mask |= np.isin(ordinals, np.fromiter((d.toordinal() for d in holidays), dtype=np.int32))
+    return mask
+
+
+# Each compiled calendar holds arrays over every day of its range, so the cache is bounded (least recently used
+# calendars are evicted), ticking and combined calendars would otherwise grow it without limit.
+_COMPILED_CALENDARS: OrderedDict[tuple[frozenset[date], int, int], CompiledCalendar] = OrderedDict()
+_COMPILED_CALENDARS_MAX_SIZE = 64
+
+
+def compile_calendar(holidays: Iterable[date] | None, sow: int = 0, eow: int = 4, dt: date = None) \
+        -> CompiledCalendar:
+    """
+    Returns the compiled calendar for the holidays and week definition, the compiled calendar is shared by all
+    requests for the same calendar value. The calendar covers the years described by the holidays, and is extended
+    to include ``dt`` when supplied.
+    """
+    holidays = frozenset() if holidays is None else frozenset(holidays)
+    key = (holidays, sow, eow)
+    compiled = _COMPILED_CALENDARS.get(key)
+    if compiled is not None:
+        _COMPILED_CALENDARS.move_to_end(key)
+    if compiled is None or (dt is not None and not compiled.covers(dt)):
+        years = {d.year for d in holidays}
+        if dt is not None:
+            years.add(dt.year)
+        if compiled is not None:
+            years.update((compiled.start_year, compiled.end_year))
+        if not years:
+            years.add((dt if dt is not None else date.today()).year)
+        compiled = CompiledCalendar(holidays, sow, eow, min(years), max(years))
+        _COMPILED_CALENDARS[key] = compiled
+        while len(_COMPILED_CALENDARS) > _COMPILED_CALENDARS_MAX_SIZE:
+            _COMPILED_CALENDARS.popitem(last=False)
+    return compiled
+
+
+def set_compiled_calendar_cache_size(max_size: int):
+    """Sets the maximum number of compiled calendars retained, the least recently used are evicted first"""
+    global _COMPILED_CALENDARS_MAX_SIZE
+    _COMPILED_CALENDARS_MAX_SIZE = max(max_size, 0)
+    while len(_COMPILED_CALENDARS) > _COMPILED_CALENDARS_MAX_SIZE:
+        _COMPILED_CALENDARS.popitem(last=False)
+
+
+def clear_compiled_calendar_cache():
+    """Drops all the compiled calendars, calendars in use by running nodes are retained by those nodes"""
+    _COMPILED_CALENDARS.clear()
+
+
+@dataclass(frozen=True)
+class PeriodCacheInfo:
+    hits: int
+    misses: int
+    size: int
+    max_size: int
+
+
+class _PeriodCache:
+    """A size bounded (LRU) cache of the business day tuples of a period, keyed by (calendar, period, start)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[tuple, tuple[date, ...]] = OrderedDict()
+
+    def business_days(self, calendar: CompiledCalendar, period: Periods, dt: date) -> tuple[date, ...]:
+        key = (calendar.key, period, period_range(period, dt, calendar.sow)[0])
+        if (days := self.entries.get(key)) is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return days
+        self.misses += 1
+        days = calendar.business_days(period, dt)
+        if self.max_size > 0:
+            self.entries[key] = days
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return days
+
+
+_PERIOD_CACHE = _PeriodCache(4096)
+
+
+def cached_business_days(calendar: CompiledCalendar, period: Periods, dt: date) -> tuple[date, ...]:
+    """
+    The business days of the period containing dt, the (immutable) tuple is shared by all requests for the same
+    calendar value and period from the process wide period cache.
+    """
+    return _PERIOD_CACHE.business_days(calendar, period, dt)
+
+
+def period_cache_info() -> PeriodCacheInfo:
+    """The hit / miss counters and size of the period cache, useful when tuning the cache size"""
+    return PeriodCacheInfo(_PERIOD_CACHE.hits, _PERIOD_CACHE.misses, len(_PERIOD_CACHE.entries),
+                           _PERIOD_CACHE.max_size)
+
+
+def set_period_cache_size(max_size: int):
+    """Sets the maximum number of periods held in the period cache, 0 disables the cache"""
+    _PERIOD_CACHE.max_size = max_size
+    while len(_PERIOD_CACHE.entries) > max_size:
+        _PERIOD_CACHE.entries.popitem(last=False)
+
+
+def clear_period_cache():
+    """Empties the period cache and resets the counters"""
+    _PERIOD_CACHE.entries.clear()
+    _PERIOD_CACHE.hits = 0
+    _PERIOD_CACHE.misses = 0
+
+
+# The supported set operations over the non-working days of calendars, keyed by the symbol used in calendar
+# expressions.
+CALENDAR_OPERATIONS: dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    "|": np.logical_or,
+    "&": np.logical_and,
+    "\\": lambda lhs, rhs: lhs & ~rhs,
+}
+
+
+def combine_calendars(op: Callable[[np.ndarray, np.ndarray], np.ndarray], lhs: CompiledCalendar,
+                      rhs: CompiledCalendar) -> tuple[frozenset[date], int, int]:
+    """
+    Combines the non-working days of the two calendars using the set operation ``op`` (see ``CALENDAR_OPERATIONS``)
+    returning the (holidays, start_of_week, end_of_week) of the resultant calendar.
+
+    The operation is performed day by day over the years spanning both calendars. When the resultant
+    weekend can be described as a start and end of week it is, otherwise the calendar has no weekend and the
+    weekend days are encoded into the holidays (so are only correct within the years combined).
+    """
+    days_of_week = np.arange(7)
+    weekends = frozenset(np.flatnonzero(op(
+        np.isin(days_of_week, list(lhs.weekends)), np.isin(days_of_week, list(rhs.weekends))
+    )).tolist())
+    week = next(((sow, eow) for sow in range(7) for eow in range(7) if weekend_days(sow, eow) == weekends), None)
+    sow, eow = (0, 6) if week is None else week
+    encoded_weekends = weekend_days(sow, eow)
+
+    start_year = min(lhs.start_year, rhs.start_year)
+    end_year = max(lhs.end_year, rhs.end_year)
+    days = np.arange(date(start_year, 1, 1).toordinal(), date(end_year + 1, 1, 1).toordinal(), dtype=np.int32)
+    non_working = op(lhs.non_working_mask(days), rhs.non_working_mask(days))
+    non_working &= ~np.isin((days - 1) % 7, np.fromiter(encoded_weekends, dtype=np.int32))
+    return frozenset(map(date.fromordinal, days[non_working].tolist())), sow, eow
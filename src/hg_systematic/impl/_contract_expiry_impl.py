@@ -0,0 +1,117 @@
+import weakref
+from bisect import bisect_left
+from datetime import date
+from typing import Iterable
+
+from hgraph import service_impl, TSS, TSD, TS, Frame, graph, map_, compute_node, STATE, CompoundScalar, default_path
+
+from hg_systematic.operators import trade_date
+from hg_systematic.operators._rolling_rules import ContractExpiry, FutureContract, contract_expiry, next_live_contract
+
+__all__ = ["ContractExpiryTable", "contract_expiry_table", "contract_expiry_static_impl",
+           "next_live_contract_static_impl"]
+
+
+class ContractExpiryTable:
+    """
+    A precomputed table of contract expiries. The contracts of each asset are held sorted by their last live date,
+    making "next live contract as of date" a binary search, and expiry look-ups by contract are a dictionary
+    look-up.
+    """
+
+    __slots__ = ("_expiries", "_assets")
+
+    def __init__(self, expiries: Iterable[ContractExpiry]):
+        self._expiries: dict[FutureContract, ContractExpiry] = {e.contract: e for e in expiries}
+        by_asset: dict[str, list[ContractExpiry]] = {}
+        for e in self._expiries.values():
+            by_asset.setdefault(e.asset, []).append(e)
+        self._assets: dict[str, tuple[list[int], tuple[ContractExpiry, ...]]] = {}
+        for asset, expiries_ in by_asset.items():
+            expiries_.sort(key=lambda e: (e.last_live_date, e.year, e.month))
+            self._assets[asset] = ([e.last_live_date.toordinal() for e in expiries_], tuple(expiries_))
+
+    @staticmethod
+    def from_frame(expiries: Frame[ContractExpiry]) -> "ContractExpiryTable":
+        import polars as pl
+        if not hasattr(expiries, "lazy"):
+            expiries = pl.from_arrow(expiries)
+        return ContractExpiryTable(ContractExpiry(**row) for row in expiries.iter_rows(named=True))
+
+    def expiry(self, contract: FutureContract) -> ContractExpiry | None:
+        return self._expiries.get(contract)
+
+    def contracts(self, asset: str) -> tuple[ContractExpiry, ...]:
+        """The contracts of the asset in order of expiry"""
+        return self._assets.get(asset, ((), ()))[1]
+
+    def next_live(self, asset: str, dt: date) -> ContractExpiry | None:
+        """The first contract of the asset that is still live on dt, None if there are no live contracts"""
+        if (entry := self._assets.get(asset)) is None:
+            return None
+        last_live, expiries = entry
+        ndx = bisect_left(last_live, dt.toordinal())
+        return expiries[ndx] if ndx < len(expiries) else None
+
+    def live(self, asset: str, dt: date) -> tuple[ContractExpiry, ...]:
+        """The contracts of the asset that are still live on dt, in order of expiry"""
+        if (entry := self._assets.get(asset)) is None:
+            return ()
+        last_live, expiries = entry
+        return expiries[bisect_left(last_live, dt.toordinal()):]
+
+
+# The frame (weakly referenced) and its table by the id of the frame, entries are released with their frame
+_TABLES: dict[int, tuple[weakref.ref, ContractExpiryTable]] = {}
+
+
+def contract_expiry_table(expiries: Frame[ContractExpiry]) -> ContractExpiryTable:
+    """
+    The table for the frame, the table is built once and shared by all users of the same frame. The table is released
+    when the frame is.
+    """
+    if (entry := _TABLES.get(key := id(expiries))) is None or entry[0]() is not expiries:
+        _TABLES[key] = entry = (weakref.ref(expiries), ContractExpiryTable.from_frame(expiries))
+        weakref.finalize(expiries, _TABLES.pop, key, None)
+    return entry[1]
+
+
+@service_impl(interfaces=[contract_expiry])
+@graph
+def contract_expiry_static_impl(contract: TSS[FutureContract], expiries: Frame[ContractExpiry]) \
+        -> TSD[FutureContract, TS[ContractExpiry]]:
+    """
+    Provides contract expiries from a fixed frame of expiries.
+    """
+    return map_(lambda key: _contract_expiry(key, expiries), __keys__=contract)
+
+
+@compute_node
+def _contract_expiry(contract: TS[FutureContract], expiries: Frame[ContractExpiry]) -> TS[ContractExpiry]:
+    return contract_expiry_table(expiries).expiry(contract.value)
+
+
+@service_impl(interfaces=[next_live_contract])
+@graph
+def next_live_contract_static_impl(asset: TSS[str], expiries: Frame[ContractExpiry], trade_date_path: str = "") \
+        -> TSD[str, TS[ContractExpiry]]:
+    """
+    Provides the next live contract from a fixed frame of expiries, as of the trade date.
+    """
+    dt = trade_date(path=default_path if trade_date_path == "" else trade_date_path)
+    return map_(lambda key, dt_: _next_live_contract(key, dt_, expiries), dt, __keys__=asset)
+
+
+class _NextLiveContractState(CompoundScalar):
+    last_live: date = None  # The last live date of the contract last produced
+
+
+@compute_node
+def _next_live_contract(asset: TS[str], dt: TS[date], expiries: Frame[ContractExpiry],
+                        _state: STATE[_NextLiveContractState] = None) -> TS[ContractExpiry]:
+    dt = dt.value
+    if not asset.modified and _state.last_live is not None and dt <= _state.last_live:
+        return  # Still live
+    if (expiry := contract_expiry_table(expiries).next_live(asset.value, dt)) is not None:
+        _state.last_live = expiry.last_live_date
+        return expiry
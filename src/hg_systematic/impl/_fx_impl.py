@@ -0,0 +1,98 @@
+from typing import Mapping
+
+from frozendict import frozendict
+from hgraph import service_impl, graph, TSS, TSD, TS, map_, compute_node, STATE, CompoundScalar, REMOVE_IF_EXISTS, \
+    set_delta, default_path
+
+from hg_systematic.impl._price_impl import _price_in_dollars_wide
+from hg_systematic.operators import price_in_dollars, fx_rate, NATIVE_PRICE
+
+__all__ = ["fx_rate_static_impl", "price_in_dollars_fx_impl"]
+
+
+@service_impl(interfaces=[fx_rate])
+@graph
+def fx_rate_static_impl(pair: TSS[str], rates: object, date_column: str = "date",
+                        round_to: int = 6) -> TSD[str, TS[float]]:
+    """
+    Provides FX rates from a wide (untyped) frame, a date indexed frame (``date_column``) with one column per pair
+    (for example "EURUSD"), see ``price_in_dollars_wide_impl``.
+    """
+    return map_(lambda rate: rate, _price_in_dollars_wide(rates, date_column, round_to), __keys__=pair)
+
+
+@service_impl(interfaces=[price_in_dollars])
+@graph
+def price_in_dollars_fx_impl(symbol: TSS[str], currencies: Mapping[str, str], native_path: str = NATIVE_PRICE,
+                             fx_path: str = default_path, round_to: int = 2) -> TSD[str, TS[float]]:
+    """
+    Converts prices in the native currency of each symbol into dollars.
+
+    The native prices are obtained from the ``price_in_dollars`` implementation registered on ``native_path``, which
+    is expected to tick prices in their native currency. The currency of each symbol is looked up in ``currencies``,
+    symbols that are not present are taken to be in dollars. The rates are obtained from ``fx_rate`` (on
+    ``fx_path``) as "<currency>USD".
+
+    The conversion is done in a single node for all symbols; a rate tick re-prices all the symbols of its currency in
+    one step against the cached rates, rather than in a node per symbol.
+    """
+    native = map_(lambda key: price_in_dollars(key, path=native_path), __keys__=symbol)
+    pairs = _fx_pairs(symbol, frozendict(currencies))
+    rates = map_(lambda key: fx_rate(key, path=fx_path), __keys__=pairs)
+    return _convert_to_dollars(native, rates, frozendict(currencies), round_to)
+
+
+def _pair(currency: str) -> str:
+    return f"{currency}USD"
+
+
+@compute_node
+def _fx_pairs(symbol: TSS[str], currencies: Mapping[str, str], _output: TSS[str] = None) -> TSS[str]:
+    pairs = {_pair(c) for s in symbol.value if (c := currencies.get(s, "USD")) != "USD"}
+    current = set(_output.value) if _output.valid else set()
+    if pairs != current or not _output.valid:
+        return set_delta(added=pairs - current, removed=current - pairs, tp=str)
+
+
+class _FxConversionState(CompoundScalar):
+    symbols: dict = None  # The symbols of each currency
+    rates: dict = None  # The current rate of each currency
+
+
+@compute_node(valid=tuple())
+def _convert_to_dollars(native: TSD[str, TS[float]], rates: TSD[str, TS[float]], currencies: Mapping[str, str],
+                        round_to: int, _state: STATE[_FxConversionState] = None) -> TSD[str, TS[float]]:
+    if _state.symbols is None:
+        _state.symbols = {}
+        _state.rates = {"USD": 1.0}
+    symbols = _state.symbols
+    cached_rates = _state.rates
+    out = {}
+
+    if native.modified:
+        for s in native.removed_keys():
+            symbols.get(currencies.get(s, "USD"), set()).discard(s)
+            out[s] = REMOVE_IF_EXISTS
+
+    if rates.modified:
+        for pair in rates.removed_keys():
+            # Without a rate the symbols of the currency can no longer be converted
+            cached_rates.pop(currency := pair[:-3], None)
+            for s in symbols.get(currency, ()):
+                out[s] = REMOVE_IF_EXISTS
+        for pair, rate in rates.modified_items():
+            currency = pair[:-3]
+            cached_rates[currency] = rate = rate.value
+            # Re-price every symbol of the currency against the new rate
+            for s in symbols.get(currency, ()):
+                if (price := native[s]).valid:
+                    out[s] = round(price.value * rate, round_to)
+
+    if native.modified:
+        for s, price in native.modified_items():
+            currency = currencies.get(s, "USD")
+            symbols.setdefault(currency, set()).add(s)
+            if (rate := cached_rates.get(currency)) is not None:
+                out[s] = round(price.value * rate, round_to)
+
+    return out if out else None
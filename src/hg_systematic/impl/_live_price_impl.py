@@ -0,0 +1,200 @@
+import asyncio
+import math
+import threading
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Iterable, Mapping
+
+from hgraph import service_impl, TSS, TSD, TS, graph, map_, push_queue, sink_node
+
+from hg_systematic.operators import price_in_dollars
+
+__all__ = ["ConflationStats", "LivePriceFeed", "price_in_dollars_live_impl"]
+
+
+@dataclass(frozen=True)
+class ConflationStats:
+    """The statistics of a live price feed"""
+    received: int  # The ticks received for subscribed symbols
+    published: int  # The prices sent to the graph
+    coalesced: int  # The ticks replaced by a later tick of the same symbol before being sent (last value wins)
+    dropped: int  # The ticks discarded, as the symbol is not subscribed or the price is not a number
+
+
+class LivePriceFeed:
+    """
+    A conflating live price feed. Ticks of ``(symbol, price)`` are read from an asyncio queue, running on the feed's
+    own event loop (in a background thread), and published into the graph.
+
+    A symbol is published at most once per its conflation window (``windows``, defaulting to ``window``), ticks
+    arriving within the window replace the pending price (last value wins). Ticks for symbols that are not
+    subscribed are dropped. This bounds the rate at which dependent indices are re-computed, independent of how
+    bursty the market is.
+
+    Ticks can be put from any thread with ``put``, or replayed with ``replay`` (a stand-in for a file or socket
+    source).
+
+    The event loop and its thread are created when the feed is started (by ``price_in_dollars_live_impl``) and are
+    stopped, joined and closed when the graph stops.
+    """
+
+    def __init__(self, window: timedelta = timedelta(), windows: Mapping[str, timedelta] = None):
+        self._window = window.total_seconds()
+        self._windows = {k: v.total_seconds() for k, v in (windows or {}).items()}
+        self._symbols: frozenset[str] = frozenset()
+        self._loop: asyncio.AbstractEventLoop = None
+        self._queue: asyncio.Queue = None
+        self._thread: threading.Thread = None
+        self._started = threading.Event()
+        self._sender = None
+        self._last_sent: dict[str, float] = {}
+        self._pending: dict[str, float] = {}  # Prices waiting for the window of their symbol to elapse
+        self._ready: dict[str, float] = {}  # Prices to send on the next send
+        self._received = self._published = self._coalesced = self._dropped = 0
+
+    @property
+    def stats(self) -> ConflationStats:
+        return ConflationStats(received=self._received, published=self._published, coalesced=self._coalesced,
+                               dropped=self._dropped)
+
+    def window(self, symbol: str) -> float:
+        """The conflation window of the symbol in seconds"""
+        return self._windows.get(symbol, self._window)
+
+    @property
+    def running(self) -> bool:
+        """True whilst the feed's event loop is running"""
+        return self._thread is not None
+
+    @property
+    def symbols(self) -> frozenset[str]:
+        """The symbols currently subscribed to"""
+        return self._symbols
+
+    def subscribe(self, symbols: Iterable[str]):
+        """Sets the symbols subscribed to, ticks of other symbols are dropped"""
+        self._symbols = frozenset(symbols)
+
+    def start(self, sender):
+        """Starts the feed, publishing the prices with the sender (a push queue sender)"""
+        if self._thread is not None:
+            return
+        self._sender = sender
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="LivePriceFeed", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        """Stops the event loop, waits for its thread to finish and closes the loop"""
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+            self._loop = None
+            self._queue = None
+            self._started.clear()
+            self._pending.clear()
+            self._ready.clear()
+            self._last_sent.clear()
+
+    def put(self, symbol: str, price: float):
+        """Queues a tick, this is safe to call from any thread once the feed is started"""
+        self._started.wait()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (symbol, price))
+
+    def replay(self, ticks: Iterable[tuple[float, str, float]]):
+        """Replays ticks of (delay in seconds, symbol, price) into the feed's queue"""
+        self._started.wait()
+        asyncio.run_coroutine_threadsafe(self._replay(ticks), self._loop)
+
+    async def _replay(self, ticks: Iterable[tuple[float, str, float]]):
+        for delay, symbol, price in ticks:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._queue.put((symbol, price))
+
+    def _run(self):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        self._queue = asyncio.Queue()
+        loop.create_task(self._consume())
+        loop.call_soon(self._started.set)
+        try:
+            loop.run_forever()
+        finally:
+            # Cancel the consumer (and any replays) so the loop closes cleanly
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    async def _consume(self):
+        while True:
+            symbol, price = await self._queue.get()
+            self._on_tick(symbol, price)
+
+    def _on_tick(self, symbol: str, price: float):
+        if symbol not in self._symbols or price is None or math.isnan(price):
+            self._dropped += 1
+            return
+        self._received += 1
+        if symbol in self._pending:
+            self._coalesced += 1
+            self._pending[symbol] = price
+            return
+        if symbol in self._ready:
+            self._coalesced += 1
+            self._ready[symbol] = price
+            return
+        due = self._last_sent.get(symbol, -math.inf) + self.window(symbol)
+        if (now := self._loop.time()) >= due:
+            self._add_ready(symbol, price)
+        else:
+            self._pending[symbol] = price
+            self._loop.call_later(due - now, self._release, symbol)
+
+    def _release(self, symbol: str):
+        if (price := self._pending.pop(symbol, None)) is not None:
+            self._add_ready(symbol, price)
+
+    def _add_ready(self, symbol: str, price: float):
+        if not self._ready:
+            self._loop.call_soon(self._send)
+        self._ready[symbol] = price
+
+    def _send(self):
+        ready, self._ready = self._ready, {}
+        now = self._loop.time()
+        for symbol in ready:
+            self._last_sent[symbol] = now
+        self._published += len(ready)
+        self._sender(ready)
+
+
+@service_impl(interfaces=[price_in_dollars])
+@graph
+def price_in_dollars_live_impl(symbol: TSS[str], feed: object) -> TSD[str, TS[float]]:
+    """
+    Provides live prices from a ``LivePriceFeed``, this is expected to be registered on the ``LIVE_PRICE`` path.
+    The requested symbols are subscribed to on the feed, the feed conflates the ticks of each symbol before they
+    enter the graph.
+    """
+    _subscribe_live_prices(symbol, feed)
+    return map_(lambda price: price, _live_prices(feed), __keys__=symbol)
+
+
+@push_queue(TSD[str, TS[float]])
+def _live_prices(sender, feed: object):
+    feed.start(sender)
+
+
+@sink_node
+def _subscribe_live_prices(symbol: TSS[str], feed: object):
+    feed.subscribe(symbol.value)
+
+
+@_subscribe_live_prices.stop
+def _stop_live_prices(feed: object):
+    feed.stop()
@@ -1,11 +1,14 @@
+import weakref
+
 from frozendict import frozendict
 from hgraph import service_impl, generator, TSS, TSD, TS, TimeSeriesSchema, CompoundScalar, Frame, graph, \
-    EvaluationEngineApi, map_, no_key
-from datetime import date, datetime
+    EvaluationEngineApi, map_, no_key, compute_node, STATE, SCHEDULER, REMOVE_IF_EXISTS
+from datetime import date, datetime, timedelta
 
-from hg_systematic.operators import price_in_dollars
+from hg_systematic.operators import price_in_dollars, returns_in_dollars
 
-__all__ = ["price_in_dollars_static_impl", "StaticPriceSchema"]
+__all__ = ["price_in_dollars_static_impl", "returns_in_dollars_static_impl", "static_prices", "StaticPriceSchema",
+           "price_in_dollars_replay_impl", "scan_prices", "price_in_dollars_wide_impl"]
 
 
 class StaticPriceSchema(CompoundScalar):
@@ -15,30 +18,204 @@ class StaticPriceSchema(CompoundScalar):
     price: float
 
 
+# id(frame) -> (weak reference to the frame, {(round_to, column): prepared frame}), an entry is dropped when its frame
+# is garbage collected.
+_STATIC_PRICES: dict[int, tuple[weakref.ref, dict[tuple[int, str], object]]] = {}
+
+
+def static_prices(prices: Frame[StaticPriceSchema], round_to: int, column: str = "price"):
+    """
+    The (date, symbol, column) of the prices sorted by date, where the column is either the ``price``, rounded to
+    ``round_to``, or its close-to-close ``returns`` (the change in the rounded price since the prior price of the
+    symbol, null for the first price).
+
+    Each column is computed when first asked for and shared by the static price and returns implementations for as
+    long as the frame is alive.
+    """
+    import polars as pl
+    if (entry := _STATIC_PRICES.get(key := id(prices))) is None or entry[0]() is not prices:
+        _STATIC_PRICES[key] = entry = (weakref.ref(prices), {})
+        weakref.finalize(prices, _STATIC_PRICES.pop, key, None)
+    if (frame := entry[1].get((round_to, column))) is None:
+        frame = prices if hasattr(prices, "lazy") else pl.from_arrow(prices)
+        frame = frame.lazy().select("date", "symbol", pl.col("price").round(round_to))
+        if column == "returns":
+            frame = frame.sort(
+                by=["symbol", "date"]
+            ).select(
+                "date", "symbol", returns=pl.col("price").diff().over("symbol").round(round_to)
+            )
+        elif column != "price":
+            raise ValueError(f"Unknown static price column: '{column}'")
+        frame = frame.sort(
+            by="date", maintain_order=True
+        ).cast(
+            {'date': datetime}
+        ).collect()
+        entry[1][(round_to, column)] = frame
+    return frame
+
+
 @service_impl(interfaces=[price_in_dollars])
 @graph
 def price_in_dollars_static_impl(symbol: TSS[str], prices: Frame[StaticPriceSchema], round_to: int = 2) -> TSD[str, TS[float]]:
     return map_(lambda price: price, _price_in_dollars_static_impl(prices, round_to), __keys__=symbol)
 
 
+@service_impl(interfaces=[returns_in_dollars])
+@graph
+def returns_in_dollars_static_impl(symbol: TSS[str], prices: Frame[StaticPriceSchema], round_to: int = 2) \
+        -> TSD[str, TS[float]]:
+    """
+    The close-to-close returns of the prices, these are computed (vectorised) once per frame when first requested
+    (see ``static_prices``).
+    """
+    return map_(lambda returns: returns, _price_in_dollars_static_impl(prices, round_to, "returns"), __keys__=symbol)
+
+
 @generator
-def _price_in_dollars_static_impl(prices: Frame[StaticPriceSchema], round_to: int, _api: EvaluationEngineApi=None) -> TSD[str, TS[float]]:
+def _price_in_dollars_static_impl(prices: Frame[StaticPriceSchema], round_to: int, column: str = "price",
+                                  _api: EvaluationEngineApi=None) -> TSD[str, TS[float]]:
     # This approach (ticking everything without filter, etc. has the consequence of not having value immediately
     # available, however, in a dynamic implementation this would have a delay between the time of request to
     # value being available. This could have consequences when swapping out implementations.
     import polars as pl
-    if not hasattr(prices, "lazy"):
-        prices = pl.from_arrow(prices)
-    prices = prices.lazy().sort(
-        by="date"
-    ).cast(
-        {'date': datetime}
-    ).with_columns(
-        pl.col("price").round(round_to)
-    ).filter(
-        pl.col("date").is_between(_api.start_time, _api.end_time)
+    prices = static_prices(prices, round_to, column).lazy().filter(
+        pl.col("date").is_between(_api.start_time, _api.end_time),
+        pl.col(column).is_not_null()
     ).collect().partition_by(
         "date", maintain_order=True, include_key=False, as_dict=True
     )
     for dt, prices_ in prices.items():
         yield dt[0], frozendict(prices_.iter_rows())
+
+
+@service_impl(interfaces=[price_in_dollars])
+@graph
+def price_in_dollars_wide_impl(symbol: TSS[str], prices: object, date_column: str = "date",
+                               round_to: int = 2) -> TSD[str, TS[float]]:
+    """
+    Provides prices from a wide frame, that is a date indexed frame (``date_column``) with one (numeric) column per
+    symbol, for example as loaded from a date x symbol parquet file. The columns depend on the symbols held, so the
+    frame is untyped (a polars or arrow frame), non-numeric columns other than the date are ignored. This avoids unpivoting the frame into
+    ``StaticPriceSchema`` rows only to partition them back into dates, the rows are ticked from a single date x symbol
+    array rather than from per-row Python tuples.
+    """
+    return map_(lambda price: price, _price_in_dollars_wide(prices, date_column, round_to), __keys__=symbol)
+
+
+@generator
+def _price_in_dollars_wide(prices: object, date_column: str, round_to: int,
+                           _api: EvaluationEngineApi = None) -> TSD[str, TS[float]]:
+    import numpy as np
+    import polars as pl
+    if not hasattr(prices, "lazy"):
+        prices = pl.from_arrow(prices)
+    if date_column not in prices.schema:
+        raise ValueError(f"The wide price frame has no date column: '{date_column}'")
+    symbols = [c for c, tp in prices.schema.items() if c != date_column and tp.is_numeric()]
+    prices = prices.lazy().select(
+        pl.col(date_column).cast(datetime), pl.col(symbols).cast(pl.Float64).round(round_to)
+    ).filter(
+        pl.col(date_column).is_between(_api.start_time, _api.end_time)
+    ).sort(date_column).collect()
+    # A single date x symbol array of the (selected, rounded and sorted) prices, this is a copy of the frame's buffers
+    values = prices.select(symbols).to_numpy()
+    present = ~np.isnan(values)
+    symbols = np.array(symbols, dtype=object)
+    for dt, row, mask in zip(prices[date_column], values, present):
+        if mask.any():
+            yield dt, frozendict(zip(symbols[mask], row[mask].tolist()))
+
+
+def scan_prices(source: str):
+    """
+    Lazily scans a ``StaticPriceSchema`` shaped price source, Parquet (``.parquet``, this may be a glob) or
+    Arrow IPC (``.arrow``, ``.ipc``, ``.feather``).
+    """
+    import polars as pl
+    if source.endswith(".parquet"):
+        return pl.scan_parquet(source)
+    elif source.endswith((".arrow", ".ipc", ".feather")):
+        return pl.scan_ipc(source)
+    raise ValueError(f"Unsupported price source: '{source}'")
+
+
+@service_impl(interfaces=[price_in_dollars])
+def price_in_dollars_replay_impl(symbol: TSS[str], source: str, round_to: int = 2, chunk_days: int = 90) \
+        -> TSD[str, TS[float]]:
+    """
+    Replays prices from a (lazily scanned) Parquet or Arrow IPC source (see ``scan_prices``) of
+    ``StaticPriceSchema`` shaped data.
+
+    Unlike ``price_in_dollars_static_impl`` only the requested symbols are read and ticked. The source is read in
+    date ordered chunks of ``chunk_days``, with the requested symbols pushed down into the scan. When a symbol is
+    requested it ticks with its last price (on or before the current date) and the current chunk is re-read to
+    include it.
+    """
+    return _price_in_dollars_replay(symbol, source, round_to, chunk_days)
+
+
+class _PriceReplayState(CompoundScalar):
+    symbols: frozenset[str] = frozenset()  # The symbols loaded in the current chunk
+    chunk: object = None  # The prices of the current chunk, a list of (date, {symbol: price})
+    position: int = 0  # The next entry in the chunk to tick
+    chunk_end: date = None  # The (exclusive) end of the current chunk
+    ticked: date = None  # The last date ticked
+
+
+@compute_node
+def _price_in_dollars_replay(symbol: TSS[str], source: str, round_to: int, chunk_days: int,
+                             _state: STATE[_PriceReplayState] = None, _scheduler: SCHEDULER = None,
+                             _api: EvaluationEngineApi = None) -> TSD[str, TS[float]]:
+    import polars as pl
+
+    now = _api.evaluation_clock.evaluation_time
+    today = now.date()
+    out = {}
+
+    if symbol.modified:
+        for s in symbol.removed():
+            out[s] = REMOVE_IF_EXISTS
+        if added := list(symbol.added()):
+            # The new symbols tick with their last price (since the start of the replay) on or before today
+            out.update(scan_prices(source).filter(
+                pl.col("symbol").is_in(added),
+                pl.col("date").cast(pl.Date).is_between(_api.start_time.date(), today)
+            ).sort("date").group_by("symbol").last().select(
+                "symbol", pl.col("price").round(round_to)
+            ).collect().iter_rows())
+        if (symbols := frozenset(symbol.value)) != _state.symbols:
+            # Re-read the remainder of the current chunk for the requested symbols
+            _state.symbols = symbols
+            _state.chunk = None
+
+    if _state.chunk is None or (_state.position >= len(_state.chunk) and today >= _state.chunk_end):
+        start = today if _state.chunk is None else _state.chunk_end
+        end = start + timedelta(days=chunk_days)
+        chunk = scan_prices(source).filter(
+            pl.col("symbol").is_in(list(_state.symbols)),
+            pl.col("date").cast(pl.Date).is_between(start, end, closed="left")
+        ).select(
+            pl.col("date").cast(pl.Date), "symbol", pl.col("price").round(round_to)
+        ).sort("date").collect() if _state.symbols else None
+        _state.chunk = [] if chunk is None else [
+            (k[0], dict(v.iter_rows())) for k, v in chunk.partition_by(
+                "date", maintain_order=True, include_key=False, as_dict=True).items()
+            if _state.ticked is None or k[0] > _state.ticked
+        ]
+        _state.position = 0
+        _state.chunk_end = end
+
+    chunk = _state.chunk
+    if _state.position < len(chunk) and chunk[_state.position][0] <= today:
+        out.update(chunk[_state.position][1])
+        _state.ticked = chunk[_state.position][0]
+        _state.position += 1
+
+    if _state.symbols:
+        next_dt = chunk[_state.position][0] if _state.position < len(chunk) else _state.chunk_end
+        if next_dt <= _api.end_time.date():
+            _scheduler.schedule(
+                max(datetime(next_dt.year, next_dt.month, next_dt.day), now + timedelta(microseconds=1)))
+    return out if out else None
@@ -0,0 +1,206 @@
+import os
+from datetime import date, datetime, timedelta
+from heapq import heappush, heappop
+
+from hgraph import service_impl, TSS, TSD, TS, Frame, compute_node, STATE, SCHEDULER, CompoundScalar, \
+    EvaluationEngineApi, REMOVE_IF_EXISTS
+
+from hg_systematic.impl._price_impl import StaticPriceSchema
+from hg_systematic.operators import price_in_dollars, returns_in_dollars
+
+__all__ = ["PriceStore", "write_price_store", "price_store", "clear_price_stores", "price_in_dollars_store_impl",
+           "returns_in_dollars_store_impl"]
+
+
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _index_path(path: str) -> str:
+    return f"{path}.index"
+
+
+def write_price_store(prices: Frame[StaticPriceSchema], path: str):
+    """
+    Writes ``StaticPriceSchema`` shaped prices as a price store. The prices are written as an uncompressed Arrow IPC
+    file sorted by (symbol, date), with a symbol to row range index written alongside (``<path>.index``).
+    """
+    import polars as pl
+    if not hasattr(prices, "lazy"):
+        prices = pl.from_arrow(prices)
+    prices = prices.lazy().select(
+        pl.col("date").cast(pl.Date), pl.col("symbol").cast(pl.String), pl.col("price").cast(pl.Float64)
+    ).drop_nulls().unique(["symbol", "date"], keep="last").sort("symbol", "date").collect()
+    prices.write_ipc(path, compression="uncompressed")
+    prices.with_row_index("row").group_by("symbol", maintain_order=True).agg(
+        start=pl.col("row").first(), end=pl.col("row").last() + 1
+    ).write_ipc(_index_path(path), compression="uncompressed")
+
+
+class PriceStore:
+    """
+    A read-only, memory-mapped price store (see ``write_price_store``). The date and price columns are exposed as
+    numpy views over the mapped file, so the store costs no more than the pages touched and the pages are shared by
+    all processes mapping the same file. The prices of a symbol are the row range given by the index, in date order,
+    so seeking a symbol to a date is a binary search of its range.
+    """
+
+    __slots__ = ("_frame", "_dates", "_prices", "_index", "_previous")
+
+    def __init__(self, path: str):
+        import polars as pl
+        self._frame = pl.read_ipc(path, memory_map=True)  # Keeps the mapping alive for the views below
+        self._dates = self._frame["date"].to_physical().to_numpy()  # Days since the epoch
+        self._prices = self._frame["price"].to_numpy()
+        self._index: dict[str, tuple[int, int]] = {
+            s: (start, end) for s, start, end in pl.read_ipc(_index_path(path), memory_map=False).iter_rows()
+        }
+        self._previous = None
+
+    @property
+    def symbols(self) -> frozenset[str]:
+        return frozenset(self._index)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def range(self, symbol: str) -> tuple[int, int]:
+        """The (start, end) rows of the symbol, an empty range if the symbol is not in the store"""
+        return self._index.get(symbol, (0, 0))
+
+    def seek(self, symbol: str, dt: date) -> int:
+        """The first row of the symbol dated after dt (the end of the range if there are none)"""
+        start, end = self.range(symbol)
+        return start + int(self._dates[start:end].searchsorted(dt.toordinal() - _EPOCH, side="right"))
+
+    def date(self, row: int) -> date:
+        return date.fromordinal(int(self._dates[row]) + _EPOCH)
+
+    def day(self, row: int) -> int:
+        """The date of the row as days since the epoch"""
+        return int(self._dates[row])
+
+    def price(self, row: int) -> float:
+        return float(self._prices[row])
+
+    def previous_price(self, row: int) -> float:
+        """The prior price of the symbol of the row, nan for the first row of a symbol"""
+        if self._previous is None:
+            # A single array (built on first use) shared by all the returns of the store
+            import numpy as np
+            previous = np.empty_like(self._prices)
+            previous[1:] = self._prices[:-1]
+            for start, _ in self._index.values():
+                previous[start] = np.nan
+            self._previous = previous
+        return float(self._previous[row])
+
+
+# path -> (version, store), the version is the (mtime, size) of the store and its index
+_STORES: dict[str, tuple[tuple[int, ...], PriceStore]] = {}
+
+
+def _store_version(path: str) -> tuple[int, ...]:
+    data, index = os.stat(path), os.stat(_index_path(path))
+    return data.st_mtime_ns, data.st_size, index.st_mtime_ns, index.st_size
+
+
+def price_store(path: str) -> PriceStore:
+    """
+    The store for the path, the store is opened (mapped) once per process and re-opened if the file has been
+    re-written since (its modification time or size changed).
+    """
+    version = _store_version(path)
+    if (entry := _STORES.get(path)) is None or entry[0] != version:
+        _STORES[path] = entry = (version, PriceStore(path))
+    return entry[1]
+
+
+def clear_price_stores():
+    """Releases the stores opened by ``price_store``, the mappings are closed once no node holds the store"""
+    _STORES.clear()
+
+
+@service_impl(interfaces=[price_in_dollars])
+def price_in_dollars_store_impl(symbol: TSS[str], store: str, round_to: int = 2) -> TSD[str, TS[float]]:
+    """
+    Provides prices from the memory-mapped price store at the ``store`` path (see ``write_price_store``).
+
+    Each requested symbol holds a cursor into its row range of the store. A symbol requested after the start of the
+    engine seeks straight to the current date and ticks with its last price since the start, rather than replaying
+    its history. The node is scheduled on the next date any requested symbol has a price.
+    """
+    return _price_in_dollars_store(symbol, store, round_to)
+
+
+@service_impl(interfaces=[returns_in_dollars])
+def returns_in_dollars_store_impl(symbol: TSS[str], store: str, round_to: int = 2) -> TSD[str, TS[float]]:
+    """
+    Provides close-to-close returns from the memory-mapped price store at the ``store`` path, the returns are the
+    change in the (rounded) price since the prior price of the symbol and tick as ``price_in_dollars_store_impl``
+    does.
+    """
+    return _price_in_dollars_store(symbol, store, round_to, True)
+
+
+class _PriceStoreState(CompoundScalar):
+    store: object = None  # The PriceStore, opened when the node first evaluates
+    cursors: dict = None  # The next row of each requested symbol
+    pending: list = None  # A heap of (day, symbol, row) for the next row of each symbol, stale entries are skipped
+
+
+@compute_node
+def _price_in_dollars_store(symbol: TSS[str], store: str, round_to: int, returns: bool = False,
+                            _state: STATE[_PriceStoreState] = None, _scheduler: SCHEDULER = None,
+                            _api: EvaluationEngineApi = None) -> TSD[str, TS[float]]:
+    if _state.store is None:
+        _state.store = price_store(store)
+    store = _state.store
+    if returns:
+        def value(row):
+            return round(round(store.price(row), round_to) - round(store.previous_price(row), round_to), round_to)
+    else:
+        def value(row):
+            return round(store.price(row), round_to)
+
+    if _state.cursors is None:
+        _state.cursors = {}
+        _state.pending = []
+    cursors = _state.cursors
+    pending = _state.pending
+
+    now = _api.evaluation_clock.evaluation_time
+    today = now.date().toordinal() - _EPOCH
+    out = {}
+
+    if symbol.modified:
+        for s in symbol.removed():
+            cursors.pop(s, None)
+            out[s] = REMOVE_IF_EXISTS
+        first_day = _api.start_time.date().toordinal() - _EPOCH
+        for s in symbol.added():
+            start, end = store.range(s)
+            row = store.seek(s, now.date())
+            if row > start and store.day(row - 1) >= first_day and (v := value(row - 1)) == v:  # Not nan
+                out[s] = v
+            cursors[s] = row
+            if row < end:
+                heappush(pending, (store.day(row), s, row))
+
+    while pending and pending[0][0] <= today:
+        _, s, row = heappop(pending)
+        if cursors.get(s) != row:
+            continue  # No longer requested (or re-requested since)
+        end = store.range(s)[1]
+        while row < end and store.day(row) <= today:
+            row += 1
+        if (v := value(row - 1)) == v:
+            out[s] = v
+        cursors[s] = row
+        if row < end:
+            heappush(pending, (store.day(row), s, row))
+
+    while pending and cursors.get(pending[0][1]) != pending[0][2]:
+        heappop(pending)
+    if pending and (next_dt := date.fromordinal(pending[0][0] + _EPOCH)) <= _api.end_time.date():
+        _scheduler.schedule(max(datetime(next_dt.year, next_dt.month, next_dt.day), now + timedelta(microseconds=1)))
+    return out if out else None
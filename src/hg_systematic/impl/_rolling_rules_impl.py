@@ -1,15 +1,35 @@
+from datetime import date
 from typing import cast, Mapping
 
-from hgraph import compute_node, cmp_, TS, TSB, CmpResult, service_impl, TSS, TSD, default_path, graph, map_, index_of, \
-    switch_, len_, lift, const, cast_, if_then_else, explode, round_
+import numpy as np
+import polars as pl
+from hgraph import compute_node, cmp_, TS, TSB, CmpResult, service_impl, TSS, TSD, default_path, graph, map_, \
+    switch_, len_, lift, const, cast_, if_then_else, explode, round_, STATE, EvaluationEngineApi, \
+    CompoundScalar
 
+from hg_systematic.impl._calendar_impl import _CompiledCalendarState, _compiled_calendar_for
+from hg_systematic.impl._compiled_calendar import CompiledCalendar, compile_calendar
 from hg_systematic.operators import MonthlyRollingRange, monthly_rolling_weights, business_day, \
-    MonthlyRollingWeightRequest, calendar_for, business_days, Periods
+    MonthlyRollingWeightRequest, calendar_for, business_days, Periods, business_day_index, HolidayCalendar
 from hg_systematic.operators._calendar import next_month
 from hg_systematic.operators._rolling_rules import monthly_rolling_info, MonthlyRollingRequest, MonthlyRollingInfo, \
-    rolling_schedules
+    rolling_schedules, MonthlyRollingOrdinals, monthly_rolling_ordinals
 
-__all__ = ["monthly_rolling_weights_impl", "monthly_rolling_info_service_impl", "rolling_schedules_service_impl", ]
+__all__ = ["monthly_rolling_weights_impl", "monthly_rolling_weights_fused_impl",
+           "monthly_rolling_weights_ordinals_impl", "monthly_rolling_info_service_impl", "rolling_schedules_service_impl",
+           "monthly_rolling_ordinals_for", "monthly_rolling_ordinals_service_impl", "monthly_rolling_ordinals_impl",
+           "monthly_rolling_info_from_ordinals", "monthly_rolling_info_compact_service_impl", "monthly_rolling_info_table",
+           "monthly_rolling_info_table_service_impl", ]
+
+
+def _roll_state(day_index: int, first_day: int, start: int, end: int) -> CmpResult:
+    if day_index == end:
+        return CmpResult.GT
+    elif (start < 0 and (day_index > first_day or day_index < end)) or \
+            (start >= 0 and (day_index > start and day_index < end)):
+        return CmpResult.EQ
+    else:
+        return CmpResult.LT
 
 
 @compute_node(overloads=cmp_)
@@ -19,18 +39,7 @@ def cmp_monthly_rolling_range(lhs: TS[int], rhs: TSB[MonthlyRollingRange], _outp
     Determines if the day index is in the range of the monthly rolling range.
     We only map to GT when day_index == end. When we are not in the range, we otherwise map to LT.
     """
-    day_index = lhs.value
-    first_day = rhs.first_day.value
-    start = rhs.start.value
-    end = rhs.end.value
-
-    if day_index == end:
-        out = CmpResult.GT
-    elif (start < 0 and (day_index > first_day or day_index < end)) or \
-            (start >= 0 and (day_index > start and day_index < end)):
-        out = CmpResult.EQ
-    else:
-        out = CmpResult.LT
+    out = _roll_state(lhs.value, rhs.first_day.value, rhs.start.value, rhs.end.value)
     if _output.valid and _output.value == out:
         return
 
@@ -65,36 +74,65 @@ def _monthly_rolling_weight(
         calendar_for_path: str,
 ) -> TS[float]:
     rolling_info = monthly_rolling_info(request)
+    return _rolling_weight(rolling_info.start, rolling_info.end, rolling_info.first_day, rolling_info.day_index,
+                           rolling_info.roll_state, request.round_to)
 
-    start_negative = rolling_info.start < 0
+
+@graph
+def _rolling_weight(start: TS[int], end: TS[int], first_day: TS[int], day_index: TS[int], roll_state: TS[CmpResult],
+                    round_to: TS[int]) -> TS[float]:
+    start_negative = start < 0
     roll_fraction = 1.0 / switch_(
         start_negative,
         {
             True: lambda s, e: cast(float, abs(s) + e),
             False: lambda s, e: cast(float, e - s)
         },
-        rolling_info.start,
-        rolling_info.end
+        start,
+        end
     )
     range_ = TSB[MonthlyRollingRange].from_ts(
-        first_day=rolling_info.first_day,
-        start=rolling_info.start,
-        end=rolling_info.end
+        first_day=first_day,
+        start=start,
+        end=end
     )
-    is_rolling = rolling_info.roll_state
     weight = switch_(
-        is_rolling,
+        roll_state,
         {
             CmpResult.LT: lambda d, r, f: const(1.0),
             CmpResult.EQ: lambda d, r, f: _weight(d, r, f),
             CmpResult.GT: lambda d, r, f: const(0.0),
         },
-        rolling_info.day_index,
+        day_index,
         range_,
         roll_fraction,
     )
 
-    return round_(weight, request.round_to)
+    return round_(weight, round_to)
+
+
+@service_impl(interfaces=monthly_rolling_weights)
+def monthly_rolling_weights_ordinals_impl(
+        request: TSS[MonthlyRollingWeightRequest],
+        ordinals_path: str = ""
+) -> TSD[MonthlyRollingWeightRequest, TS[float]]:
+    """
+    Provides rolling weights as ``monthly_rolling_weights_impl``, from the compact form of the rolling info
+    (``monthly_rolling_ordinals``, on ``ordinals_path``) rather than ``monthly_rolling_info``. The weights only depend
+    on the range, day index and roll state, so the days of the month are not required.
+    """
+    return map_(
+        lambda key: _monthly_rolling_weight_from_ordinals(key, ordinals_path),
+        __keys__=request,
+    )
+
+
+@graph
+def _monthly_rolling_weight_from_ordinals(request: TS[MonthlyRollingWeightRequest], ordinals_path: str) \
+        -> TS[float]:
+    ordinals = monthly_rolling_ordinals(request, path=ordinals_path if ordinals_path else default_path)
+    return _rolling_weight(ordinals.start, ordinals.end, ordinals.first_day, ordinals.day_index, ordinals.roll_state,
+                           request.round_to)
 
 
 @graph
@@ -113,6 +151,64 @@ def _weight(day_index: TS[int], range_: TSB[MonthlyRollingRange], roll_fraction:
     return w
 
 
+@service_impl(interfaces=monthly_rolling_weights)
+def monthly_rolling_weights_fused_impl(
+        request: TSS[MonthlyRollingWeightRequest],
+        business_day_path: str = "",
+        calendar_for_path: str = ""
+) -> TSD[MonthlyRollingWeightRequest, TS[float]]:
+    """
+    An implementation of rolling weights over a monthly rolling range that computes the weight of each request in a
+    single node (``_monthly_rolling_weight_fused``), producing the same weights as ``monthly_rolling_weights_impl``
+    without wiring ``monthly_rolling_info`` and the ``switch_``es of ``_monthly_rolling_weight``.
+    """
+    return map_(
+        lambda key: _monthly_rolling_weight_fused(
+            key,
+            calendar_for(key.calendar_name, path=calendar_for_path if calendar_for_path else default_path),
+            business_day(key.calendar_name, path=business_day_path if business_day_path else default_path),
+        ),
+        __keys__=request,
+    )
+
+
+class _RollingWeightState(_CompiledCalendarState):
+    roll_state: object = None  # The CmpResult of the last evaluation
+
+
+@compute_node(active=("calendar", "dt"))
+def _monthly_rolling_weight_fused(request: TS[MonthlyRollingWeightRequest], calendar: HolidayCalendar, dt: TS[date],
+                                  _state: STATE[_RollingWeightState] = None,
+                                  _output: TS[float] = None) -> TS[float]:
+    """
+    The weight moves through the states LT (before the roll, 1.0), EQ (rolling, linear from 1.0 to 0.0) and GT (after
+    the roll, 0.0), the weight is only computed whilst rolling.
+    """
+    request = request.value
+    dt = dt.value
+    start = request.start
+    end = request.end
+    compiled = _compiled_calendar_for(calendar, dt, _state)
+    month_start, month_end = compiled.period_bounds(Periods.Month, dt)
+    day_index = compiled.day_index(Periods.Month, dt)
+    first_day = month_end - month_start + start if start < 0 else start
+
+    roll_state = _roll_state(day_index, first_day, start, end)
+    if roll_state == CmpResult.EQ:
+        # Same operations as _weight, so the results are identical
+        roll_fraction = 1.0 / float(abs(start) + end if start < 0 else end - start)
+        offset = float(day_index - first_day if day_index >= first_day else day_index - start)
+        weight = round(1.0 - offset * roll_fraction, request.round_to)
+    elif roll_state == _state.roll_state:
+        return
+    else:
+        weight = 1.0 if roll_state == CmpResult.LT else 0.0
+    _state.roll_state = roll_state
+
+    if not _output.valid or _output.value != weight:
+        return weight
+
+
 @service_impl(interfaces=monthly_rolling_info)
 def monthly_rolling_info_service_impl(
         request: TSS[MonthlyRollingRequest],
@@ -140,7 +236,7 @@ def monthly_rolling_info_impl(
     dt = business_day(calendar_name, path=business_day_path if business_day_path else default_path)
     calendar = calendar_for(calendar_name, path=calendar_for_path if calendar_for_path else default_path)
     days_of_month = business_days(Periods.Month, calendar, dt)
-    day_index = index_of(days_of_month, dt) + 1
+    day_index = business_day_index(Periods.Month, calendar, dt)
     start_negative = start < 0
 
     first_day_index = switch_(
@@ -209,6 +305,268 @@ def monthly_rolling_info_impl(
     )
 
 
+def monthly_rolling_ordinals_for(calendar: CompiledCalendar, dt: date, start: int, end: int) -> dict:
+    """
+    The ``MonthlyRollingOrdinals`` values for dt, computed directly from the compiled calendar. This follows the same
+    rules as ``monthly_rolling_info_impl``.
+    """
+    month_start, month_end = calendar.period_bounds(Periods.Month, dt)
+    ordinals = calendar.ordinals
+    position = calendar.position_of(dt)
+    day_index = position - month_start + 1 if position >= 0 else 0
+    first_day = month_end - month_start + start if start < 0 else start
+    roll_out_month, roll_out_year = dt.month, dt.year
+    if start < 0 and day_index > end:
+        roll_out_month, roll_out_year = (1, roll_out_year + 1) if roll_out_month == 12 else \
+            (roll_out_month + 1, roll_out_year)
+    roll_in_month = roll_out_month % 12 + 1
+    return {
+        "start": start,
+        "end": end,
+        "first_day": first_day,
+        "dt": dt.toordinal(),
+        "month_first": int(ordinals[month_start]),
+        "month_last": int(ordinals[month_end - 1]),
+        "day_index": day_index,
+        "begin_roll": first_day == day_index,
+        "end_roll": day_index == end,
+        "roll_state": _roll_state(day_index, first_day, start, end),
+        "roll_out_month": roll_out_month,
+        "roll_out_year": roll_out_year,
+        "roll_in_month": roll_in_month,
+        "roll_in_year": roll_out_year + 1 if roll_in_month < roll_out_month else roll_out_year,
+    }
+
+
+@service_impl(interfaces=monthly_rolling_ordinals)
+def monthly_rolling_ordinals_service_impl(
+        request: TSS[MonthlyRollingRequest],
+        business_day_path: str = "",
+        calendar_for_path: str = ""
+) -> TSD[MonthlyRollingRequest, TSB[MonthlyRollingOrdinals]]:
+    return map_(
+        lambda key: monthly_rolling_ordinals_impl(key, business_day_path, calendar_for_path),
+        __keys__=request,
+    )
+
+
+@graph
+def monthly_rolling_ordinals_impl(
+        request: TS[MonthlyRollingRequest],
+        business_day_path: str = "",
+        calendar_for_path: str = ""
+) -> TSB[MonthlyRollingOrdinals]:
+    """
+    Computes the compact rolling info for a request in a single node.
+    """
+    calendar_name = request.calendar_name
+    dt = business_day(calendar_name, path=business_day_path if business_day_path else default_path)
+    calendar = calendar_for(calendar_name, path=calendar_for_path if calendar_for_path else default_path)
+    return _monthly_rolling_ordinals(request, calendar, dt)
+
+
+@compute_node(active=("calendar", "dt"))
+def _monthly_rolling_ordinals(request: TS[MonthlyRollingRequest], calendar: HolidayCalendar, dt: TS[date],
+                              _state: STATE[_CompiledCalendarState] = None,
+                              _output: TSB[MonthlyRollingOrdinals] = None) -> TSB[MonthlyRollingOrdinals]:
+    request = request.value
+    dt = dt.value
+    out = monthly_rolling_ordinals_for(_compiled_calendar_for(calendar, dt, _state), dt, request.start, request.end)
+    if _output.valid:
+        # Only tick the values that changed
+        out = {k: v for k, v in out.items() if getattr(_output, k).value != v}
+    return out
+
+
+@graph
+def monthly_rolling_info_from_ordinals(ordinals: TSB[MonthlyRollingOrdinals], calendar: HolidayCalendar) \
+        -> TSB[MonthlyRollingInfo]:
+    """
+    A ``MonthlyRollingInfo`` view over the compact form, for consumers of the existing schema. The days of the month
+    are decoded from the first and last business days of the month, so are only produced when the month changes.
+    """
+    dt = _date_from_ordinal(ordinals.dt)
+    y, m, d = explode(dt)
+    return TSB[MonthlyRollingInfo].from_ts(
+        first_day=ordinals.first_day,
+        start=ordinals.start,
+        end=ordinals.end,
+        days_of_month=_days_of_month(ordinals.month_first, ordinals.month_last, calendar, dt),
+        day_index=ordinals.day_index,
+        dt=dt,
+        day=d,
+        month=m,
+        year=y,
+        begin_roll=ordinals.begin_roll,
+        end_roll=ordinals.end_roll,
+        roll_state=ordinals.roll_state,
+        roll_out_month=ordinals.roll_out_month,
+        roll_out_year=ordinals.roll_out_year,
+        roll_in_month=ordinals.roll_in_month,
+        roll_in_year=ordinals.roll_in_year,
+    )
+
+
+@compute_node
+def _date_from_ordinal(ordinal: TS[int]) -> TS[date]:
+    return date.fromordinal(ordinal.value)
+
+
+@compute_node(active=("month_first", "month_last", "calendar"))
+def _days_of_month(month_first: TS[int], month_last: TS[int], calendar: HolidayCalendar, dt: TS[date],
+                   _state: STATE[_CompiledCalendarState] = None) -> TS[tuple[date, ...]]:
+    compiled = _compiled_calendar_for(calendar, dt.value, _state)
+    ordinals = compiled.ordinals
+    return compiled.dates[np.searchsorted(ordinals, month_first.value):
+                          np.searchsorted(ordinals, month_last.value, side="right")]
+
+
+@service_impl(interfaces=monthly_rolling_info)
+def monthly_rolling_info_compact_service_impl(
+        request: TSS[MonthlyRollingRequest],
+        business_day_path: str = "",
+        calendar_for_path: str = ""
+) -> TSD[MonthlyRollingRequest, TSB[MonthlyRollingInfo]]:
+    """
+    An implementation of ``monthly_rolling_info`` computed in compact form (see ``monthly_rolling_ordinals_impl``)
+    and exposed through the ``MonthlyRollingInfo`` view.
+    """
+    return map_(
+        lambda key: monthly_rolling_info_from_ordinals(
+            monthly_rolling_ordinals_impl(key, business_day_path, calendar_for_path),
+            calendar_for(key.calendar_name, path=calendar_for_path if calendar_for_path else default_path)
+        ),
+        __keys__=request,
+    )
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def monthly_rolling_info_table(calendar: CompiledCalendar, start: int, end: int, first: date, last: date) \
+        -> pl.DataFrame:
+    """
+    Compiles the ``MonthlyRollingInfo`` for each business day of the calendar in [first, last] into a table, following
+    the same rules as ``monthly_rolling_info_impl``. The calendar must cover the range.
+
+    The days of the month are described by the [month_start, month_end) positions in the calendar's business day
+    table (``calendar.dates``), ``roll_state`` holds the ``CmpResult`` value.
+    """
+    all_ordinals = calendar.ordinals
+    ordinals = all_ordinals[(all_ordinals >= first.toordinal()) & (all_ordinals <= last.toordinal())]
+    days = (ordinals - _EPOCH_ORDINAL).astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    month_start = np.searchsorted(all_ordinals, months.astype("datetime64[D]").astype(np.int32) + _EPOCH_ORDINAL)
+    month_end = np.searchsorted(all_ordinals, (months + np.timedelta64(1, "M")).astype("datetime64[D]").astype(
+        np.int32) + _EPOCH_ORDINAL)
+    day_index = np.searchsorted(all_ordinals, ordinals) - month_start + 1
+    first_day = month_end - month_start + start if start < 0 else np.full(len(ordinals), start)
+    month = months.astype(np.int32) % 12 + 1
+    year = months.astype("datetime64[Y]").astype(np.int32) + 1970
+    roll_state = np.where(
+        day_index == end, CmpResult.GT.value,
+        np.where(
+            ((day_index > first_day) | (day_index < end)) if start < 0 else ((day_index > start) & (day_index < end)),
+            CmpResult.EQ.value, CmpResult.LT.value
+        )
+    )
+    roll_out_month, roll_out_year = month, year
+    if start < 0:
+        next_month_ = day_index > end
+        roll_out_year = np.where(next_month_ & (month == 12), year + 1, year)
+        roll_out_month = np.where(next_month_, month % 12 + 1, month)
+    roll_in_month = roll_out_month % 12 + 1
+    return pl.DataFrame({
+        "dt": days,
+        "day": (days - months.astype("datetime64[D]")).astype(np.int32) + 1,
+        "month": month,
+        "year": year,
+        "first_day": first_day,
+        "day_index": day_index,
+        "month_start": month_start,
+        "month_end": month_end,
+        "begin_roll": first_day == day_index,
+        "end_roll": day_index == end,
+        "roll_state": roll_state.astype(np.int8),
+        "roll_out_month": roll_out_month,
+        "roll_out_year": roll_out_year,
+        "roll_in_month": roll_in_month,
+        "roll_in_year": np.where(roll_in_month < roll_out_month, roll_out_year + 1, roll_out_year),
+    }, schema_overrides={c: pl.Int32 for c in ("day", "month", "year", "first_day", "day_index", "month_start",
+                                               "month_end", "roll_out_month", "roll_out_year", "roll_in_month",
+                                               "roll_in_year")})
+
+
+@service_impl(interfaces=monthly_rolling_info)
+def monthly_rolling_info_table_service_impl(
+        request: TSS[MonthlyRollingRequest],
+        business_day_path: str = "",
+        calendar_for_path: str = "",
+) -> TSD[MonthlyRollingRequest, TSB[MonthlyRollingInfo]]:
+    """
+    An implementation of ``monthly_rolling_info`` that compiles the rolling info of a request into a table (see
+    ``monthly_rolling_info_table``) when it is first subscribed to, and then ticks the row of the table for each
+    business day from a single node, instead of wiring the graph of ``monthly_rolling_info_impl`` per request.
+    """
+    return map_(
+        lambda key: _monthly_rolling_info_from_table(
+            key,
+            calendar_for(key.calendar_name, path=calendar_for_path if calendar_for_path else default_path),
+            business_day(key.calendar_name, path=business_day_path if business_day_path else default_path),
+        ),
+        __keys__=request,
+    )
+
+
+class _RollingTableState(_CompiledCalendarState):
+    table: object = None  # The compiled pl.DataFrame
+    dates: object = None  # The ordinals of the dates of the rows of the table (np.ndarray)
+    until: date = None  # The last date the table was compiled to
+    last: object = None  # The last row emitted
+
+
+_TABLE_YEARS = 2  # The number of calendar years compiled into the table at a time
+
+
+@compute_node
+def _monthly_rolling_info_from_table(
+        request: TS[MonthlyRollingRequest],
+        calendar: HolidayCalendar,
+        dt: TS[date],
+        _state: STATE[_RollingTableState] = None,
+        _api: EvaluationEngineApi = None,
+) -> TSB[MonthlyRollingInfo]:
+    today = dt.value
+    req = request.value
+    out = {}
+    if request.modified or calendar.modified or _state.table is None:
+        # Re-compile from today, after which only the values that differ from the last row emitted are ticked
+        _state.table = None
+        _state.last = None
+        out = {"start": req.start, "end": req.end}
+
+    if _state.table is None or today > _state.until:
+        holidays, sow, eow = calendar.holidays.value, calendar.start_of_week.value, calendar.end_of_week.value
+        _state.until = until = max(min(date(today.year + _TABLE_YEARS - 1, 12, 31), _api.end_time.date()), today)
+        compile_calendar(holidays, sow, eow, until)
+        _state.calendar = compile_calendar(holidays, sow, eow, today)
+        _state.table = table = monthly_rolling_info_table(_state.calendar, req.start, req.end, today, until)
+        _state.dates = table["dt"].to_numpy().astype("datetime64[D]").astype(np.int32) + _EPOCH_ORDINAL
+
+    dates = _state.dates
+    ndx = int(np.searchsorted(dates, today.toordinal()))
+    if ndx < len(dates) and dates[ndx] == today.toordinal():
+        row = _state.table.row(ndx, named=True)
+        previous = _state.last or {}
+        month_start, month_end = row["month_start"], row["month_end"]
+        if (previous.get("month_start"), previous.get("month_end")) != (month_start, month_end):
+            out["days_of_month"] = _state.calendar.dates[month_start:month_end]
+        row["roll_state"] = CmpResult(row["roll_state"])
+        out |= {k: v for k, v in row.items() if k not in ("month_start", "month_end") and previous.get(k) != v}
+        _state.last = row
+    return out if out else None
+
+
 @service_impl(interfaces=rolling_schedules)
 def rolling_schedules_service_impl(
         schedules: Mapping[str, Mapping[int, tuple[int, int]]]
@@ -20,6 +20,7 @@ class IndexConfiguration(CompoundScalar):
     rounding: int = 8
     start_date: date = None  # Required to ensure we don't try and compute an index before it has started.
     publish_holiday_calendar: str = None  # Required to know when we can publish a value for an index.
+    re_balance_state_machine: bool = False  # Re-balance with the single node state machine rather than the graph.
 
 
 @dataclass(frozen=True)
@@ -1,9 +1,12 @@
-from typing import Mapping
+import sys
+from datetime import date
+from typing import Mapping, Callable
+
 from frozendict import frozendict as fd
 from hg_oap.instruments.future import month_from_code
 from hgraph import lift, TSD, TS
 
-__all__ = ["roll_schedule_to_map", "roll_schedule_to_tsd"]
+__all__ = ["roll_schedule_to_map", "roll_schedule_to_tsd", "compile_contract_schedule"]
 
 def roll_schedule_to_map(roll_schedule: tuple[str, ...]) -> Mapping[int, tuple[int, int]]:
     """convert a roll schedule tuple to a mapping"""
@@ -12,3 +15,37 @@ def roll_schedule_to_map(roll_schedule: tuple[str, ...]) -> Mapping[int, tuple[i
 
 
 roll_schedule_to_tsd = lift(roll_schedule_to_map, output=TSD[int, TS[tuple[int, int]]])
+
+
+def compile_contract_schedule(
+        roll_schedule: Mapping[int, tuple[int, int]],
+        contract_fn: Callable[..., str],
+        asset: str,
+        start: date,
+        end: date,
+        far_roll_schedule: Mapping[int, tuple[int, int]] = None,
+) -> Mapping[date, tuple[str, str]]:
+    """
+    Compiles the (roll_out, roll_in) contracts for each roll-out month between start and end (inclusive). The table is
+    keyed by the first date of the roll-out month (i.e. ``date(roll_out_year, roll_out_month, 1)``). This is the
+    same as ``futures_rolling_contracts`` (or ``spread_rolling_contracts`` when ``far_roll_schedule`` is supplied)
+    would produce for a ``MonthlyRollingInfo`` with that roll-out month.
+
+    The roll schedules are in the form produced by ``roll_schedule_to_map``. The contract names are interned, so each
+    contract name is held once however many months refer to it.
+    """
+
+    def contract(month: int, year: int) -> str:
+        m, y_offset = roll_schedule[month]
+        if far_roll_schedule is None:
+            return sys.intern(contract_fn(asset, m, year + y_offset))
+        f_m, f_y_offset = far_roll_schedule[month]
+        return sys.intern(contract_fn(asset, m, year + y_offset, f_m, year + f_y_offset))
+
+    table = {}
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        roll_in_year, roll_in_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        table[date(year, month, 1)] = (contract(month, year), contract(roll_in_month, roll_in_year))
+        year, month = roll_in_year, roll_in_month
+    return fd(table)
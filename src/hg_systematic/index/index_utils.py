@@ -1,21 +1,26 @@
+from dataclasses import dataclass
 from datetime import date
+from enum import Enum
 from typing import TypeVar, Callable
 
 from frozendict import frozendict
 from hgraph import graph, TSB, TS, map_, reduce, dedup, or_, and_, len_, DebugContext, combine, switch_, TS_SCHEMA, \
     sample, default, gate, not_, if_then_else, CmpResult, no_key, const, AUTO_RESOLVE, feedback, lag, \
-    contains_, round_
+    contains_, round_, compute_node, STATE, CompoundScalar, EvaluationEngineApi, REMOVE_IF_EXISTS
 from hgraph.reflection import fields
 
 from hg_systematic.index.configuration import BaseIndexConfiguration, initial_structure_from_config, IndexConfiguration
 from hg_systematic.index.pricing_service import IndexResult
-from hg_systematic.index.units import IndexPosition, NotionalUnitValues, IndexStructure, NotionalUnits
+from hg_systematic.index.units import IndexPosition, NotionalUnitValues, IndexStructure, NotionalUnits, \
+    dedup_re_bound_index_structure
+from hg_systematic.index.tsd_utils import valid_value, valid_values, tsd_value, apply_delta
 from hg_systematic.operators import MonthlyRollingInfo, monthly_rolling_info, monthly_rolling_weights, \
     MonthlyRollingWeightRequest, calendar_for
 
 
 __all__ = ["monthly_rolling_index", "ROLLING_CONFIG", "monthly_rolling_index_component", "re_balance_index",
-           "compute_level", "get_monthly_rolling_values", "needs_re_balance", "roll_units"]
+           "compute_level", "get_monthly_rolling_values", "needs_re_balance", "roll_units", "ReBalanceState",
+           "re_balance_state_machine"]
 
 ROLLING_CONFIG = TypeVar("ROLLING_CONFIG", bound=IndexConfiguration)
 
@@ -77,7 +82,7 @@ def monthly_rolling_index(
 
     index_structure_fb = feedback(TSB[IndexStructure])
     DebugContext.print("index_structure_fb", index_structure_fb())
-    index_structure = dedup(default(lag(index_structure_fb(), 1, roll_info.dt), initial_structure_from_config(config)))
+    index_structure = default(lag(index_structure_fb(), 1, roll_info.dt), initial_structure_from_config(config))
     DebugContext.print("index_structure", index_structure)
 
     out = monthly_rolling_index_component(
@@ -92,8 +97,9 @@ def monthly_rolling_index(
         **{k: kwargs[k] for k in kwargs_schema if k not in {"halt_trading", "roll_info", "roll_weight"}}
     )
 
-    # There is a dedup here as there seems to be a bug somewhere when dealing with REFs and TSD, will trace down later.
-    index_structure_fb(dedup(out.index_structure))  # TODO: Find out why not using de-dup causes this to fail.
+    # Both re-balance engines only publish the changes to the structure (the graph form through
+    # dedup_re_bound_index_structure), so the structure is fed back as is
+    index_structure_fb(out.index_structure)
 
     result = out.copy_with(level=round_(out.level, config.rounding))
     DebugContext.print("published level", result.level)
@@ -167,23 +173,64 @@ def compute_level(
     """
     DebugContext.print("[compute_level] current_positions", current_position)
     DebugContext.print("[compute_level] current_value", current_value)
-    returns = map_(
-        lambda pos_curr, prc_prev, prc_now: (prc_now - prc_prev) * pos_curr,
-        current_position.units,
-        current_position.unit_values,
-        current_value,
-        __keys__=current_position.units.key_set,
-    )
-    DebugContext.print("[compute_level] returns", returns)
-    new_level = current_position.level + reduce(
-        lambda x, y: x + y,
-        returns,
-        0.0
-    )
+    new_level = _compute_level(current_position, current_value)
     DebugContext.print("[compute_level] level", new_level)
     return new_level
 
 
+class _LevelState(CompoundScalar):
+    returns: dict = None  # The return ((prc_now - prc_prev) * pos_curr) of each unit
+    total: float = 0.0  # The running sum of the returns
+    published: date = None  # The date the level was last published
+
+
+@compute_node
+def _compute_level(current_position: TSB[IndexPosition], current_value: NotionalUnitValues,
+                   _state: STATE[_LevelState] = None, _api: EvaluationEngineApi = None,
+                   _output: TS[float] = None) -> TS[float]:
+    """
+    The level is the level of the position plus the sum of the returns of the units. The returns are held per unit
+    and only those of the units whose position, position value or current value are modified are re-computed, the
+    sum is maintained as a running sum of the changes.
+    """
+    if _state.returns is None:
+        _state.returns = {}
+    returns = _state.returns
+    units = current_position.units
+    unit_values = current_position.unit_values
+
+    if units.modified:
+        # Any units no longer held (the position may be re-bound, so use the keys rather than the removals)
+        for k in (removed := returns.keys() - set(units.keys())):
+            _state.total -= returns.pop(k)
+    else:
+        removed = ()
+    changed = set()
+    for ts in (units, unit_values, current_value):
+        if ts.modified:
+            changed.update(k for k, v in ts.modified_items() if v.valid)
+
+    for k in changed:
+        if (u := valid_value(units, k)) is None or (uv := valid_value(unit_values, k)) is None or \
+                (cv := valid_value(current_value, k)) is None:
+            continue  # Only units with a valid position, position value and current value contribute
+        r = (cv - uv) * u
+        _state.total += r - returns.get(k, 0.0)
+        returns[k] = r
+
+    if not returns and len(units.keys()):
+        return  # Wait for the returns of the units held
+    if not changed and not removed and not current_position.level.modified:
+        return  # Nothing contributing to the level has ticked
+    level = current_position.level.value + _state.total
+    today = _api.evaluation_clock.evaluation_time.date()
+    if not current_position.level.modified and _output.valid and _output.value == level and \
+            _state.published == today:
+        return  # Already published for the day
+    _state.published = today
+    return level
+
+
 @graph
 def needs_re_balance(
         index_structure: TSB[IndexStructure],
@@ -276,10 +323,10 @@ def re_balance_index(
     ))
 
     new_index_structure = switch_(
-        needs_re_balance(index_structure, roll_info, re_balance_signal),
+        config.re_balance_state_machine,
         {
-            True: lambda tsb: _re_balance(tsb, compute_target_units_fn),
-            False: _pass_through,
+            False: lambda tsb: _re_balance_index_graph(tsb, compute_target_units_fn),
+            True: lambda tsb: _re_balance_index_state_machine(tsb, compute_target_units_fn),
         },
         combine[TSB](
             config=config,
@@ -298,15 +345,255 @@ def re_balance_index(
 
 
 @graph
-def _pass_through(tsb: TSB[TS_SCHEMA]) -> TSB[IndexStructure]:
-    return dedup(tsb.index_structure)  # Required as there seems to be an issue with a simple ref pass through
+def _re_balance_index_graph(
+        tsb: TSB[TS_SCHEMA],
+        extract_target_units_fn: Callable[[TSB[TS_SCHEMA]], NotionalUnitValues]
+) -> TSB[IndexStructure]:
+    re_balanced = switch_(
+        needs_re_balance(tsb.index_structure, tsb.roll_info, tsb.re_balance_signal),
+        {
+            True: lambda tsb: _re_balance(tsb, extract_target_units_fn),
+            False: _pass_through,
+        },
+        tsb
+    )
+    # The switch (and the re-balance) re-bind the units of the structure, these are only compared in full when re-bound
+    return dedup_re_bound_index_structure(
+        combine[TSB[IndexStructure]](
+            current_position=re_balanced.current_position,
+            previous_units=re_balanced.previous_units,
+            target_units=re_balanced.target_units,
+        ),
+        re_balanced.re_bound
+    )
 
 
 @graph
-def _re_balance(
+def _re_balance_index_state_machine(
         tsb: TSB[TS_SCHEMA],
         extract_target_units_fn: Callable[[TSB[TS_SCHEMA]], NotionalUnitValues]
 ) -> TSB[IndexStructure]:
+    """
+    Re-balances the index with a single node (see ``re_balance_state_machine``), the target units are sampled by the
+    node when a re-balance begins. As with the graph form, the target units are only computed (the function is only
+    wired) whilst a re-balance is needed.
+    """
+    roll_info = tsb.roll_info
+    target_units = switch_(
+        needs_re_balance(tsb.index_structure, roll_info, tsb.re_balance_signal),
+        {
+            True: lambda tsb: extract_target_units_fn(tsb),
+            False: lambda tsb: const(frozendict(), NotionalUnits),
+        },
+        tsb
+    )
+    return re_balance_state_machine(
+        index_structure=tsb.index_structure,
+        begin_roll=roll_info.as_schema.begin_roll,
+        end_roll=roll_info.as_schema.end_roll,
+        roll_state=roll_info.roll_state,
+        dt=roll_info.dt,
+        roll_weight=tsb.roll_weight,
+        prices=tsb.prices,
+        level=tsb.level,
+        trade_halt=tsb.trade_halt,
+        re_balance_signal=tsb.re_balance_signal,
+        target_units=target_units,
+    )
+
+
+class ReBalanceState(Enum):
+    IDLE = 0  # Not re-balancing, the structure is passed through
+    ROLLING = 1  # Rolling from the previous to the target units
+    HALTED = 2  # The roll has ended while trading is halted, the roll completes on the next day trading is not halted
+    COMPLETE = 3  # The roll has completed, the previous and target units are released
+
+
+class _ReBalanceMachineState(CompoundScalar):
+    state: ReBalanceState = ReBalanceState.IDLE
+    dt: date = None  # The date last evaluated
+    structure: dict = None  # The (flattened) input structure, maintained from its deltas
+    published: dict = None  # The (flattened) structure last published
+    in_sync: bool = False  # The structure last published is the input structure
+
+
+def _structure_units(index_structure: TSB[IndexStructure]) -> dict:
+    """The units of the structure by their (flattened) name"""
+    position = index_structure.current_position
+    return {
+        "units": position.units,
+        "unit_values": position.unit_values,
+        "previous_units": index_structure.previous_units,
+        "target_units": index_structure.target_units,
+    }
+
+
+@compute_node(valid=("index_structure", "dt"))
+def re_balance_state_machine(
+        index_structure: TSB[IndexStructure],
+        begin_roll: TS[bool],
+        end_roll: TS[bool],
+        roll_state: TS[CmpResult],
+        dt: TS[date],
+        roll_weight: TS[float],
+        prices: NotionalUnitValues,
+        level: TS[float],
+        trade_halt: TS[bool],
+        re_balance_signal: TS[bool],
+        target_units: NotionalUnits,
+        _state: STATE[_ReBalanceMachineState] = None,
+        _output: TSB[IndexStructure] = None,
+) -> TSB[IndexStructure]:
+    """
+    The re-balance of ``re_balance_index`` as a single node operating on plain dicts, this is used when the
+    configuration sets ``re_balance_state_machine``.
+
+    The state is:
+
+    IDLE
+        The structure has no target units, the structure is passed through. A re-balance begins on a begin_roll when
+        the re_balance_signal is True, the current units become the previous units and the target units are sampled.
+
+    ROLLING
+        The units are rolled from the previous to the target units by the roll_state (and the roll_weight whilst in
+        the roll period), a new current position is set when the rolled units differ from the current units.
+
+    HALTED
+        The end of the roll was reached whilst trading is halted, the units are held until trading resumes.
+
+    COMPLETE
+        The end of the roll is reached (and trading is not halted), the previous and target units are released.
+
+    As with the graph, the rolling state is derived from the target units of the structure, so a recovered structure
+    continues its roll.
+
+    Only the delta of the structure is read (into a copy held in the state), whilst idle the delta is passed through,
+    so a tick that does not change the structure (such as a price tick) does not visit the units.
+    """
+    units = _structure_units(index_structure)
+    if (structure := _state.structure) is None:
+        structure = _state.structure = {k: valid_values(ts) for k, ts in units.items()}
+        deltas = {}
+    else:
+        deltas = {k: d for k, ts in units.items() if ts.modified and (d := apply_delta(ts, structure[k]))}
+    if (level_ := index_structure.current_position.level).valid:
+        structure["level"] = level_.value
+    current_units = structure["units"]
+    previous = structure["previous_units"]
+    target = structure["target_units"]
+    halted = trade_halt.valid and trade_halt.value
+
+    new_day = dt.value != _state.dt
+    _state.dt = dt.value
+
+    if begin_roll.valid and begin_roll.value and (target or (re_balance_signal.valid and re_balance_signal.value)):
+        # Begin the re-balance (re-based each time the begin_roll is seen)
+        previous = current_units
+        target = dict(target_units.value) if target_units.valid else {}
+        if new_day:
+            _state.state = ReBalanceState.ROLLING
+
+    if not target:
+        _state.state = ReBalanceState.IDLE
+        new_structure = structure
+    else:
+        if _state.state is ReBalanceState.IDLE:
+            _state.state = ReBalanceState.ROLLING  # Continuing the roll of a recovered structure
+        if new_day and _state.state is ReBalanceState.ROLLING and end_roll.valid and end_roll.value:
+            _state.state = ReBalanceState.HALTED if halted else ReBalanceState.COMPLETE
+        elif new_day and _state.state is ReBalanceState.HALTED and not halted:
+            _state.state = ReBalanceState.COMPLETE
+        ended = _state.state is ReBalanceState.COMPLETE
+
+        state = roll_state.value if roll_state.valid else None
+        if state is CmpResult.LT:
+            rolled = target if ended else current_units
+        elif state is CmpResult.EQ and not halted:
+            w = roll_weight.value
+            rolled = {k: previous.get(k, 0.0) * w + target.get(k, 0.0) * (1.0 - w)
+                      for k in previous.keys() | target.keys()}
+        elif state is CmpResult.GT and not halted:
+            rolled = target
+        else:
+            rolled = current_units
+
+        new_structure = {
+            "units": current_units,
+            "unit_values": structure["unit_values"],
+            "level": structure.get("level"),
+            "previous_units": {} if ended else previous,
+            "target_units": {} if ended else target,
+        }
+        if rolled != current_units:
+            new_structure |= {
+                "units": rolled,
+                "level": level.value if level.valid else None,
+                "unit_values": {k: v for k in rolled if (v := valid_value(prices, k)) is not None},
+            }
+
+    if (published := _state.published) is None:
+        _state.published = {k: dict(v) if k in units else v for k, v in new_structure.items()}
+        _state.in_sync = new_structure is structure
+        return {  # Returned rather than set, so empty units are valid
+            "current_position": {"units": new_structure["units"], "unit_values": new_structure["unit_values"]} |
+                                ({} if (level_ := new_structure.get("level")) is None else {"level": level_}),
+            "previous_units": new_structure["previous_units"],
+            "target_units": new_structure["target_units"],
+        }
+    if passed_through := new_structure is structure and _state.in_sync:
+        # Passing the structure through, only its delta is published
+        changes = deltas
+        for k, delta in deltas.items():
+            values = published[k]
+            for key, v in delta.items():
+                if v is REMOVE_IF_EXISTS:
+                    values.pop(key, None)
+                else:
+                    values[key] = v
+    else:
+        # Re-balancing, the changed units are published in full (including the stale keys to remove)
+        changes = {k: tsd_value(published[k], v) for k in units if (v := new_structure[k]) != published[k]}
+        for k in changes:
+            published[k] = dict(new_structure[k])
+    # The level is published with a new position, or when it is changed
+    level_ = new_structure.get("level")
+    publish_level = level_ is not None and (level_ != published.get("level") or changes and not passed_through)
+    _state.in_sync = new_structure is structure
+    for k, value in changes.items():
+        (_output[k] if k.endswith("_units") else _output.current_position[k]).value = value
+    if publish_level:
+        _output.current_position.level.value = published["level"] = level_
+
+
+@dataclass
+class _ReBalancedIndexStructure(IndexStructure):
+    """The structure produced by a branch of the re-balance, re_bound ticks when its units may have been re-bound"""
+    re_bound: TS[bool]
+
+
+@graph
+def _pass_through(tsb: TSB[TS_SCHEMA]) -> TSB[_ReBalancedIndexStructure]:
+    # The structure is re-bound to the (unchanged) structure when the branch is entered
+    return combine[TSB[_ReBalancedIndexStructure]](
+        current_position=(index_structure := tsb.index_structure).current_position,
+        previous_units=index_structure.previous_units,
+        target_units=index_structure.target_units,
+        re_bound=const(True)
+    )
+
+
+@compute_node(valid=tuple())
+def _re_bound(entered: TS[bool], rebase_index: TS[bool], end_roll: TS[bool], traded: TS[bool],
+              roll_state: TS[CmpResult], trade_halt: TS[bool]) -> TS[bool]:
+    """Ticks when the branch is entered or any of the selectors that re-bind the units of the re-balance change"""
+    return True
+
+
+@graph
+def _re_balance(
+        tsb: TSB[TS_SCHEMA],
+        extract_target_units_fn: Callable[[TSB[TS_SCHEMA]], NotionalUnitValues]
+) -> TSB[_ReBalancedIndexStructure]:
     # Ensure we have a valid value when we enter (This should only enter initially when we re-balance)
     end_roll = dedup(
         sample(
@@ -380,10 +667,12 @@ def _re_balance(
     # Detect the end-roll and adjust as appropriate
     empty_units = const(frozendict(), NotionalUnits)
 
-    return combine[TSB[IndexStructure]](
+    return combine[TSB[_ReBalancedIndexStructure]](
         current_position=rolled_position,
         previous_units=if_then_else(end_roll, empty_units, previous_units),
         target_units=if_then_else(end_roll, empty_units, target_units),
+        re_bound=_re_bound(const(True), dedup(rebase_index), end_roll, dedup(traded), dedup(roll_info.roll_state),
+                           dedup(trade_halt)),
     )
 
 
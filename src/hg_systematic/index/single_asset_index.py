@@ -1,23 +1,28 @@
 from contextlib import nullcontext
 from dataclasses import dataclass
-from typing import Callable
+from datetime import date
+from typing import Callable, Mapping
 
 from hgraph import graph, TS, combine, map_, TSB, TSS, feedback, \
-    union, TSD, dedup, sample, last_modified_date, convert, dispatch, TSL, Size, nothing
-from hgraph import if_true, DebugContext
+    union, TSD, dedup, convert, dispatch, TSL, Size, nothing, compute_node, STATE, \
+    CompoundScalar
+from hgraph import DebugContext
 
 from hg_systematic.index.configuration import SingleAssetIndexConfiguration
-from hg_systematic.index.conversion import roll_schedule_to_tsd
+from hg_systematic.index.conversion import roll_schedule_to_tsd, roll_schedule_to_map, compile_contract_schedule
 from hg_systematic.index.index_utils import get_monthly_rolling_values, monthly_rolling_index
 from hg_systematic.index.pricing_service import price_index_op, IndexResult
-from hg_systematic.operators import futures_rolling_contracts, price_in_dollars, MonthlyRollingInfo
+from hg_systematic.index.units import held_units
+from hg_systematic.operators import futures_rolling_contracts, price_in_dollars, MonthlyRollingInfo, \
+    subscription_metrics, as_of_prices
 from hg_systematic.operators._rolling_rules import spread_rolling_contracts
 
 
 __all__ = [
     "price_monthly_single_asset_index", "MonthlySingleAssetIndexConfiguration",
     "MonthlySpreadSingleAssetIndexConfiguration", "rolling_contract", "rolling_spread_contract" ,
-    "set_single_index_debug_on",
+    "set_single_index_debug_on", "rolling_contract_from_table", "rolling_spread_contract_from_table",
+    "MonthlySingleAssetTableIndexConfiguration", "MonthlySpreadSingleAssetTableIndexConfiguration",
 ]
 
 
@@ -74,6 +79,22 @@ class MonthlySpreadSingleAssetIndexConfiguration(MonthlySingleAssetIndexConfigur
     contract_fn: Callable[[str, int, int, int, int], str] = None
 
 
+@dataclass(frozen=True)
+class MonthlySingleAssetTableIndexConfiguration(MonthlySingleAssetIndexConfiguration):
+    """
+    A monthly single asset index whose contracts are replayed from a precompiled contract table (see
+    ``rolling_contract_from_table``) rather than computed from the roll schedule in the graph.
+    """
+
+
+@dataclass(frozen=True)
+class MonthlySpreadSingleAssetTableIndexConfiguration(MonthlySpreadSingleAssetIndexConfiguration):
+    """
+    A monthly spread index whose contracts are replayed from a precompiled contract table (see
+    ``rolling_spread_contract_from_table``) rather than computed from the roll schedules in the graph.
+    """
+
+
 @dispatch(on=("config",))
 def rolling_contract(config: TS[MonthlySingleAssetIndexConfiguration], asset: TS[str],
                      roll_info: TSB[MonthlyRollingInfo]) -> TSL[TS[str], Size[2]]:
@@ -102,6 +123,53 @@ def rolling_spread_contract(config: TS[MonthlySpreadSingleAssetIndexConfiguratio
     )
 
 
+@graph(overloads=rolling_contract)
+def rolling_contract_from_table(config: TS[MonthlySingleAssetTableIndexConfiguration], asset: TS[str],
+                                roll_info: TSB[MonthlyRollingInfo]) -> TSL[TS[str], Size[2]]:
+    """
+    Produces the same contracts as ``rolling_contract`` by replaying a contract table compiled from the configuration
+    (see ``compile_contract_schedule``) in a single node, rather than indexing the roll schedule and applying the
+    ``contract_fn`` in the graph.
+    """
+    return _replay_contract_table(config, asset, roll_info.roll_out_month, roll_info.roll_out_year, spread=False)
+
+
+@graph(overloads=rolling_contract)
+def rolling_spread_contract_from_table(config: TS[MonthlySpreadSingleAssetTableIndexConfiguration], asset: TS[str],
+                                       roll_info: TSB[MonthlyRollingInfo]) -> TSL[TS[str], Size[2]]:
+    """The spread form of ``rolling_contract_from_table``, the far leg is compiled from the far leg roll schedule"""
+    return _replay_contract_table(config, asset, roll_info.roll_out_month, roll_info.roll_out_year, spread=True)
+
+
+class _ContractTableState(CompoundScalar):
+    table: Mapping[date, tuple[str, str]] = None
+
+
+_CONTRACT_TABLE_YEARS = 5  # The number of years of roll-out months compiled at a time
+
+
+@compute_node
+def _replay_contract_table(config: TS[MonthlySingleAssetIndexConfiguration], asset: TS[str], roll_out_month: TS[int],
+                           roll_out_year: TS[int], spread: bool, _state: STATE[_ContractTableState] = None,
+                           _output: TSL[TS[str], Size[2]] = None) -> TSL[TS[str], Size[2]]:
+    if config.modified or asset.modified:
+        _state.table = None
+    month = date(roll_out_year.value, roll_out_month.value, 1)
+    if _state.table is None or (contracts := _state.table.get(month)) is None:
+        config_ = config.value
+        _state.table = compile_contract_schedule(
+            roll_schedule_to_map(config_.roll_schedule),
+            config_.contract_fn,
+            asset.value,
+            month,
+            date(month.year + _CONTRACT_TABLE_YEARS - 1, 12, 1),
+            roll_schedule_to_map(config_.far_leg_roll_schedule) if spread else None,
+        )
+        contracts = _state.table[month]
+    out = {i: c for i, c in enumerate(contracts) if not _output[i].valid or _output[i].value != c}
+    return out if out else None
+
+
 @graph(overloads=price_index_op)
 def price_monthly_single_asset_index(config: TS[MonthlySingleAssetIndexConfiguration]) -> TSB[IndexResult]:
     """
@@ -122,12 +190,15 @@ def price_monthly_single_asset_index(config: TS[MonthlySingleAssetIndexConfigura
         dt = roll_info.dt
 
         required_prices_fb = feedback(TSS[str], frozenset())
-        # Join current positions + roll_in / roll_out contract, perhaps this could be reduced to just roll_in?
+        # Join the held contracts + roll_in / roll_out contract, perhaps this could be reduced to just roll_in?
+        # Contracts that are no longer held (and are no longer rolled in or out of) drop out of the union, this
+        # releases their price subscriptions.
         all_contracts = union(combine[TSS[str]](*contracts), required_prices_fb())
         DebugContext.print("all_contracts", all_contracts)
+        DebugContext.print("price subscriptions", subscription_metrics(all_contracts))
 
-        prices = map_(lambda key, dt_: sample(if_true(dt_ >= last_modified_date(p := price_in_dollars(key))), p),
-                      __keys__=all_contracts, dt_=dt)
+        # The latest price of each contract at or before dt (prices can tick ahead of dt)
+        prices = as_of_prices(map_(lambda key: price_in_dollars(key), __keys__=all_contracts), dt).prices
         DebugContext.print("prices", prices)
 
         out = monthly_rolling_index(
@@ -140,7 +211,7 @@ def price_monthly_single_asset_index(config: TS[MonthlySingleAssetIndexConfigura
             contracts=contracts,
         )
 
-        # We require prices for the items in the current position at least
-        required_prices_fb(out.index_structure.current_position.units.key_set)
+        # We require prices for the items held in the index structure (current, previous and target units)
+        required_prices_fb(held_units(out.index_structure))
 
         return out
@@ -0,0 +1,40 @@
+"""
+Helpers for reading and publishing the TSD values of the index structures from within compute nodes.
+"""
+from typing import Mapping
+
+from hgraph import REMOVE_IF_EXISTS
+
+__all__ = ["valid_values", "valid_value", "tsd_value", "apply_delta"]
+
+
+def valid_values(tsd) -> dict:
+    """The values of the valid elements of the TSD (empty if the TSD is not valid), this visits every element"""
+    return {k: v.value for k, v in zip(tsd.keys(), tsd.values()) if v.valid} if tsd.valid else {}
+
+
+def valid_value(tsd, key, default=None):
+    """The value of the element ``key`` of the TSD, or the ``default`` if it is not present or not valid"""
+    if tsd.valid and key in tsd and (ts := tsd[key]).valid:
+        return ts.value
+    return default
+
+
+def tsd_value(previous: Mapping[str, float], current: Mapping[str, float]) -> dict:
+    """The current value with the keys no longer present removed"""
+    return dict(current) | {k: REMOVE_IF_EXISTS for k in previous.keys() - current.keys()}
+
+
+def apply_delta(tsd, values: dict) -> dict:
+    """
+    Applies the delta of the TSD (its removed and modified elements) to ``values``, this visits only the delta. Returns
+    the elements that changed, with the removed elements as ``REMOVE_IF_EXISTS``.
+    """
+    delta = {}
+    for key in tsd.removed_keys():
+        if values.pop(key, None) is not None:
+            delta[key] = REMOVE_IF_EXISTS
+    for key, v in tsd.modified_items():
+        if v.valid and values.get(key) != (value := v.value):
+            values[key] = delta[key] = value
+    return delta
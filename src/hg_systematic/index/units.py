@@ -3,9 +3,13 @@ Representing the units held (or desired to be held) by an index.
 """
 from dataclasses import dataclass
 
-from hgraph import TSD, TS, TimeSeriesSchema, graph, subscription_service, TSS, service_impl, mesh_, TSB
+from hgraph import TSD, TS, TimeSeriesSchema, graph, subscription_service, TSS, service_impl, mesh_, TSB, \
+    compute_node, set_delta, STATE, CompoundScalar
 
-__all__ = ["NotionalUnits", "NotionalUnitValues", "IndexPosition", "IndexStructure",]
+from hg_systematic.index.tsd_utils import valid_values, tsd_value, apply_delta
+
+__all__ = ["NotionalUnits", "NotionalUnitValues", "IndexPosition", "IndexStructure", "held_units",
+           "dedup_index_structure", "dedup_re_bound_index_structure"]
 
 # A dictionary of fractional units representing the current or desired holding of the unit
 NotionalUnits = TSD[str, TS[float]]
@@ -46,3 +50,102 @@ class IndexStructure(TimeSeriesSchema):
     previous_units: NotionalUnits
 
 
+@compute_node(valid=tuple())
+def held_units(index_structure: TSB[IndexStructure], _output: TSS[str] = None) -> TSS[str]:
+    """
+    The units that appear in any of the current_position, previous_units or target_units of the index structure.
+    A unit is removed once it is no longer present in any of these, this is computed from the values of the
+    structure, so it does not depend on the key deltas surviving the re-binding of the structure.
+    """
+    held = set()
+    for units in (index_structure.current_position.units, index_structure.previous_units,
+                  index_structure.target_units):
+        if units.valid:
+            held.update(units.value.keys())
+    current = set(_output.value) if _output.valid else set()
+    if held != current or not _output.valid:
+        return set_delta(added=held - current, removed=current - held, tp=str)
+
+
+class _DedupIndexStructureState(CompoundScalar):
+    units: dict = None  # The units (previous_units, target_units, units and unit_values) last published
+    level: float = None  # The level last published
+
+
+def _index_structure_units(index_structure: TSB[IndexStructure], _output: TSB[IndexStructure]) -> dict:
+    """The units of the structure, with the accessor of the output of each"""
+    position = index_structure.current_position
+    return {
+        "previous_units": (index_structure.previous_units, lambda: _output.previous_units),
+        "target_units": (index_structure.target_units, lambda: _output.target_units),
+        "units": (position.units, lambda: _output.current_position.units),
+        "unit_values": (position.unit_values, lambda: _output.current_position.unit_values),
+    }
+
+
+def _initial_index_structure(units: dict, level: float, _state: _DedupIndexStructureState) -> dict:
+    """Records and returns the initial structure, this is returned rather than set, so the empty units are valid"""
+    _state.units = {k: valid_values(ts) for k, (ts, _) in units.items()}
+    _state.level = level
+    return {
+        "current_position": {"units": _state.units["units"], "unit_values": _state.units["unit_values"]} |
+                            ({} if level is None else {"level": level}),
+        "previous_units": _state.units["previous_units"],
+        "target_units": _state.units["target_units"],
+    }
+
+
+def _publish_level(index_structure: TSB[IndexStructure], _state: _DedupIndexStructureState,
+                   _output: TSB[IndexStructure], re_bound: bool = False):
+    if ((level := index_structure.current_position.level).modified or re_bound and level.valid) and \
+            level.value != _state.level:
+        _output.current_position.level.value = _state.level = level.value
+
+
+@compute_node
+def dedup_index_structure(index_structure: TSB[IndexStructure], _state: STATE[_DedupIndexStructureState] = None,
+                          _output: TSB[IndexStructure] = None) -> TSB[IndexStructure]:
+    """
+    Publishes the changes to the index structure. Only the elements of the units that are modified are compared with
+    those last published, so detecting a change is proportional to the change rather than to the size of the units.
+
+    This relies on the deltas of the units describing the change, a structure whose units are re-bound (by a switch
+    or an ``if_then_else``) must be published through ``dedup_re_bound_index_structure``.
+    """
+    units = _index_structure_units(index_structure, _output)
+    if (published := _state.units) is None:
+        level = index_structure.current_position.level
+        return _initial_index_structure(units, level.value if level.valid else None, _state)
+
+    for k, (ts, out) in units.items():
+        if ts.modified and (delta := apply_delta(ts, published[k])):
+            out().value = delta
+    _publish_level(index_structure, _state, _output)
+
+
+@compute_node(valid=("index_structure",))
+def dedup_re_bound_index_structure(index_structure: TSB[IndexStructure], re_bound: TS[bool],
+                                   _state: STATE[_DedupIndexStructureState] = None,
+                                   _output: TSB[IndexStructure] = None) -> TSB[IndexStructure]:
+    """
+    Publishes the changes to an index structure whose units may be re-bound (by a switch or an ``if_then_else``) to
+    other units. A re-bound TSD only carries the delta of its new binding, which does not describe the change, so the
+    producer ticks ``re_bound`` when it may have re-bound the units. Only then are the units compared in full with
+    those last published (and published with the keys no longer present removed), otherwise only the deltas are
+    compared as in ``dedup_index_structure``.
+    """
+    units = _index_structure_units(index_structure, _output)
+    if (published := _state.units) is None:
+        level = index_structure.current_position.level
+        return _initial_index_structure(units, level.value if level.valid else None, _state)
+
+    if re_bound.modified:
+        for k, (ts, out) in units.items():
+            if (value := valid_values(ts)) != published[k]:
+                out().value = tsd_value(published[k], value)
+                published[k] = value
+    else:
+        for k, (ts, out) in units.items():
+            if ts.modified and (delta := apply_delta(ts, published[k])):
+                out().value = delta
+    _publish_level(index_structure, _state, _output, re_bound.modified)
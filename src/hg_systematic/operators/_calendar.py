@@ -5,7 +5,9 @@ from hgraph import TimeSeriesSchema, TSS, subscription_service, TS, default_path
     compute_node, contains_, graph, TIME_SERIES_TYPE, last_modified_date, sample, if_true, not_
 
 __all__ = ["HolidayCalendarSchema", "calendar_for", "Periods", "business_days", "business_day", "HolidayCalendar",
-           "filter_by_calendar", "day_index_for", "trade_date", "next_month"]
+           "filter_by_calendar", "day_index_for", "trade_date", "next_month", "business_day_index",
+           "business_day_offset", "nth_business_day", "business_days_between",
+           "union_calendars", "intersect_calendars", "difference_calendars"]
 
 
 class HolidayCalendarSchema(TimeSeriesSchema):
@@ -50,6 +52,15 @@ def business_days(period: TS[Periods], calendar: HolidayCalendar, dt: TS[date])
     """
 
 
+@operator
+def business_day_index(period: TS[Periods], calendar: HolidayCalendar, dt: TS[date]) -> TS[int]:
+    """
+    The (1 based) index of the dt within the business days of the period containing dt, using the given calendar.
+    This is equivalent to ``index_of(business_days(period, calendar, dt), dt) + 1``, so is 0 when dt is not a
+    business day.
+    """
+
+
 @reference_service
 def trade_date(path: str = default_path) -> TS[date]:
     """
@@ -70,28 +81,56 @@ def business_day(symbol: TS[str], path: str = default_path) -> TS[date]:
     """
 
 
-@compute_node(overloads=contains_)
-def _contains_dt_in_calendar(ts: HolidayCalendar, item: TS[date]) -> TS[bool]:
+@operator
+def business_day_offset(calendar: HolidayCalendar, dt: TS[date], n: TS[int]) -> TS[date]:
     """
-    Determines if the date is within the holiday calendar, for us that means if we deem it a non-working day then
-    the date is within the calendar.
+    The business day ``n`` business days after dt (or before when n is negative) using the calendar.
+    When dt is not a business day, it is first rolled forward (non-negative n) or backward (negative n) to a
+    business day, so an offset of 0 is the first business day on or after dt.
     """
-    dt = item.value
-    dow = dt.weekday()
-    sow = ts.start_of_week.value
-    eow = ts.end_of_week.value
-    if eow < sow:
-        if eow < dow < sow:
-            return True  # We are in a weekend
-    else:
-        if dow < sow or eow < dow:
-            return True  # The other perspective for weekend
-    return dt in ts.holidays.value
 
 
-@graph
+@operator
+def nth_business_day(calendar: HolidayCalendar, dt: TS[date], n: TS[int]) -> TS[date]:
+    """
+    The n-th (1 based) business day of the month containing dt using the calendar. Negative values count back from
+    the end of the month, i.e. -1 is the last business day of the month. n cannot be 0.
+    """
+
+
+@operator
+def business_days_between(calendar: HolidayCalendar, start: TS[date], end: TS[date]) -> TS[int]:
+    """
+    The number of business days in the range [start, end) using the calendar. This is negative when end is before
+    start.
+    """
+
+
+@operator
+def union_calendars(lhs: HolidayCalendar, rhs: HolidayCalendar) -> HolidayCalendar:
+    """
+    The calendar whose non-working days are the non-working days of either calendar.
+    For example, a publishing calendar that is the approximation of two market calendars.
+    """
+
+
+@operator
+def intersect_calendars(lhs: HolidayCalendar, rhs: HolidayCalendar) -> HolidayCalendar:
+    """The calendar whose non-working days are the non-working days of both calendars."""
+
+
+@operator
+def difference_calendars(lhs: HolidayCalendar, rhs: HolidayCalendar) -> HolidayCalendar:
+    """The calendar whose non-working days are the non-working days of lhs that are working days in rhs."""
+
+
+@operator
 def filter_by_calendar(ts: TIME_SERIES_TYPE, holidays: HolidayCalendar) -> TIME_SERIES_TYPE:
     """Restrict values to be published only during working days"""
+
+
+@graph(overloads=filter_by_calendar)
+def filter_by_calendar_default(ts: TIME_SERIES_TYPE, holidays: HolidayCalendar) -> TIME_SERIES_TYPE:
     dt = last_modified_date(ts)
     return sample(if_true(not_(contains_(holidays, dt))), ts)
 
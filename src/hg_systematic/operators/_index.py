@@ -190,8 +190,7 @@ def index_level(symbol: str, initial_level: float = 100.0, record: str = None,
     contracts = index_rolling_contracts(symbol, dt, calendar)
 
     all_contracts = union(flip(contracts.first).key_set, flip(contracts.second).key_set)
-    prices = map_(lambda key, d, c: filter_by_calendar(price_in_dollars(key), c), __keys__=all_contracts, d=dt,
-                  c=calendar)
+    prices = filter_by_calendar(map_(lambda key: price_in_dollars(key), __keys__=all_contracts), calendar)
 
     level_fb = feedback(TS[float], initial_level)
     wav_first_fb = feedback(TS[float], 0.0)
@@ -1,7 +1,12 @@
-from hgraph import subscription_service, TS, default_path
+from dataclasses import dataclass
+from datetime import date
 
+from hgraph import subscription_service, TS, default_path, TSS, CompoundScalar, compute_node, TSD, TSB, \
+    TimeSeriesSchema, STATE, EvaluationEngineApi, REMOVE_IF_EXISTS
 
-__all__ = ["price_in_dollars", "SETTLEMENT_PRICE", "LIVE_PRICE", "returns_in_dollars",]
+
+__all__ = ["price_in_dollars", "SETTLEMENT_PRICE", "LIVE_PRICE", "returns_in_dollars", "SubscriptionMetrics",
+           "subscription_metrics", "NATIVE_PRICE", "fx_rate", "AsOfPrices", "as_of_prices",]
 
 # Ticks with the settlement price when available.
 SETTLEMENT_PRICE = "settlement_price"
@@ -9,6 +14,9 @@ SETTLEMENT_PRICE = "settlement_price"
 # Ticks with the live price
 LIVE_PRICE = "live_price"
 
+# Ticks with the price in the native currency of the symbol (see price_in_dollars_fx_impl)
+NATIVE_PRICE = "native_price"
+
 @subscription_service
 def price_in_dollars(symbol: TS[str], path: str = default_path) -> TS[float]:
     """
@@ -16,9 +24,124 @@ def price_in_dollars(symbol: TS[str], path: str = default_path) -> TS[float]:
     """
 
 
+@subscription_service
+def fx_rate(pair: TS[str], path: str = default_path) -> TS[float]:
+    """
+    The rate to convert one unit of the base currency into the quote currency of the pair, for example "EURUSD" is
+    the number of dollars for one euro.
+    """
+
+
 @subscription_service
 def returns_in_dollars(symbol: TS[str], path: str = default_path) -> TS[float]:
     """
     The current returns in dollars for this symbol. This is based on close-to-close prices.
     """
 
+
+class SubscriptionMetrics(CompoundScalar):
+    """Counts of the subscriptions made to a service"""
+    live: int  # The number of symbols currently subscribed
+    peak: int  # The largest number of symbols subscribed at any one time
+    subscribed: int  # The total number of subscriptions made
+    unsubscribed: int  # The total number of subscriptions released
+
+
+@compute_node
+def subscription_metrics(symbols: TSS[str], _output: TS[SubscriptionMetrics] = None) -> TS[SubscriptionMetrics]:
+    """
+    Tracks the subscriptions of a set of requested symbols, for example the keys of the ``price_in_dollars``
+    requests, or the ``symbol`` input of a service implementation.
+    """
+    previous = _output.value if _output.valid else SubscriptionMetrics(live=0, peak=0, subscribed=0, unsubscribed=0)
+    live = len(symbols.value)
+    return SubscriptionMetrics(
+        live=live,
+        peak=max(previous.peak, live),
+        subscribed=previous.subscribed + len(symbols.added()),
+        unsubscribed=previous.unsubscribed + len(symbols.removed()),
+    )
+
+
+@dataclass
+class AsOfPrices(TimeSeriesSchema):
+    prices: TSD[str, TS[float]]  # The latest price at or before the date
+    age: TSD[str, TS[int]]  # The number of days between the date and the date of the price
+
+
+class _AsOfPricesState(CompoundScalar):
+    history: dict = None  # symbol -> [dates, prices, ndx], dates are ordinals in ascending order, ndx the entry in use
+    published: dict = None  # symbol -> (price, age) last published
+
+
+_AS_OF_TRIM = 64  # The number of superseded entries of a symbol's history retained before they are discarded
+
+
+@compute_node(valid=("dt",))
+def as_of_prices(prices: TSD[str, TS[float]], dt: TS[date], max_staleness: int = None,
+                 _state: STATE[_AsOfPricesState] = None, _api: EvaluationEngineApi = None,
+                 _output: TSB[AsOfPrices] = None) -> TSB[AsOfPrices]:
+    """
+    The latest price of each symbol at or before ``dt``, where a price is dated by the engine date it ticked on.
+    Prices that tick ahead of ``dt`` are held back until ``dt`` reaches them. If ``max_staleness`` (in days) is set,
+    prices older than this are withdrawn.
+
+    This keeps a sorted history per symbol with the index of the entry in use, as ``dt`` only moves forward the index
+    only moves forward and superseded history is discarded. The age of each price is exposed alongside it, so
+    consumers can apply their own staleness policy.
+    """
+    if _state.history is None:
+        _state.history = {}
+        _state.published = {}
+    history = _state.history
+    published = _state.published
+    out_prices = {}
+    out_age = {}
+
+    if prices.modified:
+        for s in prices.removed_keys():
+            if history.pop(s, None) is not None:
+                published.pop(s, None)
+                out_prices[s] = REMOVE_IF_EXISTS
+                out_age[s] = REMOVE_IF_EXISTS
+        today = _api.evaluation_clock.evaluation_time.date().toordinal()
+        for s, price in prices.modified_items():
+            if (entry := history.get(s)) is None:
+                history[s] = entry = [[], [], -1]
+            dates, prices_, _ = entry
+            if dates and dates[-1] == today:
+                prices_[-1] = price.value
+            else:
+                dates.append(today)
+                prices_.append(price.value)
+
+    d = dt.value.toordinal()
+    for s in history if dt.modified else prices.modified_keys():
+        entry = history[s]
+        dates, prices_, ndx = entry
+        while ndx + 1 < len(dates) and dates[ndx + 1] <= d:
+            ndx += 1
+        if ndx >= _AS_OF_TRIM:
+            del dates[:ndx], prices_[:ndx]
+            ndx = 0
+        entry[2] = ndx
+        if ndx < 0:
+            continue  # Nothing at or before dt
+        price, age = prices_[ndx], d - dates[ndx]
+        current = published.get(s)
+        if max_staleness is not None and age > max_staleness:
+            if current is not None:
+                del published[s]
+                out_prices[s] = REMOVE_IF_EXISTS
+                out_age[s] = REMOVE_IF_EXISTS
+            continue
+        if dt.modified or current is None or current[0] != price:
+            out_prices[s] = price  # The prices tick with dt, even if unchanged
+        if current is None or current[1] != age:
+            out_age[s] = age
+        published[s] = price, age
+
+    if out_prices:
+        _output.prices.value = out_prices
+    if out_age:
+        _output.age.value = out_age
@@ -1,14 +1,19 @@
+import sys
 from dataclasses import dataclass
 from datetime import date
 from typing import Callable
 
 from hg_oap.instruments.future import month_code
 from hgraph import TimeSeriesSchema, TS, subscription_service, default_path, CompoundScalar, graph, TSD, TSB, TSL, Size, \
-    CmpResult, reference_service, format_, lift, compute_node, apply
+    CmpResult, reference_service, format_, lift, compute_node, apply, STATE, REMOVE_IF_EXISTS
+
+from hg_systematic.operators._index import INDEX_ROLL_STR
 
 __all__ = ["MonthlyRollingRange", "monthly_rolling_weights", "MonthlyRollingRequest", "MonthlyRollingWeightRequest",
            "monthly_rolling_info", "MonthlyRollingInfo", "futures_rolling_contracts", "bbg_commodity_contract_fn",
-           "rolling_schedules", "bbg_commodity_spread_contract_fn"]
+           "rolling_schedules", "bbg_commodity_spread_contract_fn", "MonthlyRollingOrdinals", "monthly_rolling_ordinals",
+           "multi_asset_rolling_contracts", "FutureContract", "ContractExpiry", "contract_expiry",
+           "next_live_contract"]
 
 
 @dataclass(frozen=True)
@@ -81,6 +86,38 @@ def monthly_rolling_info(request: TS[MonthlyRollingRequest], path: str = default
     """
 
 
+@dataclass
+class MonthlyRollingOrdinals(MonthlyRollingRange):
+    """
+    A compact form of ``MonthlyRollingInfo``. The dates are represented as their ``date.toordinal()`` values (which fit
+    in an int32), and the business days of the month are described by the ordinals of the first and last business days
+    of the month rather than a tuple of dates. These are independent of the range a calendar is compiled for, the days
+    of the month are the business days of the calendar in [month_first, month_last].
+
+    ``monthly_rolling_info_from_ordinals`` provides a ``MonthlyRollingInfo`` view over this.
+    """
+    dt: TS[int]  # The ordinal of the date the information represents
+    month_first: TS[int]  # The ordinal of the first business day of the month
+    month_last: TS[int]  # The ordinal of the last business day of the month
+    day_index: TS[int]  # The (1 based) index of dt within the business days of the month
+    begin_roll: TS[bool]
+    end_roll: TS[bool]
+    roll_state: TS[CmpResult]  # LT before roll, EQ in roll, GT After roll
+    roll_out_month: TS[int]
+    roll_out_year: TS[int]
+    roll_in_month: TS[int]
+    roll_in_year: TS[int]
+
+
+@subscription_service
+def monthly_rolling_ordinals(request: TS[MonthlyRollingRequest], path: str = default_path) \
+        -> TSB[MonthlyRollingOrdinals]:
+    """
+    The rolling information in compact (ordinal) form, this is cheaper to compare, de-duplicate and record than
+    ``monthly_rolling_info``.
+    """
+
+
 @graph
 def futures_rolling_contracts(
         roll_info: TSB[MonthlyRollingInfo],
@@ -130,6 +167,83 @@ def futures_rolling_contracts(
     return TSL.from_ts(c1_m, c2_m)
 
 
+@graph
+def multi_asset_rolling_contracts(
+        roll_info: TSB[MonthlyRollingInfo],
+        roll_schedules: TSD[str, TSD[int, TS[tuple[int, int]]]],
+        contract_fn: TS[Callable[[str, int, int], str]],
+) -> INDEX_ROLL_STR:
+    """
+    The contracts for all the assets of ``roll_schedules`` (keyed by asset), this produces the same contracts as
+    ``futures_rolling_contracts`` for each asset, but computes them in a single node. The node is only evaluated when
+    the roll-out month changes (or the schedules change), and only the assets whose contracts change are ticked.
+
+    Here the ``contract_fn`` is a scalar function of (asset, month, year), for example ``bbg_commodity_contract_fn``.
+    """
+    return _multi_asset_rolling_contracts(roll_info.roll_out_month, roll_info.roll_out_year, roll_info.roll_in_month,
+                                          roll_info.roll_in_year, roll_schedules, contract_fn)
+
+
+class _MultiAssetRollingContractsState(CompoundScalar):
+    contracts: dict = None  # asset -> (roll_out, roll_in) last produced
+    names: dict = None  # (asset, month, year) -> the (interned) contract name
+
+
+@compute_node
+def _multi_asset_rolling_contracts(
+        roll_out_month: TS[int],
+        roll_out_year: TS[int],
+        roll_in_month: TS[int],
+        roll_in_year: TS[int],
+        roll_schedules: TSD[str, TSD[int, TS[tuple[int, int]]]],
+        contract_fn: TS[Callable[[str, int, int], str]],
+        _state: STATE[_MultiAssetRollingContractsState] = None,
+        _output: INDEX_ROLL_STR = None,
+) -> INDEX_ROLL_STR:
+    if _state.contracts is None or contract_fn.modified:
+        _state.contracts = {}
+        _state.names = {}
+    contracts = _state.contracts
+    names = _state.names
+    fn = contract_fn.value
+
+    def name(asset: str, month: int, year: int) -> str:
+        if (n := names.get(key := (asset, month, year))) is None:
+            names[key] = n = sys.intern(fn(asset, month, year))
+        return n
+
+    m1, y1 = roll_out_month.value, roll_out_year.value
+    m2, y2 = roll_in_month.value, roll_in_year.value
+    first = {}
+    second = {}
+    if roll_out_month.modified or roll_out_year.modified or roll_in_month.modified or roll_in_year.modified or \
+            contract_fn.modified:
+        assets = roll_schedules.keys()
+    else:
+        assets = roll_schedules.modified_keys()
+    for asset in assets:
+        schedule = roll_schedules[asset]
+        (c1_m, c1_y), (c2_m, c2_y) = schedule[m1].value, schedule[m2].value
+        c1 = name(asset, c1_m, y1 + c1_y)
+        c2 = name(asset, c2_m, y2 + c2_y)
+        previous = contracts.get(asset, (None, None))
+        if c1 != previous[0]:
+            first[asset] = c1
+        if c2 != previous[1]:
+            second[asset] = c2
+        contracts[asset] = (c1, c2)
+    for asset in roll_schedules.removed_keys():
+        contracts.pop(asset, None)
+        first[asset] = REMOVE_IF_EXISTS
+        second[asset] = REMOVE_IF_EXISTS
+
+    # Set the changes (as deltas) on each asset TSD, the removals cannot be returned within a nested dict
+    if first:
+        _output.first.value = first
+    if second:
+        _output.second.value = second
+
+
 @graph
 def spread_rolling_contracts(
         roll_info: TSB[MonthlyRollingInfo],
@@ -219,6 +333,55 @@ def rolling_schedules(path: str = default_path) -> TSD[str, TSD[int, TS[tuple[in
     """
 
 
+@dataclass(frozen=True)
+class FutureContract(CompoundScalar):
+    """Identifies a future contract by asset and delivery month and year"""
+    asset: str
+    month: int
+    year: int
+
+
+@dataclass(frozen=True)
+class ContractExpiry(CompoundScalar):
+    """
+    The key dates of a future contract.
+
+    :param last_trade_date: The last date the contract trades.
+    :param first_notice_date: The first date a notice of delivery can be given, None when the contract is cash settled
+                              (or has no notice period).
+    """
+    asset: str
+    month: int
+    year: int
+    last_trade_date: date
+    first_notice_date: date = None
+
+    @property
+    def contract(self) -> FutureContract:
+        return FutureContract(self.asset, self.month, self.year)
+
+    @property
+    def last_live_date(self) -> date:
+        """The last date a position can be held in this contract, the day before first notice or the last trade date"""
+        return self.last_trade_date if self.first_notice_date is None else \
+            min(self.last_trade_date, date.fromordinal(self.first_notice_date.toordinal() - 1))
+
+
+@subscription_service
+def contract_expiry(contract: TS[FutureContract], path: str = default_path) -> TS[ContractExpiry]:
+    """
+    The last trade and first notice dates of the contract. Does not tick if the contract is not known.
+    """
+
+
+@subscription_service
+def next_live_contract(asset: TS[str], path: str = default_path) -> TS[ContractExpiry]:
+    """
+    The first contract of the asset that is live (see ``ContractExpiry.last_live_date``) as of the current trade date,
+    this ticks when the next live contract changes.
+    """
+
+
 # NOTE: Mostly BBG uses a single digit year identifier, but using 2 makes it scale a bit further in time.
 
 def bbg_commodity_contract_fn(asset: str, month: int, year: int, use_single_digit_year: bool = False) -> str:
@@ -0,0 +1,43 @@
+"""
+Helpers for testing that an implementation ticks the same as the implementation it replaces.
+"""
+from functools import wraps
+from typing import Callable
+
+from hgraph import graph, register_service, default_path
+from hgraph.test import eval_node
+
+__all__ = ["service", "with_services", "assert_equivalent"]
+
+
+def service(impl, path: str = default_path, **kwargs) -> tuple:
+    """A service registration for ``with_services``"""
+    return path, impl, kwargs
+
+
+def with_services(body: Callable, *services: tuple) -> Callable:
+    """
+    A graph with the signature of ``body`` that registers the ``services`` (see ``service``) and then wires ``body``,
+    the services common to the implementations compared can be registered by ``body`` itself.
+    """
+
+    @wraps(body)
+    def g(*args, **kwargs):
+        for path, impl, kwargs_ in services:
+            register_service(path, impl, **kwargs_)
+        return body(*args, **kwargs)
+
+    return graph(g)
+
+
+def assert_equivalent(reference: Callable, candidate: Callable, *inputs, normalise: Callable = None,
+                      **kwargs) -> list:
+    """
+    Asserts that the ``candidate`` graph ticks the same as the ``reference`` graph for the same ``inputs`` (and
+    ``eval_node`` arguments), once ``normalise``-d. Returns the (normalised) ticks of the reference, so these can be
+    held to known values.
+    """
+    normalise = normalise or (lambda ticks: ticks)
+    expected = normalise(eval_node(reference, *inputs, **kwargs))
+    assert normalise(eval_node(candidate, *inputs, **kwargs)) == expected
+    return expected
@@ -0,0 +1,108 @@
+from datetime import date
+
+import pytest
+from frozendict import frozendict as fd
+from hgraph import REMOVE, CmpResult
+from hgraph.test import eval_node
+
+from hg_systematic.index.index_utils import compute_level, re_balance_state_machine
+from hg_systematic.index.units import dedup_index_structure, dedup_re_bound_index_structure
+
+
+def test_compute_level():
+    assert eval_node(
+        compute_level,
+        [dict(units=fd(a=2.0, b=1.0), unit_values=fd(a=10.0, b=20.0), level=100.0), None, None,
+         dict(units=fd(a=REMOVE), unit_values=fd(a=REMOVE), level=103.0)],
+        [fd(a=10.0, b=20.0), fd(a=11.0), fd(b=22.0), fd(b=21.0)],
+    ) == [100.0, 102.0, 104.0, 104.0]
+
+
+def test_re_balance_state_machine():
+    d = lambda day: date(2024, 1, day)
+    assert eval_node(
+        re_balance_state_machine,
+        index_structure=[dict(current_position=dict(units=fd(a=1.0), unit_values=fd(a=10.0), level=100.0),
+                              previous_units=fd(), target_units=fd()),
+                         dict(previous_units=fd(a=1.0), target_units=fd(b=0.5)),
+                         None,
+                         dict(current_position=dict(units=fd(a=0.5, b=0.25), unit_values=fd(b=20.0), level=101.0)),
+                         None,
+                         dict(current_position=dict(units=fd(a=REMOVE, b=0.5), unit_values=fd(a=REMOVE)),
+                              previous_units=fd(a=REMOVE), target_units=fd(b=REMOVE))],
+        begin_roll=[True, False],
+        end_roll=[False, None, None, True, False],
+        roll_state=[CmpResult.LT, CmpResult.EQ, None, CmpResult.GT],
+        dt=[d(1), d(2), d(3), d(4), d(5), d(6)],
+        roll_weight=[1.0, 0.5],
+        prices=[fd(a=10.0, b=20.0)],
+        level=[100.0, None, 101.0],
+        trade_halt=[False, True, False, True, False],
+        re_balance_signal=[True],
+        target_units=[fd(b=0.5)],
+    ) == [
+        # Begin the re-balance
+        dict(current_position=dict(units=fd(a=1.0), unit_values=fd(a=10.0), level=100.0),
+             previous_units=fd(a=1.0), target_units=fd(b=0.5)),
+        None,  # Trading is halted
+        # Only the position is changed
+        dict(current_position=dict(units=fd(a=0.5, b=0.25), unit_values=fd(a=10.0, b=20.0), level=101.0),
+             previous_units=fd(), target_units=fd()),
+        None,  # The roll ends whilst trading is halted
+        # Complete once trading resumes
+        dict(current_position=dict(units=fd(a=REMOVE, b=0.5), unit_values=fd(a=REMOVE, b=20.0), level=101.0),
+             previous_units=fd(a=REMOVE), target_units=fd(b=REMOVE)),
+        None,
+    ]
+
+
+def test_re_balance_state_machine_idle():
+    d = lambda day: date(2024, 1, day)
+    assert eval_node(
+        re_balance_state_machine,
+        index_structure=[dict(current_position=dict(units=fd(a=1.0, b=2.0), unit_values=fd(a=10.0, b=20.0),
+                                                     level=100.0), previous_units=fd(), target_units=fd()),
+                         None,
+                         dict(current_position=dict(units=fd(b=REMOVE, c=3.0), unit_values=fd(b=REMOVE, c=30.0)))],
+        begin_roll=[False],
+        end_roll=[False],
+        roll_state=[CmpResult.LT],
+        dt=[d(1), None, d(2)],
+        roll_weight=[1.0],
+        prices=[fd(a=10.0, b=20.0), fd(a=11.0)],  # The price tick does not change the structure
+        level=[100.0, 101.0],
+        trade_halt=[False],
+        re_balance_signal=[False],
+        target_units=[fd()],
+    ) == [
+        dict(current_position=dict(units=fd(a=1.0, b=2.0), unit_values=fd(a=10.0, b=20.0), level=100.0),
+             previous_units=fd(), target_units=fd()),
+        None,
+        # Whilst idle the delta of the structure is passed through
+        dict(current_position=dict(units=fd(b=REMOVE, c=3.0), unit_values=fd(b=REMOVE, c=30.0)),
+             previous_units=fd(), target_units=fd()),
+    ]
+
+
+@pytest.mark.parametrize("dedup,re_bound", [
+    (dedup_index_structure, ()),
+    # Without a re-bind only the deltas are compared, with one the units are compared in full
+    (dedup_re_bound_index_structure, ([None, None, None, None],)),
+    (dedup_re_bound_index_structure, ([True, True, True, True],)),
+])
+def test_dedup_index_structure(dedup, re_bound):
+    assert eval_node(dedup, [
+        dict(current_position=dict(units=fd(a=1.0), unit_values=fd(a=10.0), level=100.0),
+             previous_units=fd(), target_units=fd()),
+        dict(current_position=dict(units=fd(a=1.0), level=100.0), target_units=fd()),  # Unchanged
+        dict(current_position=dict(units=fd(a=REMOVE, b=2.0), unit_values=fd(a=REMOVE, b=5.0), level=101.0),
+             previous_units=fd(a=1.0)),
+        dict(previous_units=fd(a=REMOVE)),
+    ], *re_bound) == [
+        dict(current_position=dict(units=fd(a=1.0), unit_values=fd(a=10.0), level=100.0),
+             previous_units=fd(), target_units=fd()),
+        None,
+        dict(current_position=dict(units=fd(a=REMOVE, b=2.0), unit_values=fd(a=REMOVE, b=5.0), level=101.0),
+             previous_units=fd(a=1.0), target_units=fd()),
+        dict(current_position=dict(units=fd(), unit_values=fd()), previous_units=fd(a=REMOVE), target_units=fd()),
+    ]
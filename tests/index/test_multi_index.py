@@ -1,10 +1,11 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from datetime import date, datetime
 from importlib import resources as pkg_resources
 
 import polars as pl
 import polars.selectors as cs
 from frozendict import frozendict
+import pytest
 from hgraph import graph, register_service, default_path, TSB, DebugContext, TS, const, map_
 from hgraph.test import eval_node, EvaluationTrace
 
@@ -21,6 +22,11 @@ from hg_systematic.operators import bbg_commodity_contract_fn
 class MyMultiIndexConfiguration(AnnualMultiIndexConfiguration):
     ...
 
+
+@dataclass(frozen=True)
+class MyComparedMultiIndexConfiguration(AnnualMultiIndexConfiguration):
+    ...
+
 INDICES = {
     "My Index": MyMultiIndexConfiguration(
         symbol="My Index",
@@ -66,9 +72,20 @@ INDICES = {
     ),
 }
 
+# The same index re-balanced by each of the re-balance engines
+COMPARED_INDICES = INDICES | {
+    symbol: MyComparedMultiIndexConfiguration(**{
+        **{f.name: getattr(INDICES["My Index"], f.name) for f in fields(MyComparedMultiIndexConfiguration)},
+        "symbol": symbol,
+        "re_balance_month": 5,
+        "re_balance_state_machine": state_machine,
+    })
+    for symbol, state_machine in (("My Graph Index", False), ("My State Machine Index", True))
+}
+
 
 @graph
-def register_services():
+def register_services(indices=INDICES):
     register_service(default_path, trade_date_week_days)
     register_service(default_path, business_day_impl)
     register_service(
@@ -97,7 +114,7 @@ def register_services():
     register_service(default_path, price_in_dollars_static_impl, prices=prcs, round_to=2)
     register_service(default_path, monthly_rolling_info_service_impl)
     register_service(default_path, monthly_rolling_weights_impl)
-    register_service(default_path, static_index_configuration, indices=INDICES)
+    register_service(default_path, static_index_configuration, indices=indices)
 
 
 def _move_back(k, delta, symbol="CL") -> str:
@@ -140,3 +157,26 @@ def test_multi_index():
     )
     print('Result', result)
     assert result
+
+
+def test_multi_index_re_balance_state_machine():
+    from hg_systematic.index.pricing_service import IndexResult, price_index_op, price_index_impl, price_index
+
+    @graph(overloads=price_index_op)
+    def price_index_op_compared(config: TS[MyComparedMultiIndexConfiguration]) -> TSB[IndexResult]:
+        return multi_index_monthly_rolling_index(
+            config=config,
+            weights_fn=lambda cfg, levels: map_(lambda key: const(0.5), __keys__=levels.key_set)
+        )
+
+    @graph
+    def g(symbol: TS[str]) -> TS[float]:
+        register_services(COMPARED_INDICES)
+        register_service(default_path, price_index_impl)
+        return price_index(symbol).level
+
+    args = dict(__start_time__=datetime(2019, 4, 1), __end_time__=datetime(2019, 6, 1), __elide__=True)
+    expected = eval_node(g, ["My Graph Index"], **args)
+    assert len(expected) > 20
+    assert expected[-1] == pytest.approx(119.29178268)  # A fixed reference level, not only parity between the engines
+    assert eval_node(g, ["My State Machine Index"], **args) == expected
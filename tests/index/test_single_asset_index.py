@@ -1,24 +1,31 @@
+from dataclasses import replace, fields
 from datetime import date, datetime
 from importlib import resources as pkg_resources
 
 import polars as pl
 import polars.selectors as cs
 from frozendict import frozendict
-from hgraph import graph, register_service, default_path, TSB, DebugContext
+import pytest
+from hgraph import graph, register_service, default_path, TSB, DebugContext, TS, TSL, Size, const, TSS, TSD, map_, \
+    service_impl, sink_node, EvaluationEngineApi
 
 from hg_systematic.impl import trade_date_week_days, calendar_for_static, create_market_holidays, \
-    price_in_dollars_static_impl, monthly_rolling_info_service_impl, monthly_rolling_weights_impl, business_day_impl
+    price_in_dollars_static_impl, price_in_dollars_wide_impl, monthly_rolling_info_service_impl, monthly_rolling_weights_impl, business_day_impl
 from hg_systematic.index.configuration_service import static_index_configuration
 from hg_systematic.index.pricing_service import price_index_impl
 
+from hg_systematic.index.conversion import compile_contract_schedule, roll_schedule_to_map
 from hg_systematic.index.single_asset_index import MonthlySingleAssetIndexConfiguration, \
-    price_monthly_single_asset_index
-from hg_systematic.operators import bbg_commodity_contract_fn
+    price_monthly_single_asset_index, MonthlySpreadSingleAssetIndexConfiguration, rolling_contract, \
+    MonthlySingleAssetTableIndexConfiguration, MonthlySpreadSingleAssetTableIndexConfiguration
+from hg_systematic.operators import bbg_commodity_contract_fn, bbg_commodity_spread_contract_fn, monthly_rolling_info, \
+    MonthlyRollingRequest, price_in_dollars, subscription_metrics, SubscriptionMetrics
 
 from hgraph.test import eval_node, EvaluationTrace
+from tests.equivalence import with_services, assert_equivalent
 
 @graph
-def register_services():
+def register_services(price_impl=price_in_dollars_static_impl):
     register_service(default_path, trade_date_week_days)
     register_service(default_path, business_day_impl)
     register_service(
@@ -32,8 +39,10 @@ def register_services():
     with pkg_resources.path(tests.index, "CL.parquet") as file:
         cl_df = pl.read_parquet(file)
     cl_df = cl_df.rename({k: _move_back(k, 6) for k in cl_df.schema}) # Pretend these are earlier contracts
-    prcs = cl_df.unpivot(cs.numeric(), index="date",variable_name="symbol", value_name="price").drop_nulls().cast({"date": date})
-    register_service(default_path, price_in_dollars_static_impl, prices=prcs, round_to=2)
+    if price_impl is not price_in_dollars_wide_impl:
+        cl_df = cl_df.unpivot(cs.numeric(), index="date", variable_name="symbol", value_name="price").drop_nulls().cast(
+            {"date": date})
+    register_service(default_path, price_impl, prices=cl_df, round_to=2)
     register_service(default_path, monthly_rolling_info_service_impl)
     register_service(default_path, monthly_rolling_weights_impl)
 
@@ -120,4 +129,240 @@ def test_single_asset_index_initialised_from_nothing():
         #__trace__=True
     )
     print('Result', result)
-    assert result
\ No newline at end of file
+    assert result
+
+def test_single_asset_index_releases_rolled_out_contracts():
+    from hg_systematic.index.pricing_service import IndexResult
+    from hg_systematic.impl._price_impl import _price_in_dollars_static_impl
+    metrics = []
+
+    @sink_node
+    def _record(m: TS[SubscriptionMetrics]):
+        metrics.append(m.value)
+
+    @service_impl(interfaces=[price_in_dollars])
+    @graph
+    def _price_impl(symbol: TSS[str], prices: object, round_to: int = 2) -> TSD[str, TS[float]]:
+        _record(subscription_metrics(symbol))
+        return map_(lambda price: price, _price_in_dollars_static_impl(prices, round_to), __keys__=symbol)
+
+    @graph
+    def g() -> TSB[IndexResult]:
+        register_services(_price_impl)
+        register_service(default_path, static_index_configuration, indices=frozendict())
+        register_service(default_path, price_index_impl)
+        return price_monthly_single_asset_index(
+            config=MonthlySingleAssetIndexConfiguration(
+                symbol="CL Index",
+                publish_holiday_calendar="BCOM",
+                rounding=8,
+                initial_level=100.0,
+                initial_contract='CLK19 Comdty',
+                start_date=date(2019, 4, 1),
+                asset="CL",
+                roll_period=(5, 10),
+                roll_schedule=("H0", "H0", "K0", "K0", "N0", "N0", "U0", "U0", "X0", "X0", "F0", "F1"),
+                trading_halt_calendar="CL NonTrading",
+                contract_fn=bbg_commodity_contract_fn
+            ))
+
+    assert eval_node(g, __start_time__=datetime(2019, 4, 1), __end_time__=datetime(2020, 1, 1), __elide__=True)
+    # Only the contracts rolled out of, held and rolled into are subscribed to
+    assert max(m.live for m in metrics) <= 3
+    assert metrics[-1].subscribed >= 5
+    assert metrics[-1].unsubscribed == metrics[-1].subscribed - metrics[-1].live
+
+
+
+def test_single_asset_index_re_balance_state_machine():
+    from hg_systematic.index.pricing_service import IndexResult
+
+    def index_structures(state_machine: bool) -> dict:
+        structures = {}
+
+        @sink_node
+        def _record(result: TSB[IndexResult], _api: EvaluationEngineApi = None):
+            # The graph form can re-set the position (at the same level) when the roll state changes, so compare the
+            # level and the units held
+            structure = result.index_structure
+            structures[_api.evaluation_clock.evaluation_time.date()] = (
+                result.level.value, structure.current_position.units.value, structure.previous_units.value,
+                structure.target_units.value
+            )
+
+        @graph
+        def g():
+            register_services()
+            register_service(default_path, static_index_configuration, indices=frozendict())
+            register_service(default_path, price_index_impl)
+            _record(price_monthly_single_asset_index(
+                config=MonthlySingleAssetIndexConfiguration(
+                    symbol="CL Index",
+                    publish_holiday_calendar="BCOM",
+                    rounding=8,
+                    initial_level=100.0,
+                    current_position=frozendict({'CLK19 Comdty': 100.0 / 53.30}),
+                    current_position_value=frozendict({'CLK19 Comdty': 53.30}),
+                    current_level=100.0,
+                    start_date=date(2025, 4, 1),
+                    asset="CL",
+                    roll_period=(5, 10),
+                    roll_schedule=("H0", "H0", "K0", "K0", "N0", "N0", "U0", "U0", "X0", "X0", "F0", "F1"),
+                    trading_halt_calendar="CL NonTrading",
+                    contract_fn=bbg_commodity_contract_fn,
+                    re_balance_state_machine=state_machine,
+                )))
+
+        eval_node(g, __start_time__=datetime(2019, 4, 1), __end_time__=datetime(2019, 6, 1))
+        return structures
+
+    expected = index_structures(False)
+    assert expected[date(2019, 4, 12)][1] == pytest.approx({"CLN19 Comdty": 100.0 / 53.30})
+    # Both engines are held to fixed reference levels, not only to each other
+    reference = {date(2019, 4, 5): 100.31894934, date(2019, 4, 12): 101.70731707, date(2019, 5, 31): 96.82926829}
+    for state_machine, structures in ((False, expected), (True, actual := index_structures(True))):
+        assert {d: structures[d][0] for d in reference} == pytest.approx(reference), state_machine
+    assert actual == expected
+
+
+def _index_levels(config: MonthlySingleAssetIndexConfiguration, start_time: datetime, end_time: datetime,
+                  price_impl=price_in_dollars_static_impl) -> dict[date, float]:
+    """The published level of the index by date"""
+    from hg_systematic.index.pricing_service import IndexResult
+    levels = {}
+
+    @sink_node
+    def _record(result: TSB[IndexResult], _api: EvaluationEngineApi = None):
+        levels[_api.evaluation_clock.evaluation_time.date()] = result.level.value
+
+    @graph
+    def g():
+        register_services(price_impl)
+        register_service(default_path, static_index_configuration, indices=frozendict())
+        register_service(default_path, price_index_impl)
+        _record(price_monthly_single_asset_index(config=config))
+
+    eval_node(g, __start_time__=start_time, __end_time__=end_time)
+    return levels
+
+
+_CL_INDEX = MonthlySingleAssetIndexConfiguration(
+    symbol="CL Index",
+    publish_holiday_calendar="BCOM",
+    rounding=8,
+    initial_level=100.0,
+    initial_contract='CLK19 Comdty',
+    start_date=date(2019, 4, 1),
+    asset="CL",
+    roll_period=(5, 10),
+    roll_schedule=("H0", "H0", "K0", "K0", "N0", "N0", "U0", "U0", "X0", "X0", "F0", "F1"),
+    trading_halt_calendar="CL NonTrading",
+    contract_fn=bbg_commodity_contract_fn
+)
+
+
+def test_single_asset_index_wide_prices():
+    expected = _index_levels(_CL_INDEX, datetime(2019, 4, 1), datetime(2019, 6, 1))
+    assert len(expected) > 30
+    assert _index_levels(_CL_INDEX, datetime(2019, 4, 1), datetime(2019, 6, 1), price_in_dollars_wide_impl) == expected
+
+
+@pytest.mark.parametrize("state_machine", [False, True])
+def test_single_asset_index_level_after_roll(state_machine):
+    # The structure fed back after the roll completes carries the unit values of the roll, so the move of the final
+    # day of the roll is counted once (it was counted twice, giving 103.62101313)
+    levels = _index_levels(replace(_CL_INDEX, re_balance_state_machine=state_machine), datetime(2019, 4, 1),
+                           datetime(2019, 4, 20))
+    assert levels[date(2019, 4, 15)] == pytest.approx(102.64540338)
+
+
+def test_compile_contract_schedule():
+    schedule = roll_schedule_to_map(("H0", "H0", "K0", "K0", "N0", "N0", "U0", "U0", "X0", "X0", "F1", "F1"))
+    table = compile_contract_schedule(schedule, bbg_commodity_contract_fn, "CL", date(2024, 11, 15), date(2025, 1, 2))
+    assert table == {
+        date(2024, 11, 1): ("CLF25 Comdty", "CLF25 Comdty"),
+        date(2024, 12, 1): ("CLF25 Comdty", "CLH25 Comdty"),
+        date(2025, 1, 1): ("CLH25 Comdty", "CLH25 Comdty"),
+    }
+    # Contract names are shared
+    assert table[date(2024, 11, 1)][1] is table[date(2024, 12, 1)][0]
+    # The range is inclusive of the months of the start and end dates
+    assert list(compile_contract_schedule(schedule, bbg_commodity_contract_fn, "CL", date(2024, 12, 31),
+                                          date(2024, 12, 1))) == [date(2024, 12, 1)]
+    assert compile_contract_schedule(schedule, bbg_commodity_contract_fn, "CL", date(2025, 1, 1),
+                                     date(2024, 12, 31)) == {}
+
+
+_ROLL_SCHEDULE = ("H0", "H0", "K0", "K0", "N0", "N0", "U0", "U0", "X0", "X0", "F1", "F1")
+
+
+def _table_config(config: MonthlySingleAssetIndexConfiguration):
+    """The table form of the configuration"""
+    tp = MonthlySpreadSingleAssetTableIndexConfiguration if isinstance(config, MonthlySpreadSingleAssetIndexConfiguration) \
+        else MonthlySingleAssetTableIndexConfiguration
+    return tp(**{f.name: getattr(config, f.name) for f in fields(config)})
+
+
+@pytest.mark.parametrize("config", [
+    MonthlySingleAssetIndexConfiguration(
+        symbol="CL Index", publish_holiday_calendar="BCOM", asset="CL", roll_period=(-3, 5),
+        roll_schedule=_ROLL_SCHEDULE, contract_fn=bbg_commodity_contract_fn,
+    ),
+    MonthlySpreadSingleAssetIndexConfiguration(
+        symbol="CL Spread Index", publish_holiday_calendar="BCOM", asset="CL", roll_period=(5, 10),
+        roll_schedule=_ROLL_SCHEDULE, far_leg_roll_schedule=_ROLL_SCHEDULE[1:] + _ROLL_SCHEDULE[:1],
+        contract_fn=bbg_commodity_spread_contract_fn,
+    ),
+])
+def test_rolling_contract_from_table(config):
+    def g(config_):
+        def g_() -> TSL[TS[str], Size[2]]:
+            register_services()
+            roll_info = monthly_rolling_info(
+                const(MonthlyRollingRequest(start=config.roll_period[0], end=config.roll_period[1],
+                                            calendar_name="BCOM")))
+            # Selected by the type of the configuration
+            return rolling_contract(const(config_, TS[MonthlySingleAssetIndexConfiguration]), const(config.asset),
+                                    roll_info)
+
+        return with_services(g_)
+
+    def contracts(ticks):
+        # The graph form can re-tick a contract with an unchanged name, so compare the sequence of contract pairs
+        states = [{}]
+        for tick in ticks:
+            if (state := states[-1] | tick) != states[-1]:
+                states.append(state)
+        return states
+
+    expected = assert_equivalent(g(config), g(_table_config(config)), normalise=contracts,
+                                 __start_time__=datetime(2024, 10, 1), __end_time__=datetime(2025, 3, 1),
+                                 __elide__=True)
+    assert len(expected) > 3
+
+
+def test_replay_contract_table_out_of_range():
+    from hg_systematic.index.single_asset_index import _replay_contract_table
+    config = _table_config(_CL_INDEX)
+    schedule = roll_schedule_to_map(config.roll_schedule)
+    table = compile_contract_schedule(schedule, bbg_commodity_contract_fn, "CL", date(2024, 6, 1), date(2030, 1, 1))
+    # Across the year end, past the end of the compiled table and back to before its start
+    months = [(12, 2024), (1, 2025), (1, 2030), (6, 2024)]
+    assert eval_node(
+        _replay_contract_table, [config], ["CL"], [m for m, _ in months], [y for _, y in months], False
+    ) == [
+        {0: "CLF25 Comdty", 1: "CLH25 Comdty"},
+        {0: "CLH25 Comdty"},  # Only the contracts that change tick
+        {0: "CLH30 Comdty", 1: "CLH30 Comdty"},
+        {0: "CLN24 Comdty", 1: "CLU24 Comdty"},
+    ]
+    assert [table[date(y, m, 1)] for m, y in months] == [("CLF25 Comdty", "CLH25 Comdty"),
+                                                         ("CLH25 Comdty", "CLH25 Comdty"),
+                                                         ("CLH30 Comdty", "CLH30 Comdty"),
+                                                         ("CLN24 Comdty", "CLU24 Comdty")]
+
+
+def test_single_asset_index_from_table():
+    levels = _index_levels(_table_config(_CL_INDEX), datetime(2019, 4, 1), datetime(2019, 6, 1))
+    assert levels == _index_levels(_CL_INDEX, datetime(2019, 4, 1), datetime(2019, 6, 1))
+    assert levels[date(2019, 4, 15)] == pytest.approx(102.64540338)
@@ -1,12 +1,19 @@
 from datetime import datetime, date, timedelta
 from frozendict import frozendict as fd
 
+import numpy as np
 import pytest
-from hgraph import graph, TSB, TS, contains_, register_service, default_path, service_impl
+from hgraph import graph, TSB, TS, contains_, register_service, default_path, service_impl, const, and_, not_, \
+    Removed, TSD, REMOVE
 from hgraph.test import eval_node
 
-from hg_systematic.impl import trade_date_week_days, business_day_impl, calendar_for_static, day_index_for_impl
-from hg_systematic.operators import business_days, Periods, HolidayCalendarSchema, business_day
+from hg_systematic.impl import trade_date_week_days, business_day_impl, calendar_for_static, day_index_for_impl, \
+    compile_calendar, create_market_holidays, set_holiday_cache_dir, market_holiday_ordinals, clear_period_cache, \
+    period_cache_info, trade_date_sparse, TradeDateClockInfo, trade_date_sparse_clock_info, set_compiled_calendar_cache_size, \
+    clear_compiled_calendar_cache, CompiledCalendar
+from hg_systematic.operators import business_days, Periods, HolidayCalendarSchema, business_day, business_day_index, \
+    union_calendars, intersect_calendars, difference_calendars, calendar_for, business_day_offset, nth_business_day, \
+    business_days_between, filter_by_calendar, trade_date
 from hg_systematic.operators._calendar import next_month, day_index_for
 
 
@@ -81,3 +88,289 @@ def test_day_index_for():
         __end_time__=datetime(2025, 1, 6, 23, 59),
         __elide__=True
     ) == [1, 2, 3]
+
+
+@pytest.mark.parametrize(
+    ["period", "dt", "expected"],
+    [
+        [Periods.Month, date(2025, 1, 15), tuple(d for d in (date(2025, 1, i) for i in range(2, 32))
+                                                 if d.weekday() < 5)],
+        [Periods.Week, date(2024, 12, 31), (date(2024, 12, 30), date(2024, 12, 31), date(2025, 1, 2),
+                                            date(2025, 1, 3))],
+        [Periods.Quarter, date(2025, 2, 15), tuple(d for d in (date(2025, 1, 1) + timedelta(days=i)
+                                                               for i in range(90)) if d.weekday() < 5)[1:]],
+    ]
+)
+def test_compiled_calendar_business_days(period, dt, expected):
+    calendar = compile_calendar(frozenset({date(2025, 1, 1)}), dt=dt)
+    assert calendar.business_days(period, dt) == expected
+    assert calendar.period_length(period, dt) == len(expected)
+    assert calendar.day_index(period, expected[1]) == 2
+
+
+def test_compiled_calendar_year():
+    calendar = compile_calendar(frozenset({date(2025, 1, 1), date(2025, 12, 25)}))
+    days = calendar.business_days(Periods.Year, date(2025, 6, 1))
+    assert len(days) == 261 - 2
+    assert days[0] == date(2025, 1, 2) and days[-1] == date(2025, 12, 31)
+    assert calendar.day_index(Periods.Year, date(2025, 1, 4)) == 0  # Saturday
+    assert not calendar.is_business_day(date(2025, 12, 25))
+
+
+def test_compiled_calendar_extends_range():
+    holidays = frozenset({date(2025, 1, 1)})
+    calendar = compile_calendar(holidays)
+    assert not calendar.covers(date(2030, 1, 2))
+    extended = compile_calendar(holidays, dt=date(2030, 1, 2))
+    assert extended.covers(date(2030, 1, 2)) and extended.covers(date(2025, 1, 2))
+    assert extended.day_index(Periods.Month, date(2030, 1, 2)) == 2
+
+
+@pytest.mark.parametrize("dt", [date(2023, 3, 10), date(2024, 12, 31), date(2026, 1, 1), date(1990, 6, 1)])
+@pytest.mark.parametrize("period", [Periods.Week, Periods.Month, Periods.Quarter, Periods.Year])
+def test_compiled_calendar_outside_range(period, dt):
+    calendar = CompiledCalendar(frozenset({date(2025, 1, 1)}), 0, 4, 2025, 2025)
+    with pytest.raises(ValueError):
+        calendar.period_bounds(period, dt)
+    with pytest.raises(ValueError):
+        calendar.business_days(period, dt)
+    # The first and last days of the compiled range are within range (a week may extend beyond it)
+    assert date(2025, 1, 2) in calendar.business_days(period, date(2025, 1, 2))
+    assert date(2025, 12, 31) in calendar.business_days(period, date(2025, 12, 31))
+
+
+def test_compiled_calendar_cache_is_bounded():
+    from hg_systematic.impl._compiled_calendar import _COMPILED_CALENDARS
+    try:
+        clear_compiled_calendar_cache()
+        set_compiled_calendar_cache_size(2)
+        first = compile_calendar(frozenset({date(2025, 1, 1)}))
+        for day in range(2, 6):
+            compile_calendar(frozenset({date(2025, 1, day)}))
+        assert len(_COMPILED_CALENDARS) == 2
+        assert compile_calendar(frozenset({date(2025, 1, 1)})) is not first
+    finally:
+        set_compiled_calendar_cache_size(64)
+
+
+def test_business_day_index():
+    assert eval_node(
+        business_day_index,
+        [Periods.Month],
+        [{"holidays": frozenset({date(2025, 1, 1)}), "start_of_week": 0, "end_of_week": 4}],
+        [date(2025, 1, 2), date(2025, 1, 3), date(2025, 1, 4), date(2025, 1, 31), date(2025, 2, 3)],
+    ) == [1, 2, 0, 22, 1]
+
+
+def test_create_market_holidays_cached(tmp_path, monkeypatch):
+    from hg_systematic.impl import _calendar_impl
+    monkeypatch.setattr(_calendar_impl, "_HOLIDAY_CACHE_DIR", str(tmp_path))
+    holidays = create_market_holidays(["US", "GB"], datetime(2024, 1, 1), datetime(2025, 1, 1))
+    assert date(2025, 12, 25) in holidays and date(2024, 7, 4) in holidays
+    assert len(list(tmp_path.glob("holidays-GB_US-2024-2025-*.npy"))) == 1
+    assert create_market_holidays(["GB", "US"], datetime(2024, 1, 1), datetime(2025, 1, 1)) is holidays
+    ordinals = market_holiday_ordinals(["US", "GB"], datetime(2024, 1, 1), datetime(2025, 1, 1))
+    assert isinstance(ordinals, np.memmap)
+    assert list(ordinals) == sorted(d.toordinal() for d in holidays)
+
+
+def test_create_market_holidays_not_cached_by_default(tmp_path, monkeypatch):
+    from hg_systematic.impl import _calendar_impl
+    monkeypatch.setattr(_calendar_impl, "_HOLIDAY_CACHE_DIR", None)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    holidays = create_market_holidays(["US"], datetime(2024, 1, 1), datetime(2024, 1, 1))
+    assert date(2024, 7, 4) in holidays
+    assert not list(tmp_path.rglob("*.npy"))
+
+
+def test_in_calendar_outside_compiled_range():
+    @graph
+    def g(c: TSB[HolidayCalendarSchema], d: TS[date]) -> TS[bool]:
+        return contains_(c, d)
+
+    assert eval_node(
+        g,
+        [{"holidays": frozenset({date(2025, 1, 1)}), "start_of_week": 0, "end_of_week": 4}],
+        [date(2025, 1, 1), date(2025, 1, 2), date(2031, 1, 4), date(1990, 1, 3)]
+    ) == [True, False, True, False]
+
+
+def test_union_calendars():
+    @graph
+    def g(lhs: TSB[HolidayCalendarSchema], rhs: TSB[HolidayCalendarSchema], dt: TS[date]) -> TS[bool]:
+        return contains_(union_calendars(lhs, rhs), dt)
+
+    assert eval_node(
+        g,
+        [{"holidays": frozenset({date(2025, 1, 1)}), "start_of_week": 0, "end_of_week": 4}],
+        [{"holidays": frozenset({date(2025, 1, 2)}), "start_of_week": 6, "end_of_week": 3}],
+        [date(2025, 1, 1), date(2025, 1, 2), date(2025, 1, 3), date(2025, 1, 4), date(2025, 1, 5),
+         date(2025, 1, 6)],
+    ) == [True, True, True, True, True, False]
+
+
+def test_intersect_and_difference_calendars():
+    us = {"holidays": frozenset({date(2025, 1, 1), date(2025, 7, 4)}), "start_of_week": 0, "end_of_week": 4}
+    gb = {"holidays": frozenset({date(2025, 1, 1), date(2025, 12, 26)}), "start_of_week": 0, "end_of_week": 4}
+    assert eval_node(intersect_calendars, [us], [gb]) == [
+        {"holidays": frozenset({date(2025, 1, 1)}), "start_of_week": 0, "end_of_week": 4}]
+    # The weekends are removed by the difference, leaving all days as working days bar the US only holiday.
+    assert eval_node(difference_calendars, [us], [gb]) == [
+        {"holidays": frozenset({date(2025, 7, 4)}), "start_of_week": 0, "end_of_week": 6}]
+
+
+def test_calendar_for_static_expression():
+    @graph
+    def g() -> TS[bool]:
+        register_service(default_path, calendar_for_static, holidays=fd({
+            "S1": frozenset({date(2025, 1, 1)}),
+            "S2": frozenset({date(2025, 1, 2)}),
+        }))
+        dt = const(date(2025, 1, 2))
+        return and_(contains_(calendar_for("S1|S2"), dt), not_(contains_(calendar_for("S1"), dt)))
+
+    assert eval_node(g, __elide__=True) == [True]
+
+
+_CALENDAR = {"holidays": frozenset({date(2025, 1, 1), date(2025, 12, 25)}), "start_of_week": 0, "end_of_week": 4}
+
+
+def test_business_day_offset():
+    assert eval_node(
+        business_day_offset,
+        [_CALENDAR],
+        [date(2024, 12, 31), date(2025, 1, 4), date(2025, 1, 4)],
+        [1, None, -1],
+    ) == [date(2025, 1, 2), date(2025, 1, 7), date(2025, 1, 2)]
+
+
+def test_nth_business_day():
+    assert eval_node(
+        nth_business_day,
+        [_CALENDAR],
+        [date(2025, 1, 20), date(2025, 12, 3)],
+        [1, -1],
+    ) == [date(2025, 1, 2), date(2025, 12, 31)]
+
+
+def test_nth_business_day_zero():
+    calendar = compile_calendar(_CALENDAR["holidays"])
+    with pytest.raises(ValueError):
+        calendar.nth_business_day(date(2025, 1, 20), 0)
+    with pytest.raises(ValueError):
+        calendar.nth_business_day(np.array([date(2025, 1, 20)], dtype="datetime64[D]"), np.array([0]))
+
+
+def test_business_days_between():
+    assert eval_node(
+        business_days_between,
+        [_CALENDAR],
+        [date(2025, 1, 1), date(2025, 12, 1)],
+        [date(2025, 2, 1), date(2026, 1, 1)],
+    ) == [22, 22]
+
+
+def test_compiled_calendar_bulk_arithmetic():
+    calendar = compile_calendar(_CALENDAR["holidays"])
+    dates = np.array([date(2025, 1, 4), date(2025, 3, 10)], dtype="datetime64[D]")
+    assert calendar.business_day_offset(dates, 2).tolist() == [date(2025, 1, 8), date(2025, 3, 12)]
+    assert calendar.nth_business_day(dates, np.array([1, -1])).tolist() == [date(2025, 1, 2), date(2025, 3, 31)]
+    assert calendar.business_days_between(dates, dates + np.timedelta64(7, "D")).tolist() == [5, 5]
+
+
+def test_business_days_holiday_delta():
+    january = tuple(d for d in (date(2025, 1, i) for i in range(1, 32)) if d.weekday() < 5)
+    assert eval_node(
+        business_days,
+        [Periods.Month],
+        [
+            {"holidays": frozenset(), "start_of_week": 0, "end_of_week": 4},
+            {"holidays": {date(2025, 2, 3)}},  # Outside of the current period
+            {"holidays": {date(2025, 1, 20)}},
+            {"holidays": {Removed(date(2025, 1, 20))}},
+        ],
+        [date(2025, 1, 15)],
+    ) == [january, None, tuple(d for d in january if d != date(2025, 1, 20)), january]
+
+
+def test_business_day_index_ignores_unrelated_holidays():
+    assert eval_node(
+        business_day_index,
+        [Periods.Month],
+        [
+            {"holidays": frozenset(), "start_of_week": 0, "end_of_week": 4},
+            {"holidays": {date(2025, 1, 20)}},
+            {"holidays": {date(2025, 1, 2)}},
+        ],
+        [date(2025, 1, 15)],
+    ) == [11, None, 10]
+
+
+def test_business_days_period_cache():
+    clear_period_cache()
+    calendar = {"holidays": frozenset({date(2025, 1, 1)}), "start_of_week": 0, "end_of_week": 4}
+    for _ in range(2):
+        assert len(eval_node(business_days, [Periods.Month], [calendar], [date(2025, 1, 2), date(2025, 2, 3)])) == 2
+    info = period_cache_info()
+    assert info.misses == 2 and info.hits == 2 and info.size == 2
+
+
+@pytest.mark.parametrize(
+    ["start", "expected"],
+    [
+        [datetime(2025, 1, 2), [{"a": 1.0, "b": 2.0}, {"a": 3.0}, {"a": REMOVE}]],
+        [datetime(2025, 1, 3), []],  # Removing a key that was never published produces no change
+    ]
+)
+def test_filter_by_calendar_tsd(start, expected):
+    @graph
+    def g(ts: TSD[str, TS[float]], c: TSB[HolidayCalendarSchema]) -> TSD[str, TS[float]]:
+        return filter_by_calendar(ts, c)
+
+    assert eval_node(
+        g,
+        [{"a": 1.0, "b": 2.0}, {"a": 3.0}, {"a": REMOVE}],
+        [{"holidays": frozenset({date(2025, 1, 3)}), "start_of_week": 0, "end_of_week": 4}],
+        __start_time__=start,
+        __elide__=True,
+    ) == expected
+
+
+@pytest.mark.parametrize(["start", "expected"], [[datetime(2025, 1, 2), [1.0, 2.0]], [datetime(2025, 1, 3), []]])
+def test_filter_by_calendar_ts(start, expected):
+    @graph
+    def g(ts: TS[float], c: TSB[HolidayCalendarSchema]) -> TS[float]:
+        return filter_by_calendar(ts, c)
+
+    assert eval_node(
+        g,
+        [1.0, 2.0],
+        [{"holidays": frozenset({date(2025, 1, 3)}), "start_of_week": 0, "end_of_week": 4}],
+        __start_time__=start,
+        __elide__=True,
+    ) == expected
+
+
+def test_trade_date_sparse():
+    holidays = frozenset({date(2025, 1, 1), date(2025, 1, 6)})
+
+    @graph
+    def g() -> TS[date]:
+        register_service(
+            default_path, trade_date_sparse,
+            holidays=holidays,
+            dates=frozenset({date(2025, 1, 6)}),
+            start_date=date(2025, 1, 3),
+        )
+        return trade_date()
+
+    assert eval_node(
+        g,
+        __start_time__=datetime(2025, 1, 1),
+        __end_time__=datetime(2025, 1, 8, 23, 59),
+        __elide__=True
+    ) == [date(2025, 1, 3), date(2025, 1, 6), date(2025, 1, 7), date(2025, 1, 8)]
+    info = trade_date_sparse_clock_info(date(2025, 1, 1), date(2025, 1, 8), holidays=holidays,
+                                        dates=frozenset({date(2025, 1, 6)}), start_date=date(2025, 1, 3))
+    assert info == TradeDateClockInfo(ticks=4, week_days=6)
+    assert info.cycles_avoided == 2
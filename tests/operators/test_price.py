@@ -0,0 +1,311 @@
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import polars as pl
+import polars.selectors as cs
+import pytest
+from frozendict import frozendict
+from hgraph import graph, TSS, TSD, TS, register_service, default_path, map_, Removed, const, sink_node, \
+    run_graph, EvaluationMode, generator, TSB, REMOVE, EvaluationEngineApi
+from hgraph.test import eval_node
+
+from hg_systematic.impl import price_in_dollars_static_impl, price_in_dollars_replay_impl, \
+    price_in_dollars_store_impl, write_price_store, price_store, clear_price_stores, returns_in_dollars_static_impl, \
+    returns_in_dollars_store_impl, price_in_dollars_wide_impl, LivePriceFeed, price_in_dollars_live_impl, \
+    fx_rate_static_impl, price_in_dollars_fx_impl, static_prices
+from hg_systematic.operators import price_in_dollars, returns_in_dollars, subscription_metrics, SubscriptionMetrics, \
+    LIVE_PRICE, NATIVE_PRICE, as_of_prices, AsOfPrices
+from tests.equivalence import service, with_services, assert_equivalent
+
+
+def _wide_prices() -> pl.DataFrame:
+    from importlib.resources import files, as_file
+    import tests.index
+    with as_file(files(tests.index).joinpath("CL.parquet")) as file:
+        return pl.read_parquet(file)
+
+
+def _prices() -> pl.DataFrame:
+    return _wide_prices().unpivot(
+        cs.numeric(), index="date", variable_name="symbol", value_name="price"
+    ).drop_nulls().cast({"date": date}).select("date", "symbol", "price")
+
+
+def _prices_of(symbols: TSS[str]) -> TSD[str, TS[float]]:
+    return map_(lambda key: price_in_dollars(key), __keys__=symbols)
+
+
+def _returns_of(symbols: TSS[str]) -> TSD[str, TS[float]]:
+    return map_(lambda key: returns_in_dollars(key), __keys__=symbols)
+
+
+@pytest.mark.parametrize("chunk_days", [7, 90])
+def test_price_in_dollars_replay(tmp_path, chunk_days):
+    prices = _prices()
+    prices.write_parquet(source := str(tmp_path / "prices.parquet"))
+
+    expected = assert_equivalent(
+        with_services(_prices_of, service(price_in_dollars_static_impl, prices=prices)),
+        with_services(_prices_of, service(price_in_dollars_replay_impl, source=source, chunk_days=chunk_days)),
+        [{"CLH25", "CLJ25"}, None, {"CLK25"}],
+        __start_time__=datetime(2025, 1, 2), __end_time__=datetime(2025, 3, 1), __elide__=True
+    )
+    assert len(expected) > 30
+
+
+def test_price_in_dollars_store(tmp_path):
+    prices = _prices()
+    write_price_store(prices, path := str(tmp_path / "prices.arrow"))
+    store = price_store(path)
+    assert len(store) == len(prices)
+    start, end = store.range("CLJ25")
+    assert end - start == prices.filter(pl.col("symbol") == "CLJ25").height
+    assert store.date(store.seek("CLJ25", date(2025, 1, 2)) - 1) == date(2025, 1, 2)
+
+    expected = assert_equivalent(
+        with_services(_prices_of, service(price_in_dollars_static_impl, prices=prices)),
+        with_services(_prices_of, service(price_in_dollars_store_impl, store=path)),
+        [{"CLJ25", "CLK25"}, None, {"CLM25"}, None, None, {"CLN25"}],
+        __start_time__=datetime(2025, 1, 2), __end_time__=datetime(2025, 3, 1), __elide__=True
+    )
+    assert len(expected) > 30
+
+
+@pytest.mark.parametrize("impl", ["replay", "store", "wide"])
+@pytest.mark.parametrize(["start", "end"], [
+    [datetime(2025, 3, 10), datetime(2025, 4, 1)],  # Runs past the last prices (2025-03-14)
+    [datetime(2025, 4, 1), datetime(2025, 5, 1)],  # After the last prices
+])
+def test_price_in_dollars_edges(tmp_path, impl, start, end):
+    prices = _prices()
+    if impl == "replay":
+        prices.write_parquet(source := str(tmp_path / "prices.parquet"))
+        candidate = service(price_in_dollars_replay_impl, source=source, chunk_days=7)
+    elif impl == "store":
+        write_price_store(prices, path := str(tmp_path / "prices.arrow"))
+        candidate = service(price_in_dollars_store_impl, store=path)
+    else:
+        candidate = service(price_in_dollars_wide_impl, prices=_wide_prices())
+
+    # An unknown symbol, a removal and a symbol re-requested after its removal
+    symbols = [{"CLJ25", "CLK25", "XXX"}, None, {Removed("CLJ25")}, None, {"CLJ25", "CLM25"}, {Removed("XXX")}]
+    expected = assert_equivalent(
+        with_services(_prices_of, service(price_in_dollars_static_impl, prices=prices)),
+        with_services(_prices_of, candidate),
+        symbols, __start_time__=start, __end_time__=end, __elide__=True
+    )
+    if start > datetime(2025, 3, 14):
+        assert not any(expected)
+    else:
+        assert expected[2] == {"CLJ25": REMOVE}
+        assert expected[4] == {"CLJ25": 66.03, "CLM25": 65.27}  # Re-requested with the price of the day
+        assert len(expected) == 9 and all("XXX" not in tick for tick in expected)
+
+
+def test_price_store_reopened_when_rewritten(tmp_path):
+    prices = _prices()
+    write_price_store(prices, path := str(tmp_path / "prices.arrow"))
+    assert price_store(path) is price_store(path)
+    assert "CLJ25" in price_store(path).symbols
+    write_price_store(prices.filter(pl.col("symbol") != "CLJ25"), path)
+    assert "CLJ25" not in price_store(path).symbols
+    clear_price_stores()
+
+
+def test_returns_in_dollars(tmp_path):
+    prices = _prices()
+    write_price_store(prices, path := str(tmp_path / "prices.arrow"))
+
+    args = dict(__start_time__=datetime(2025, 1, 2), __end_time__=datetime(2025, 3, 1), __elide__=True)
+    symbols = [{"CLJ25", "CLK25"}, None, {"CLM25"}]
+    expected = assert_equivalent(
+        with_services(_returns_of, service(returns_in_dollars_static_impl, prices=prices)),
+        with_services(_returns_of, service(returns_in_dollars_store_impl, store=path)),
+        symbols, **args
+    )
+
+    # The returns are the change in price since the previous price
+    previous = {}
+    prices_of = with_services(_prices_of, service(price_in_dollars_static_impl, prices=prices))
+    for prices_, returns_ in zip(eval_node(prices_of, symbols, **args)[3:], expected[3:]):
+        if prices_:
+            assert returns_.keys() == prices_.keys()
+            for k, v in prices_.items():
+                if k in previous:
+                    assert returns_[k] == pytest.approx(v - previous[k])
+            previous.update(prices_)
+
+
+def test_returns_in_dollars_first_price_and_removal(tmp_path):
+    prices = _prices()
+    write_price_store(prices, path := str(tmp_path / "prices.arrow"))
+    # CLM28 is first priced on 2019-06-10, the first price of a symbol has no return
+    expected = assert_equivalent(
+        with_services(_returns_of, service(returns_in_dollars_static_impl, prices=prices)),
+        with_services(_returns_of, service(returns_in_dollars_store_impl, store=path)),
+        [{"CLM28", "CLZ27"}, None, {Removed("CLZ27")}],
+        __start_time__=datetime(2019, 6, 6), __end_time__=datetime(2019, 6, 13), __elide__=True
+    )
+    assert expected == [{}, {"CLZ27": 0.75}, {"CLZ27": REMOVE}, {"CLM28": 0.57}, {"CLM28": -1.1}]
+
+
+def test_static_prices_cache():
+    import gc
+    from hg_systematic.impl._price_impl import _STATIC_PRICES
+    prices = _prices()
+    frame = static_prices(prices, 2)
+    assert frame.columns == ["date", "symbol", "price"]
+    assert static_prices(prices, 2) is frame
+    assert list(_STATIC_PRICES[id(prices)][1]) == [(2, "price")]  # The returns are only computed when asked for
+    assert static_prices(prices, 2, "returns").columns == ["date", "symbol", "returns"]
+    key = id(prices)
+    del prices
+    gc.collect()
+    assert key not in _STATIC_PRICES
+
+
+def test_subscription_metrics():
+    assert eval_node(subscription_metrics, [{"a", "b"}, {Removed("a"), "c"}, {Removed("b"), Removed("c")}]) == [
+        SubscriptionMetrics(live=2, peak=2, subscribed=2, unsubscribed=0),
+        SubscriptionMetrics(live=2, peak=2, subscribed=3, unsubscribed=1),
+        SubscriptionMetrics(live=0, peak=2, subscribed=3, unsubscribed=3),
+    ]
+
+
+def test_price_in_dollars_wide():
+    expected = assert_equivalent(
+        with_services(_prices_of, service(price_in_dollars_static_impl, prices=_prices())),
+        with_services(_prices_of, service(price_in_dollars_wide_impl, prices=_wide_prices())),
+        [{"CLJ25", "CLK25"}, None, {"CLM25"}, None, {"CLJ26"}],
+        __start_time__=datetime(2025, 1, 2), __end_time__=datetime(2025, 3, 1), __elide__=True
+    )
+    assert len(expected) > 30
+
+
+def test_price_in_dollars_wide_date_column():
+    @graph
+    def g(symbols: TSS[str]) -> TSD[str, TS[float]]:
+        register_service(default_path, price_in_dollars_wide_impl, prices=_wide_prices().rename({"date": "dt"}),
+                         date_column="dt")
+        return map_(lambda key: price_in_dollars(key), __keys__=symbols)
+
+    @graph
+    def g_missing(symbols: TSS[str]) -> TSD[str, TS[float]]:
+        register_service(default_path, price_in_dollars_wide_impl, prices=_wide_prices().drop("date"))
+        return map_(lambda key: price_in_dollars(key), __keys__=symbols)
+
+    args = dict(__start_time__=datetime(2025, 1, 2), __end_time__=datetime(2025, 1, 10), __elide__=True)
+    assert eval_node(g, [{"CLJ25"}], **args)
+    with pytest.raises(Exception, match="no date column"):
+        eval_node(g_missing, [{"CLJ25"}], **args)
+
+
+def test_price_in_dollars_live():
+    feed = LivePriceFeed(window=timedelta(milliseconds=200), windows={"B": timedelta()})
+    ticks = []
+
+    @sink_node
+    def record(prices: TSD[str, TS[float]], _api: EvaluationEngineApi = None):
+        ticks.append(dict(prices.delta_value))
+        if prices.value.get("A") == 30.0:
+            _api.request_engine_stop()
+
+    @graph
+    def g():
+        register_service(LIVE_PRICE, price_in_dollars_live_impl, feed=feed)
+        symbols = const(frozenset({"A", "B"}), TSS[str])
+        record(map_(lambda key: price_in_dollars(key, path=LIVE_PRICE), __keys__=symbols))
+
+    def produce():
+        while feed.symbols != {"A", "B"}:
+            time.sleep(0.01)
+        # A burst of ticks (delivered together) followed by a tick of A within its window
+        feed.replay([(0.0, "A", float(i)) for i in range(30)] + [(0.0, "C", 1.0), (0.0, "B", 2.0), (0.05, "A", 30.0)])
+
+    threading.Thread(target=produce, daemon=True).start()
+    run_graph(g, run_mode=EvaluationMode.REAL_TIME, end_time=timedelta(seconds=30))
+    assert not feed.running  # Stopped with the graph
+
+    # The burst is conflated into its last value (last value wins), A is published again after its window
+    assert [t["A"] for t in ticks if "A" in t] == [29.0, 30.0]
+    assert [t["B"] for t in ticks if "B" in t] == [2.0]
+    stats = feed.stats
+    assert stats.received == 32 and stats.dropped == 1  # C is not subscribed
+    assert stats.coalesced == 29 and stats.published == 3
+
+
+def test_price_in_dollars_fx():
+    native = pl.DataFrame({
+        "date": [date(2025, 1, 1), date(2025, 1, 2), date(2025, 1, 3)],
+        "FESX": [100.0, 101.0, None],
+        "FGBL": [200.0, None, 202.0],
+        "CL": [70.0, 71.0, 72.0],
+    })
+    rates = pl.DataFrame({
+        "date": [date(2025, 1, 1), date(2025, 1, 3)],
+        "EURUSD": [1.1, 1.2],
+    })
+
+    @graph
+    def g(symbols: TSS[str]) -> TSD[str, TS[float]]:
+        register_service(NATIVE_PRICE, price_in_dollars_wide_impl, prices=native)
+        register_service(default_path, fx_rate_static_impl, rates=rates)
+        register_service(default_path, price_in_dollars_fx_impl, currencies=frozendict(FESX="EUR", FGBL="EUR"))
+        return map_(lambda key: price_in_dollars(key), __keys__=symbols)
+
+    result = eval_node(g, [{"FESX", "FGBL", "CL"}], __start_time__=datetime(2025, 1, 1),
+                       __end_time__=datetime(2025, 1, 4), __elide__=True)
+    result = [r for r in result if r]
+    assert result == [
+        {"FESX": 110.0, "FGBL": 220.0, "CL": 70.0},
+        {"FESX": 111.1, "CL": 71.0},
+        {"FESX": 121.2, "FGBL": 242.4, "CL": 72.0},
+    ]
+
+
+def test_convert_to_dollars_rate_removed():
+    from hg_systematic.impl._fx_impl import _convert_to_dollars
+    currencies = frozendict(FESX="EUR", FGBL="EUR")
+    result = eval_node(
+        _convert_to_dollars,
+        [{"FESX": 100.0, "FGBL": 200.0, "CL": 70.0}, {"FESX": 101.0}, None, {"FESX": 102.0}],
+        [{"EURUSD": 1.1}, None, {"EURUSD": REMOVE}, {"EURUSD": 1.2}],
+        currencies, 2
+    )
+    assert result == [
+        {"FESX": 110.0, "FGBL": 220.0, "CL": 70.0},
+        {"FESX": 111.1},
+        {"FESX": REMOVE, "FGBL": REMOVE},
+        {"FESX": 122.4, "FGBL": 240.0},
+    ]
+
+
+def test_as_of_prices():
+    prices = pl.DataFrame({
+        "date": [date(2025, 1, 2), date(2025, 1, 3), date(2025, 1, 8)],
+        "a": [1.0, 2.0, 3.0],
+        "b": [None, 5.0, None],
+    })
+
+    @generator
+    def lagged_dt() -> TS[date]:
+        # The date lags the prices by a day
+        for dt, lagged in [(date(2025, 1, 2), date(2025, 1, 1)), (date(2025, 1, 3), date(2025, 1, 2)),
+                           (date(2025, 1, 6), date(2025, 1, 3)), (date(2025, 1, 8), date(2025, 1, 6)),
+                           (date(2025, 1, 9), date(2025, 1, 8))]:
+            yield datetime(dt.year, dt.month, dt.day), lagged
+
+    @graph
+    def g() -> TSB[AsOfPrices]:
+        register_service(default_path, price_in_dollars_wide_impl, prices=prices)
+        symbols = const(frozenset({"a", "b"}), TSS[str])
+        return as_of_prices(map_(lambda key: price_in_dollars(key), __keys__=symbols), lagged_dt(), max_staleness=2)
+
+    result = eval_node(g, __start_time__=datetime(2025, 1, 2), __end_time__=datetime(2025, 1, 10), __elide__=True)
+    assert result == [
+        {"prices": {"a": 1.0}, "age": {"a": 0}},
+        {"prices": {"a": 2.0, "b": 5.0}, "age": {"b": 0}},
+        {"prices": {"a": REMOVE, "b": REMOVE}, "age": {"a": REMOVE, "b": REMOVE}},
+        {"prices": {"a": 3.0}, "age": {"a": 0}},
+    ]
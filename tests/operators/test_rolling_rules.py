@@ -1,17 +1,29 @@
 from datetime import datetime, date
 
+import polars as pl
+
 import pytest
 from frozendict import frozendict as fd
-from hgraph import TS, cmp_, TSB, CmpResult, graph, register_service, default_path, TSL, Size, combine
+from hgraph import TS, cmp_, TSB, CmpResult, graph, register_service, default_path, TSL, Size, combine, map_, TSD, \
+    REMOVE
 from hgraph.test import eval_node
 
 from examples.bcom_index.bcom_index import get_bcom_roll_schedule, create_bcom_holidays
 from hg_systematic.impl import calendar_for_static, business_day_impl, trade_date_week_days, \
-    monthly_rolling_weights_impl, rolling_schedules_service_impl
-from hg_systematic.impl._rolling_rules_impl import monthly_rolling_info_service_impl
+    monthly_rolling_weights_impl, rolling_schedules_service_impl, trade_date_sparse
+from hg_systematic.impl import ContractExpiryTable, contract_expiry_static_impl, next_live_contract_static_impl, \
+    CompiledCalendar
+from hg_systematic.impl._rolling_rules_impl import monthly_rolling_info_service_impl, \
+    monthly_rolling_info_compact_service_impl, monthly_rolling_ordinals_service_impl, \
+    monthly_rolling_info_table_service_impl, monthly_rolling_weights_fused_impl, monthly_rolling_ordinals_for, \
+    monthly_rolling_weights_ordinals_impl
 from hg_systematic.operators import MonthlyRollingRange, monthly_rolling_weights, MonthlyRollingWeightRequest
 from hg_systematic.operators._rolling_rules import futures_rolling_contracts, rolling_schedules, \
-    bbg_commodity_contract_fn, monthly_rolling_info, MonthlyRollingRequest
+    bbg_commodity_contract_fn, monthly_rolling_info, MonthlyRollingRequest, MonthlyRollingInfo, \
+    monthly_rolling_ordinals, MonthlyRollingOrdinals, multi_asset_rolling_contracts, ContractExpiry, FutureContract, \
+    contract_expiry, next_live_contract
+from hg_systematic.operators import INDEX_ROLL_STR
+from tests.equivalence import service, with_services, assert_equivalent
 
 
 @graph
@@ -127,6 +139,254 @@ def test_roll_contracts_monthly_with_range(dt, expected):
         __end_time__=datetime(dt.year, dt.month, dt.day, 23),
     ) == [expected]
 
+
+def _state_by_date(ticks):
+    """Merges the (partial) bundle ticks, returning the settled state of the bundle for each date"""
+    state = {}
+    out = {}
+    for tick in ticks:
+        if tick is not None and "dt" in (state := state | tick):
+            out[state["dt"]] = state | {"days_of_month": tuple(state["days_of_month"])}
+    return out
+
+
+def _rolling_info(request: TS[MonthlyRollingRequest]) -> TSB[MonthlyRollingInfo]:
+    register_service(default_path, calendar_for_static, holidays=fd(BCOM=create_bcom_holidays()))
+    register_service(default_path, business_day_impl)
+    register_service(default_path, trade_date_week_days)
+    return monthly_rolling_info(request)
+
+
+@pytest.mark.parametrize(["start", "end"], [[5, 10], [-3, 5]])
+@pytest.mark.parametrize("impl", [monthly_rolling_info_compact_service_impl, monthly_rolling_info_table_service_impl])
+def test_monthly_rolling_info_equivalence(impl, start, end):
+    assert_equivalent(
+        with_services(_rolling_info, service(monthly_rolling_info_service_impl)),
+        with_services(_rolling_info, service(impl)),
+        [MonthlyRollingRequest(start=start, end=end, calendar_name="BCOM")],
+        normalise=_state_by_date, __start_time__=datetime(2024, 11, 20), __end_time__=datetime(2025, 3, 10),
+        __elide__=True,
+    )
+
+
+def test_monthly_rolling_info_table_extended():
+    # The table is compiled two years at a time, so this crosses two extensions of the table (and the year ends)
+    expected = assert_equivalent(
+        with_services(_rolling_info, service(monthly_rolling_info_service_impl)),
+        with_services(_rolling_info, service(monthly_rolling_info_table_service_impl)),
+        [MonthlyRollingRequest(start=-3, end=5, calendar_name="BCOM")],
+        normalise=_state_by_date, __start_time__=datetime(2024, 12, 20), __end_time__=datetime(2029, 1, 10),
+        __elide__=True,
+    )
+    assert min(expected) == date(2024, 12, 20) and max(expected) == date(2029, 1, 9)
+
+
+def _sparse_rolling_info(request: TS[MonthlyRollingRequest]) -> TSB[MonthlyRollingInfo]:
+    register_service(default_path, calendar_for_static, holidays=fd(BCOM=create_bcom_holidays()))
+    register_service("bd", business_day_impl)
+    register_service(default_path, trade_date_sparse, start_date=date(2025, 1, 15))
+    return monthly_rolling_info(request)
+
+
+def test_monthly_rolling_info_table_sparse_clock():
+    expected = assert_equivalent(
+        with_services(_sparse_rolling_info, service(monthly_rolling_info_service_impl, business_day_path="bd")),
+        with_services(_sparse_rolling_info, service(monthly_rolling_info_table_service_impl, business_day_path="bd")),
+        [MonthlyRollingRequest(start=-3, end=5, calendar_name="BCOM")],
+        normalise=_state_by_date, __start_time__=datetime(2024, 12, 1), __end_time__=datetime(2025, 3, 10),
+        __elide__=True,
+    )
+    assert min(expected) == date(2025, 1, 15)
+
+
+def test_monthly_rolling_ordinals():
+    @graph
+    def g(request: TS[MonthlyRollingRequest]) -> TSB[MonthlyRollingOrdinals]:
+        register_service(default_path, calendar_for_static, holidays=fd(Test=frozenset()))
+        register_service(default_path, business_day_impl)
+        register_service(default_path, trade_date_week_days)
+        register_service(default_path, monthly_rolling_ordinals_service_impl)
+        return monthly_rolling_ordinals(request)
+
+    result = eval_node(
+        g,
+        [MonthlyRollingRequest(start=-2, end=3, calendar_name="Test")],
+        __start_time__=datetime(2025, 1, 30),
+        __end_time__=datetime(2025, 2, 3, 23),
+        __elide__=True,
+    )
+    assert result[0] == dict(
+        start=-2, end=3, first_day=21, dt=date(2025, 1, 30).toordinal(), month_first=date(2025, 1, 1).toordinal(),
+        month_last=date(2025, 1, 31).toordinal(), day_index=22, begin_roll=False, end_roll=False,
+        roll_state=CmpResult.EQ, roll_out_month=2, roll_out_year=2025, roll_in_month=3, roll_in_year=2025
+    )
+    # Only the values that change tick
+    assert result[1] == dict(dt=date(2025, 1, 31).toordinal(), day_index=23)
+    assert result[2] == dict(dt=date(2025, 2, 3).toordinal(), month_first=date(2025, 2, 3).toordinal(),
+                             month_last=date(2025, 2, 28).toordinal(), day_index=1, first_day=18)
+
+
+def test_monthly_rolling_ordinals_independent_of_compiled_range():
+    # The month is described by dates, so is the same whatever range the calendar has been compiled for
+    narrow = CompiledCalendar(frozenset({date(2025, 1, 1)}), 0, 4, 2025, 2025)
+    ordinals = monthly_rolling_ordinals_for(narrow, date(2025, 1, 30), -2, 3)
+    wide = CompiledCalendar(frozenset({date(2025, 1, 1)}), 0, 4, 2010, 2025)
+    assert monthly_rolling_ordinals_for(wide, date(2025, 1, 30), -2, 3) == ordinals
+    assert (ordinals["month_first"], ordinals["month_last"]) == (date(2025, 1, 2).toordinal(),
+                                                                date(2025, 1, 31).toordinal())
+
+
+@pytest.mark.parametrize(["start", "end", "round_to", "ticks", "first_weights"], [
+    [5, 10, 2, 145, [1.0, 0.8, 0.6, 0.4, 0.2, 0.0, 1.0]],
+    [-2, 3, 2, 143, [0.4, 0.2, 0.0, 1.0, 0.8, 0.6, 0.4]],
+    [-3, 5, 4, 215, [0.5, 0.375, 0.25, 0.125, 0.0, 1.0, 0.875]],
+    [0, 7, 3, 192, [0.857, 0.714, 0.571, 0.429, 0.286, 0.143, 0.0]],
+])
+def test_monthly_rolling_weights_fused_equivalence(start, end, round_to, ticks, first_weights):
+    def weights(request: TS[MonthlyRollingWeightRequest]) -> TS[float]:
+        register_service(default_path, calendar_for_static, holidays=fd(BCOM=create_bcom_holidays()))
+        register_service(default_path, business_day_impl)
+        register_service(default_path, trade_date_week_days)
+        return monthly_rolling_weights(request)
+
+    reference = with_services(weights, service(monthly_rolling_weights_impl),
+                              service(monthly_rolling_info_service_impl))
+    args = dict(
+        __start_time__=datetime(2024, 1, 1),
+        __end_time__=datetime(2025, 12, 31),
+        __elide__=True,
+    )
+    request = [MonthlyRollingWeightRequest(start=start, end=end, round_to=round_to, calendar_name="BCOM")]
+    expected = assert_equivalent(reference, with_services(weights, service(monthly_rolling_weights_fused_impl)),
+                                 request, **args)
+    # The weights of the graph implementation are held to those of the original graph implementation
+    assert len(expected) == ticks
+    assert expected[:len(first_weights)] == first_weights
+    assert_equivalent(reference, with_services(weights, service(monthly_rolling_weights_ordinals_impl),
+                                               service(monthly_rolling_ordinals_service_impl)), request, **args)
+
+
+def test_multi_asset_rolling_contracts():
+    def g(multi):
+        def g_(start: TS[int], end: TS[int]) -> INDEX_ROLL_STR:
+            rolling_info = monthly_rolling_info(combine[TS[MonthlyRollingRequest]](start=start, end=end,
+                                                                                   calendar_name="BCOM"))
+            schedules = rolling_schedules()
+            if multi:
+                return multi_asset_rolling_contracts(rolling_info, schedules, bbg_commodity_contract_fn)
+            contracts = map_(
+                lambda asset, ri, rs, c_fn: futures_rolling_contracts(ri, rs, asset, c_fn),
+                rolling_info,
+                schedules,
+                bbg_commodity_contract_fn,
+                __keys__=schedules.key_set,
+                __key_arg__="asset",
+            )
+            return INDEX_ROLL_STR.from_ts(first=map_(lambda c: c[0], contracts), second=map_(lambda c: c[1], contracts))
+
+        return with_services(
+            g_,
+            service(rolling_schedules_service_impl, schedules=get_bcom_roll_schedule()),
+            service(monthly_rolling_info_service_impl),
+            service(business_day_impl),
+            service(trade_date_week_days),
+            service(calendar_for_static, holidays=fd(BCOM=create_bcom_holidays())),
+        )
+
+    def contracts(ticks):
+        # Compare the (settled) contracts after each tick, ignoring re-ticks of an unchanged contract name
+        states = [{"first": {}, "second": {}}]
+        for tick in ticks:
+            if (state := {k: v | tick.get(k, {}) for k, v in states[-1].items()}) != states[-1]:
+                states.append(state)
+        return states
+
+    expected = assert_equivalent(g(False), g(True), [-3], [5], normalise=contracts,
+                                 __start_time__=datetime(2024, 11, 1), __end_time__=datetime(2025, 6, 1), __elide__=True)
+    assert len(expected[-1]["first"]) == len(get_bcom_roll_schedule())
+
+
+def test_multi_asset_rolling_contracts_roll_in_and_removal():
+    # The roll-in month is taken from the roll info (here a quarterly roll), not assumed to be the following month
+    roll_info = [
+        dict(roll_out_month=3, roll_out_year=2025, roll_in_month=6, roll_in_year=2025),
+        None,
+        dict(roll_out_month=12, roll_out_year=2025, roll_in_month=3, roll_in_year=2026),
+    ]
+    schedules = [
+        fd(CL=fd({3: (6, 0), 6: (9, 0), 12: (3, 1)}), NG=fd({3: (6, 0), 6: (9, 0), 12: (3, 1)})),
+        fd(NG=REMOVE),
+        None,
+    ]
+    assert eval_node(multi_asset_rolling_contracts, roll_info, schedules, [bbg_commodity_contract_fn]) == [
+        dict(first=fd(CL="CLM25 Comdty", NG="NGM25 Comdty"), second=fd(CL="CLU25 Comdty", NG="NGU25 Comdty")),
+        dict(first=fd(NG=REMOVE), second=fd(NG=REMOVE)),
+        dict(first=fd(CL="CLH26 Comdty"), second=fd(CL="CLM26 Comdty")),
+    ]
+
+
+_EXPIRIES = pl.DataFrame([
+    dict(asset="CL", month=3, year=2025, last_trade_date=date(2025, 2, 20), first_notice_date=None),
+    dict(asset="CL", month=2, year=2025, last_trade_date=date(2025, 1, 21), first_notice_date=None),
+    dict(asset="CL", month=4, year=2025, last_trade_date=date(2025, 3, 20), first_notice_date=None),
+    dict(asset="GC", month=2, year=2025, last_trade_date=date(2025, 2, 26), first_notice_date=date(2025, 1, 31)),
+    dict(asset="GC", month=4, year=2025, last_trade_date=date(2025, 4, 28), first_notice_date=date(2025, 3, 31)),
+])
+
+
+def test_contract_expiry_table():
+    table = ContractExpiryTable.from_frame(_EXPIRIES)
+    assert table.expiry(FutureContract("CL", 3, 2025)).last_trade_date == date(2025, 2, 20)
+    assert table.expiry(FutureContract("CL", 5, 2025)) is None
+    assert [(e.month, e.year) for e in table.contracts("CL")] == [(2, 2025), (3, 2025), (4, 2025)]
+    assert table.next_live("CL", date(2025, 1, 21)).month == 2
+    assert table.next_live("CL", date(2025, 1, 22)).month == 3
+    assert table.next_live("CL", date(2025, 3, 21)) is None
+    # Live ends the day before first notice
+    assert table.next_live("GC", date(2025, 1, 30)).month == 2
+    assert table.next_live("GC", date(2025, 1, 31)).month == 4
+    assert [e.month for e in table.live("CL", date(2025, 2, 1))] == [3, 4]
+
+
+def test_contract_expiry_table_cache():
+    import gc
+    from hg_systematic.impl._contract_expiry_impl import _TABLES, contract_expiry_table
+    expiries = _EXPIRIES.clone()
+    table = contract_expiry_table(expiries)
+    assert contract_expiry_table(expiries) is table
+    key = id(expiries)
+    assert key in _TABLES
+    del expiries
+    gc.collect()
+    assert key not in _TABLES
+
+
+def test_contract_expiry():
+    @graph
+    def g(contract: TS[FutureContract]) -> TS[ContractExpiry]:
+        register_service(default_path, contract_expiry_static_impl, expiries=_EXPIRIES)
+        return contract_expiry(contract)
+
+    assert eval_node(g, [FutureContract("GC", 2, 2025)], __elide__=True) == [
+        ContractExpiry("GC", 2, 2025, date(2025, 2, 26), date(2025, 1, 31))
+    ]
+
+
+def test_next_live_contract():
+    @graph
+    def g(asset: TS[str]) -> TS[int]:
+        register_service(default_path, trade_date_week_days)
+        register_service(default_path, next_live_contract_static_impl, expiries=_EXPIRIES)
+        return next_live_contract(asset).month
+
+    assert eval_node(
+        g, ["CL"],
+        __start_time__=datetime(2025, 1, 20),
+        __end_time__=datetime(2025, 3, 1),
+        __elide__=True
+    ) == [2, 3, 4]
+
+
 # def test_rolling_contract_for():
 #     @graph
 #     def g() -> TSL[TS[str], Size[2]]: